@@ -1,9 +1,12 @@
 """Recursively walks the given directory and copies the .c and .cpp and .cc files to output directory."""
 # -------------------------------------------------------------------------------------------
-import os, sys, shlex
+import os, sys, shlex, errno, shutil
 from subprocess import Popen, PIPE
 from multiprocessing.dummy import Pool
 
+sys.path.append("src/util")
+from BlobStore import BLOB_MANIFEST, readManifest
+
 # -------------------------------------------------------------------------------------------
 def isCFile(filename):
     """Returns True if `filename` ends in .c, .cpp, .cc"""
@@ -21,6 +24,19 @@ def Popen_and_print(cmd):
 
     return process.returncode
 
+# -------------------------------------------------------------------------------------------
+def linkOrCopy(paths):
+    """Makes `dest` (of the pair `paths` = (src, dest)) a hard link to `src`, or a copy of it where a hard link cannot be made (ex. across file systems)"""
+    src, dest = paths
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copyfile(src, dest)
+
 #--------------------------------------------------------------------------------------------------------------------------
 def printUsage():
     """
@@ -33,6 +49,10 @@ def printUsage():
 def extractAndCopyCFiles(in_dir, out_dir):
     """Recursively walks the `in_dir` directory and copies the .c and .cpp and .ccfiles to `out_dir`
 
+    The files are hard links to those in `in_dir` where possible, so that files linked from a blob store (see
+    src/util/BlobStore.py, ex. snapshots dumped with `dump.py --blob-store`) stay shared; their entries in the blob
+    manifests of `in_dir` are carried over to that of `out_dir`.
+
     Args
     ----
     in_dir: string
@@ -50,25 +70,34 @@ def extractAndCopyCFiles(in_dir, out_dir):
     if not os.path.isdir(out_dir):
         print("Creating output directory for extracted .c, .cpp, and .cc files.")
         cmd = "mkdir -p " + out_dir
-        Popen(shlex.split(cmd))
+        Popen(shlex.split(cmd)).wait()
     else:
         print("Emptying the possibly non-empty output directory for extracted .c, .cpp, and .cc files.")
         cmd = "rm -rf " + out_dir + '/*'
-        Popen(shlex.split(cmd))
+        Popen(shlex.split(cmd)).wait()
         out_dir = os.path.abspath(out_dir)
 
-    cmds = []
+    pairs = []
+    manifest = []
     for root, dirs, files in os.walk(in_dir):
+        blob_shas = readManifest(root)
         for nextFile in files:
             if(isCFile(nextFile)):
                 fullpath = os.path.join(root, nextFile)
                 outfile = "__".join(filter(None, root.partition(in_dir)[2].split('/')) + [nextFile])
-                cmd = "cp " + fullpath + " " + out_dir + "/" + outfile
-                cmds.append(shlex.split(cmd))
+                pairs.append((fullpath, out_dir + "/" + outfile))
+                if nextFile in blob_shas:
+                    manifest.append((blob_shas[nextFile], outfile))
 
-    # Create a maximum of 16 `cp` threads at a time. 16 seems small enough to not stall the system :-/
+    # Create a maximum of 16 threads at a time. 16 seems small enough to not stall the system :-/
     pool = Pool(16)
-    return_codes = pool.map(Popen_and_print, cmds)
+    pool.map(linkOrCopy, pairs)
+    pool.close()
+    pool.join()
+
+    if manifest:
+        with open(os.path.join(out_dir, BLOB_MANIFEST), 'w') as manifest_file:
+            manifest_file.write(''.join('%s\t%s\n' % entry for entry in manifest))
 
 # -------------------------------------------------------------------------------------------
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ import os.path
 import shutil
 import logging
 import datetime
+import bisect
 
 
 from Config import Config
@@ -15,6 +16,7 @@ from OutDir import OutDir
 from SnapShot import SnapShot
 
 sys.path.append("src/util")
+from DatabaseCon import DEFAULT_FETCH_SIZE
 import Log
 from Util import cd
 import Util
@@ -23,13 +25,14 @@ import Util
 
 class Corpus:
 
-    def __init__(self, projectPath, language, outDir, configFile, debug=True):
+    def __init__(self, projectPath, language, outDir, configFile, debug=True, blobStore=False):
 
         self.src_path = projectPath
         self.language = language
         self.out_path = outDir
         self.cfg      = configFile
         self.debug    = debug
+        self.blob_store = blobStore
 
         proj_path = self.src_path.rstrip(os.sep)
         self.project_name = proj_path.split(os.sep)[-1]
@@ -86,35 +89,41 @@ class Corpus:
 
         db_edits = DbEdits(self.project_name, self.language)
         db_edits.connectDb(db_config['database'], db_config['user'], db_config['host'], db_config['port'])
-        db_edits.fetchEditsFromTable(db_config['table'])
 
         #logging.debug(db_edits)
 
-        return db_edits.edits
+        # The edits are streamed from the database into `mapEditToSnapshot()`, which goes through them once; the
+        # optional `fetch_size` of the Database section sets how many rows are held at a time
+        fetch_size = int(db_config.get('fetch_size') or DEFAULT_FETCH_SIZE)
+        return db_edits.streamEditsFromTable(db_config['table'], fetch_size)
 
-    @staticmethod
-    def minKey(commitDate, snapshot):
+    def mapEditToSnapshot(self):
 
-        if commitDate >= snapshot.date:
-            return (commitDate - snapshot.date).days
-        else:
-            return 9999
+        # Each edit goes to the latest snapshot taken on or before its commit date; the snapshots are sorted by date
+        # (see `initSnapshots()`), so one binary search per edit finds it
+        snapshot_dates = [snap.date for snap in self.snapshots]
 
-    def mapEditToSnapshot(self):
+        # `self.edits` may be a stream (see `fetchEdits()`); the edits are only kept by their snapshots, and by
+        # `self.edit_to_snapshot` when debugging
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
         for e in self.edits:
             cd = e.commit_date
-            snap = min(self.snapshots, key=lambda sd : self.minKey(cd,sd))
-            if cd < snap.date:
-                print("---> skipping: commit_date %s: snapshot %s" % (cd, snap.date))
+            index = bisect.bisect_right(snapshot_dates, cd) - 1
+            if index < 0:
+                print("---> skipping: commit_date %s: snapshot %s" % (cd, self.snapshots[0].date))
                 continue
 
-            self.edit_to_snapshot[e] = snap
+            snap = self.snapshots[index]
+            if debug:
+                self.edit_to_snapshot[e] = snap
             snap.addEdit(e)
 
-        logging.debug("mapEditToSnapshot : <edit> : <snapshot>")
-        for key in self.edit_to_snapshot:
-            logging.debug("%s:%s" % (key, self.edit_to_snapshot[key]))
+        # Printing a snapshot prints all its edits, so this is only worth it when debugging
+        if debug:
+            logging.debug("mapEditToSnapshot : <edit> : <snapshot>")
+            for key in self.edit_to_snapshot:
+                logging.debug("%s:%s" % (key, self.edit_to_snapshot[key]))
 
     def initSnapshots(self):
 
@@ -126,7 +135,7 @@ class Corpus:
         snaps.sort()
 
         for snap in snaps:
-            s = SnapShot(self.src_path, snap, self.out_path)
+            s = SnapShot(self.src_path, snap, self.out_path, blobStore=self.blob_store)
             self.snapshots.append(s)
 
         self.mapEditToSnapshot()
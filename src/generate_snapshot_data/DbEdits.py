@@ -5,7 +5,7 @@ import logging
 from collections import namedtuple
 
 sys.path.append("src/util")
-from DatabaseCon import DatabaseCon
+from DatabaseCon import DatabaseCon, DEFAULT_FETCH_SIZE
 
 
 edit = namedtuple('edit', ['project', 'file_name', 'sha', 'commit_date', 'isbug'])
@@ -36,7 +36,13 @@ class DbEdits:
 
 		self.dbCon = DatabaseCon(db, dbUser, dbHost, dbPort)
 
-	def fetchEditsFromTable(self, table):
+	def fetchEditsFromTable(self, table, fetchSize=DEFAULT_FETCH_SIZE):
+
+		self.edits.extend(self.streamEditsFromTable(table, fetchSize))
+
+	# yields the edits one at a time, from a server-side cursor that holds `fetchSize` rows at a time
+	# (see `DatabaseCon.stream()`), so that the edit history of a project is never loaded all at once
+	def streamEditsFromTable(self, table, fetchSize=DEFAULT_FETCH_SIZE):
 
 		sql_command = "SELECT project, file_name, sha, commit_date, isbug "
 		sql_command +=  " FROM " + table + " WHERE tag = \'" + self.language + \
@@ -44,12 +50,9 @@ class DbEdits:
 
 		print sql_command
 		
-		rows = self.dbCon.execute(sql_command)
-
-		for row in rows:
+		for row in self.dbCon.stream(sql_command, fetchSize):
 			project, file_name, sha, commit_date, isbug = row
-			e = edit(project, file_name, sha, commit_date, isbug)
-			self.edits.append(e)
+			yield edit(project, file_name, sha, commit_date, isbug)
 
 
 	def printEdits(self):
@@ -9,6 +9,7 @@ from git import *
 
 sys.path.append("src/util")
 from Util import cd
+from GitCatFile import getGitCatFile
 import Util
 
 class GitRepo:
@@ -21,6 +22,7 @@ class GitRepo:
 
 
     self.git = repo.git
+    self.cat_file = getGitCatFile(repoPath)
 
   def fetchFiles(self, fileName, sha):
 
@@ -35,6 +37,55 @@ class GitRepo:
             % (sha) )
       return []
 
+  # batched `fetchFiles()`: resolves every (fileName, sha) pair to the blobs of its new and old version through
+  # one `git cat-file --batch-check` pipe, instead of running `git rev-list` per pair.
+  # returns, per pair, None if `sha` does not exist, else [new blob, old blob]; the new blob is None if the file
+  # is missing from `sha`, and the old one is left out if the file is missing from its first parent (ex. added in `sha`)
+  def fetchFileBlobs(self, fileShaPairs):
+
+    names = []
+    for file_name, sha in fileShaPairs:
+      names += [sha + '^{commit}', sha + ':' + file_name, sha + '^:' + file_name]
+    headers = self.cat_file.checkObjects(names)
+
+    blobs = []
+    for i, (file_name, sha) in enumerate(fileShaPairs):
+      commit, new, old = headers[3*i:3*i + 3]
+      if commit is None:
+        print('Most likely, %s commit does not exist... Skipping related files.' % (sha))
+        logging.debug('Most likely, %s commit does not exist... Skipping related files.' % (sha))
+        blobs.append(None)
+        continue
+      file_blobs = [new[0] if new is not None and new[1] == 'blob' else None]
+      if old is not None and old[1] == 'blob':
+        file_blobs.append(old[0])
+      blobs.append(file_blobs)
+    return blobs
+
+  # writes each blob of `blobDestinations` ((blob sha, destination) pairs) to its destinations, reading each distinct
+  # blob once from the shared `git cat-file --batch` pipe; a missing blob (None) gives an empty file, like `dumpFile()`.
+  # with a `blobStore` (a `BlobStore.BlobStore`), the destinations are hard links to the blobs in the store instead.
+  # safe to call from several threads, as long as they write to different destinations
+  def dumpBlobs(self, blobDestinations, blobStore=None):
+
+    destinations_per_blob = {}
+    for blob_sha, destination in blobDestinations:
+      destinations_per_blob.setdefault(blob_sha, []).append(destination)
+
+    for blob_sha in sorted(destinations_per_blob, key=lambda blob_sha: blob_sha or ''):
+      destinations = destinations_per_blob[blob_sha]
+      if blob_sha is not None and blobStore is not None:
+        destinations = [destination for destination in destinations if not blobStore.link(blob_sha, destination)]
+        if not destinations:
+          continue
+      content = self.cat_file.blob(blob_sha) if blob_sha is not None else None
+      for destination in destinations:
+        if content is None:
+          print destination, 'does not exist.'
+        with open(destination, 'wb') as out_file:
+          if content is not None:
+            out_file.write(content)
+
   def checkFile(self, fileName, sha):
     
     try:
@@ -46,25 +97,29 @@ class GitRepo:
 
   def showFile(self, fileName, sha):
     
-    try:
-      file_content = self.git.show(sha + ":" + fileName)
-      #file_content = str = unicode(self.git.show(sha + ":" + fileName), errors='ignore') 
-      return file_content
-    except Exception, e:
-      print e
+    file_content = self.cat_file.blob(sha + ":" + fileName)
+    if file_content is None:
       print('file= %s, sha= %s does not exist.' % (fileName, sha))
       logging.debug('file= %s, sha= %s does not exist.' % (fileName, sha))
+      return None
+    # Same as `git show`, which drops the trailing newline
+    if file_content.endswith('\n'):
+      file_content = file_content[:-1]
+    return file_content
   
-  #calls git show from command line
-  # this removes unicode error
-  def dumpFile(self, fileName, sha, destination):
+  # reads the blob through the shared `git cat-file --batch` pipe
+  # the bytes are written as they are, so there is no unicode error
+  # with a `blobStore` (a `BlobStore.BlobStore`), the destination is a hard link to the blob in the store
+  def dumpFile(self, fileName, sha, destination, blobStore=None):
     
-    with cd(self.repo_path):   
-      try:
-	command = 'git show ' + sha + ":" + fileName + " > " + destination
-	os.system(command)
-      except Exception, e:
-	print fileName, sha, destination, e
+    # relative destinations used to be resolved inside the repo, where `git show` was run
+    destination = os.path.join(self.repo_path, destination)
+    if blobStore is not None:
+      header = self.cat_file.checkObject(sha + ":" + fileName)
+      if header is not None and header[1] == 'blob' and blobStore.link(header[0], destination):
+        return
+    if not self.cat_file.dumpBlob(sha + ":" + fileName, destination):
+      print fileName, sha, destination, 'does not exist.'
 
 def test():
   print "Testing GitStuff"
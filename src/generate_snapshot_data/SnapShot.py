@@ -8,6 +8,7 @@ import logging
 import datetime
 import ntpath
 import codecs
+import pickle
 
 from GitRepo import GitRepo
 from OutDir import OutDir
@@ -16,6 +17,9 @@ sys.path.append("src/util")
 import Log
 from Util import cd
 import Util
+from SourceTree import listSourceFiles, flatPath
+from SzzCore import projectRepoPath
+from BlobStore import getBlobStore
 
 # Given a path, returns the basename of the file/directory in an _extremely_ robust way
 def path_leaf(path):
@@ -24,14 +28,27 @@ def path_leaf(path):
 
 class SnapShot:
 
-    def __init__(self, projPath, snapshot, outDir, debug=False):
+    def __init__(self, projPath, snapshot, outDir, debug=False, blobStore=False):
 
         self.src_path = projPath + os.sep + snapshot
         self.out_path = outDir + os.sep + snapshot
         self.debug    = debug
-        self.git_repo = GitRepo(self.src_path)
         self.date     = datetime.datetime.strptime(snapshot, '%Y-%m-%d').date()
 
+        # Snapshots dumped in the 'stream' mode of dump.py are not git repos; their files come straight from the
+        # project clone in data/projects/, at the SHA recorded in ss_sha_info.txt
+        self.sha = None
+        if os.path.exists(self.src_path + os.sep + '.git'):
+            self.git_repo = GitRepo(self.src_path)
+        else:
+            with open(projPath + os.sep + 'ss_sha_info.txt', 'rb') as ss_sha_info_file:
+                self.sha = pickle.load(ss_sha_info_file)[snapshot]
+            self.git_repo = GitRepo(projectRepoPath(self.src_path + os.sep))
+
+        # With the blob store of the project (see `BlobStore`), the files dumped from git are hard links to unique
+        # blobs, and each output dir gets a manifest of the blobs behind its files
+        self.blob_store = getBlobStore(projectRepoPath(self.src_path + os.sep)) if blobStore else None
+
         self.out_dir = None
         self.edits = []
         self.test_files = set()
@@ -108,25 +125,26 @@ class SnapShot:
         print('Dumping files in test dir for ' + path_leaf(self.src_path))
         test_dirs = self.out_dir.get_test_dirs()
 
-        for e in self.edits:
-            files = self.git_repo.fetchFiles(e.file_name, e.sha)
-            for i, sha in enumerate(files):
+        edits = [e for e in self.edits if os.path.splitext(e.file_name)[1].lower() in ['.c', '.cpp', '.cc', '.java']]
 
-              #copy_content = self.git_repo.showFile(e.file_name, sha)
+        # The blobs of the new and old version of every edited file are resolved in one batch, and then written
+        # straight from the shared `git cat-file` pipe of the repo to test/new and test/old
+        blob_destinations = []
+        for e, blobs in zip(edits, self.git_repo.fetchFileBlobs([(e.file_name, e.sha) for e in edits])):
+            if blobs is None:
+                continue
 
-              file_name = e.file_name.replace(os.sep, Util.SEP)
-              file_name, extn = os.path.splitext(file_name)
+            file_name = e.file_name.replace(os.sep, Util.SEP)
+            file_name, extn = os.path.splitext(file_name)
+            file_name = file_name + Util.SEP + e.sha + extn
 
-              if extn.lower() not in ['.c', '.cpp', '.cc', '.java']:
-                continue
+            for i, blob_sha in enumerate(blobs):
+                blob_destinations.append((blob_sha, os.path.abspath(test_dirs[i] + os.sep + file_name)))
+
+        self.git_repo.dumpBlobs(blob_destinations, self.blob_store)
 
-              file_name = file_name + Util.SEP + e.sha + extn
-              dest_file = test_dirs[i] + os.sep + file_name
-              #print file_name, dest_file
-	      self.git_repo.dumpFile(e.file_name, sha, dest_file)
-              #copy_content = self.git_repo.showFile(e.file_name, sha)
-	      #with codecs.open(dest_file, "w", encoding="utf-8") as f:
-	      #   f.write(copy_content)
+        if self.blob_store is not None:
+            self.blob_store.writeManifests()
 
 
 
@@ -144,6 +162,31 @@ class SnapShot:
         self.getTestFiles()
         # self.git_repo.git.stash('-u')
 
+        # Without a checkout, the snapshot holds the source files of its SHA in the flattened layout already (see the
+        # 'stream' mode of dump.py); the listing of that SHA tells which file each of them is
+        if self.sha is not None:
+            for file_name, blob_sha in listSourceFiles(self.git_repo.repo_path, self.sha):
+                src_file = self.src_path + os.sep + flatPath(file_name)
+                if file_name in self.test_files:
+                    dest_file = self.out_dir.changed_dir + os.sep + flatPath(file_name)
+                else:
+                    self.train_files.add(file_name)
+                    dest_file = self.out_dir.learn_dir + os.sep + flatPath(file_name)
+                if self.blob_store is not None:
+                    self.blob_store.link(blob_sha, dest_file)
+                elif os.path.isfile(src_file):
+                    shutil.copyfile(src_file, dest_file)
+                else:
+                    self.git_repo.cat_file.dumpBlob(blob_sha, dest_file)
+            if self.blob_store is not None:
+                self.blob_store.writeManifests()
+            return
+
+        # With a blob store, the files of the checkout are linked from the store by the blobs they have at HEAD
+        blob_shas = {}
+        if self.blob_store is not None:
+            blob_shas = dict(listSourceFiles(self.src_path, 'HEAD'))
+
         #all files under snapshot except test files
         for root, dirs, files in os.walk(self.src_path):
             for f in files:
@@ -164,10 +207,18 @@ class SnapShot:
 
                 if file_name in self.test_files:
                     dest_file = self.out_dir.changed_dir + os.sep + file_name.replace(os.sep, Util.SEP)
-                    shutil.copyfile(src_file, dest_file)
+                    self.copyFile(src_file, dest_file, blob_shas.get(file_name))
                     continue
 
                 self.train_files.add(file_name)
 
                 dest_file = self.out_dir.learn_dir + os.sep + file_name.replace(os.sep, Util.SEP)
-                shutil.copyfile(src_file, dest_file)
+                self.copyFile(src_file, dest_file, blob_shas.get(file_name))
+
+        if self.blob_store is not None:
+            self.blob_store.writeManifests()
+
+    def copyFile(self, src_file, dest_file, blob_sha=None):
+        """Links `dest_file` from the blob store if there is one and `blob_sha` is known; copies `src_file` otherwise."""
+        if self.blob_store is None or blob_sha is None or not self.blob_store.link(blob_sha, dest_file):
+            shutil.copyfile(src_file, dest_file)
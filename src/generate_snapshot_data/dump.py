@@ -5,7 +5,12 @@ import os, sys, inspect
 import os.path
 import shutil
 import logging
+import subprocess
+import threading
+import bisect
+import time
 from git import *
+from multiprocessing.dummy import Pool
 
 
 from projDB import DbProj
@@ -16,6 +21,8 @@ sys.path.append("src/util")
 sys.path.append("src/changes")
 from Config import Config
 from OutDir import OutDir
+from SourceTree import dumpSourceFiles
+from BlobStore import getBlobStore
 
 import Log
 from Util import cd
@@ -52,7 +59,133 @@ def getProjName(projectPath):
     return project_name
 
 #--------------------------------------------------------------------------------------------------------------------------
-def dumpSnapShots(srcPath, destPath, ss_interval_len, commitDateMin, commitDateMax):
+# Ways of creating a snapshot; see `createSnapShot()`
+SS_MODES = ('copy', 'worktree', 'shared', 'stream')
+
+#--------------------------------------------------------------------------------------------------------------------------
+def snapShotDates(ss_interval_len, commitDateMin, commitDateMax):
+    """Returns the dates of the snapshots: one every `ss_interval_len` months (of 30 days) from the day after `commitDateMin`, and `commitDateMax`."""
+    dates = []
+    start_date = commitDateMin + timedelta(days=1)
+    while start_date <= commitDateMax:
+        dates.append(start_date)
+        start_date = start_date + timedelta(days=ss_interval_len*30)
+    dates.append(commitDateMax)
+    return dates
+
+#--------------------------------------------------------------------------------------------------------------------------
+def snapShotHistory(srcPath, branch):
+    """
+    Returns the (commit timestamp, SHA) of every non-merge commit on the first-parent history of `branch` of the repo at `srcPath`, oldest first, from a single `git rev-list` walk.
+
+    Commits with the same timestamp keep the order of the history, older first.
+    """
+    walk = subprocess.check_output(['git', 'rev-list', '--first-parent', '--no-merges', '--timestamp', '--reverse', str(branch)], cwd=srcPath)
+    history = [(int(timestamp), sha) for timestamp, sha in (line.split() for line in walk.splitlines())]
+    # Commit dates are not monotonic along the history (ex. rebased or cherry-picked commits); the sort is stable
+    history.sort(key=lambda commit: commit[0])
+    return history
+
+#--------------------------------------------------------------------------------------------------------------------------
+def snapShotShas(srcPath, branch, dates):
+    """
+    Returns the SHA of the last non-merge commit on the first-parent history of `branch` of the repo at `srcPath` before each of `dates` (or '' if there is none): the commit with the latest date that is not after the date, like `git rev-list -n 1 --first-parent --no-merges --before=<date> <branch>` would give if the commit dates were in order.
+
+    The history is walked once (see `snapShotHistory()`), and each date is looked up with a binary search; `git rev-parse`
+    turns the dates into the same timestamps that `--before` would use.
+    """
+    boundaries = [int(line.split('=')[1]) for line in
+                  subprocess.check_output(['git', 'rev-parse'] + ['--before=' + str(date) for date in dates], cwd=srcPath).split()]
+    history = snapShotHistory(srcPath, branch)
+    timestamps = [timestamp for timestamp, _ in history]
+    shas = []
+    for boundary in boundaries:
+        index = bisect.bisect_right(timestamps, boundary)
+        shas.append(history[index - 1][1] if index > 0 else '')
+    return shas
+
+#--------------------------------------------------------------------------------------------------------------------------
+def existingSnapShotSha(snapshot, recordedSha=None):
+    """
+    Returns the SHA that the existing snapshot directory `snapshot` was created at: the HEAD of its checkout, or, for a snapshot that is not a git repo (see the 'stream' mode), `recordedSha` (its entry in the ss_sha_info.txt of an earlier dump). Returns None if neither is known.
+    """
+    if os.path.exists(os.path.join(snapshot, '.git')):
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=snapshot).strip()
+        except subprocess.CalledProcessError:
+            return None
+    return recordedSha
+
+#--------------------------------------------------------------------------------------------------------------------------
+def createSnapShot(srcPath, snapshot, sha, ssMode='copy', blobStore=None):
+    """
+    Creates the snapshot directory `snapshot` with the files of the repo at `srcPath` as of `sha`.
+
+    `ssMode` is one of `SS_MODES`:
+    'copy' copies the whole repo, .git included, and checks out `sha` in the copy.
+    'worktree' adds a detached `git worktree` of the repo at `sha`; the snapshot shares the repo's objects and is registered in its .git/worktrees/.
+    'shared' makes a `git clone --shared` of the repo (which borrows the repo's objects through .git/objects/info/alternates) and checks out `sha`.
+    'stream' checks nothing out: it writes only the source files of `sha` (see `SourceTree.SOURCE_EXTENSIONS`), straight from the repo's objects, into the flattened layout (s1__s2__file.c) of the snapshot. Such a snapshot is not a git repo; later stages read its SHA from `ss_sha_info.txt` and its history from the repo at `srcPath`.
+    None of them changes the directory of the process, so several snapshots can be created at once (see `dumpSnapShots()`).
+    With a `blobStore` (see `BlobStore.getBlobStore()`), the files of a 'stream' snapshot are hard links to the blobs of the store, so that the files shared by several snapshots are stored once; the snapshot's `BlobStore.BLOB_MANIFEST` records which blob backs each file.
+    """
+    if ssMode == 'copy':
+        Util.copy_dir(srcPath,snapshot)
+        subprocess.call(['git', 'reset', '--hard'], cwd=snapshot)
+        #os.system("git checkout")
+        subprocess.call(['git', 'checkout', sha], cwd=snapshot)
+    elif ssMode == 'worktree':
+        subprocess.check_call(['git', 'worktree', 'add', '--detach', os.path.abspath(snapshot), sha], cwd=srcPath)
+    elif ssMode == 'shared':
+        subprocess.check_call(['git', 'clone', '--quiet', '--shared', '--no-checkout', os.path.abspath(srcPath), snapshot])
+        subprocess.check_call(['git', 'checkout', '--quiet', '--detach', sha], cwd=snapshot)
+    elif ssMode == 'stream':
+        dumpSourceFiles(srcPath, sha, snapshot, blobStore=blobStore)
+    else:
+        raise ValueError("`ssMode` should be one of " + str(SS_MODES) + ". Given: " + str(ssMode))
+
+#--------------------------------------------------------------------------------------------------------------------------
+def snapShotCost(srcPath, sha, ssMode):
+    """Returns an estimate of the bytes that creating the snapshot of `sha` writes: the size of its tree, plus that of the repo's .git for the 'copy' mode."""
+    cost = sum(int(line.split()[3]) for line in
+               subprocess.check_output(['git', 'ls-tree', '-r', '-l', sha], cwd=srcPath).splitlines()
+               if line.split()[1] == 'blob')
+    if ssMode == 'copy':
+        for root, dirs, files in os.walk(os.path.join(srcPath, '.git')):
+            cost += sum(os.path.getsize(os.path.join(root, f)) for f in files if os.path.isfile(os.path.join(root, f)))
+    return cost
+
+#--------------------------------------------------------------------------------------------------------------------------
+class IoBudget:
+    """
+    Lets concurrent snapshot builders write at most `budget` bytes (see `snapShotCost()`) at a time. A snapshot that
+    costs more than the whole budget waits until nothing else is being written, and is then created on its own.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, cost):
+        with self.condition:
+            while self.in_use > 0 and self.in_use + cost > self.budget:
+                self.condition.wait()
+            self.in_use += cost
+
+    def release(self, cost):
+        with self.condition:
+            self.in_use -= cost
+            self.condition.notify_all()
+
+#--------------------------------------------------------------------------------------------------------------------------
+def dumpSnapShots(srcPath, destPath, ss_interval_len, commitDateMin, commitDateMax, ssMode='copy', blobStore=False, numWorkers=1, ioBudget=None):
+    """
+    Creates the missing snapshots of the repo at `srcPath` in `destPath`/<project>/<date>/ (see `createSnapShot()`), and returns a dictionary that maps the name of each snapshot on disk to the SHA its files come from.
+
+    The SHAs of all the snapshots are resolved up front (see `snapShotShas()`); then `numWorkers` snapshots are created
+    at a time, writing at most `ioBudget` bytes at once (see `IoBudget`), or without a limit if it is None.
+    """
 
     print srcPath, destPath, commitDateMin, commitDateMax
 
@@ -62,36 +195,88 @@ def dumpSnapShots(srcPath, destPath, ss_interval_len, commitDateMin, commitDateM
     print branch
 
     project_name = getProjName(srcPath)
+    blob_store = getBlobStore(srcPath) if blobStore else None
 
-    start_date = commitDateMin + timedelta(days=1)
-
-    while start_date <= commitDateMax:
-        #snapshot = destPath + os.sep + project_name + os.sep + project_name + "_" + str(start_date)
-        snapshot = destPath + os.sep + project_name + os.sep + str(start_date)
-        print snapshot
-
-        if not os.path.isdir(snapshot):
-            Util.copy_dir(srcPath,snapshot)
-            git_command = "git checkout `git rev-list -n 1 --no-merges --before=\"" + str(start_date) + "\" " +  str(branch) + "`"
-            with cd(snapshot):
-                os.system("git reset --hard")
-                #os.system("git checkout")
-                os.system(git_command)
-
-        start_date = start_date + timedelta(days=ss_interval_len*30)
+    # Forget the worktrees of snapshots that were deleted since the last dump
+    if ssMode == 'worktree':
+        subprocess.check_call(['git', 'worktree', 'prune'], cwd=srcPath)
 
-    #snapshot = destPath + os.sep + project_name + os.sep + project_name + "_" + str(commitDateMax)
-    start_date = commitDateMax
-    snapshot = destPath + os.sep + project_name + os.sep + str(start_date)
+    # Snapshots that are already on disk keep the SHA they were created at (see `existingSnapShotSha()`), which an
+    # earlier dump may have resolved differently; ss_sha_info.txt must describe the trees that are actually there
+    project_ss_path = destPath + os.sep + project_name
+    recorded_ss_shas = {}
+    if os.path.isfile(project_ss_path + os.sep + 'ss_sha_info.txt'):
+        with open(project_ss_path + os.sep + 'ss_sha_info.txt', 'rb') as ss_sha_info_file:
+            recorded_ss_shas = pickle.load(ss_sha_info_file)
 
-    print snapshot
-    if not os.path.isdir(snapshot):
-        Util.copy_dir(srcPath,snapshot)
-        git_command = "git checkout `git rev-list -n 1 --no-merges --before=\"" + str(start_date) + "\" " +  str(branch) + "`"
-        with cd(snapshot):
-            os.system("git reset --hard")
-            #os.system("git checkout")
-            os.system(git_command)
+    ss_dates = snapShotDates(ss_interval_len, commitDateMin, commitDateMax)
+    ss_name_to_sha = {}
+    to_create = []
+    for start_date, ss_sha in zip(ss_dates, snapShotShas(srcPath, branch, ss_dates)):
+        #snapshot = destPath + os.sep + project_name + os.sep + project_name + "_" + str(start_date)
+        snapshot = project_ss_path + os.sep + str(start_date)
+
+        if not ss_sha:
+            print "!! No commit before %s; skipping this snapshot" % (start_date)
+            continue
+
+        if os.path.isdir(snapshot):
+            existing_sha = existingSnapShotSha(snapshot, recorded_ss_shas.get(str(start_date)))
+            if existing_sha is not None:
+                if existing_sha != ss_sha:
+                    print "!! %s was created at %s, not at %s; keeping it as it is" % (snapshot, existing_sha, ss_sha)
+                ss_name_to_sha[str(start_date)] = existing_sha
+                continue
+            # Nothing tells which SHA the files of this snapshot come from, so it is made again
+            print "!! The SHA of %s is unknown; creating it again" % (snapshot)
+            shutil.rmtree(snapshot)
+
+        ss_name_to_sha[str(start_date)] = ss_sha
+        if snapshot not in [ss for ss, _ in to_create]:
+            to_create.append((snapshot, ss_sha))
+
+    # Snapshots on disk from other dates (ex. of a dump with another interval) stay in ss_sha_info.txt too
+    if os.path.isdir(project_ss_path):
+        for ss_name in sorted(os.listdir(project_ss_path)):
+            if ss_name in ss_name_to_sha or not os.path.isdir(project_ss_path + os.sep + ss_name):
+                continue
+            existing_sha = existingSnapShotSha(project_ss_path + os.sep + ss_name, recorded_ss_shas.get(ss_name))
+            if existing_sha is None:
+                print "!! The SHA of %s is unknown; leaving it out of ss_sha_info.txt" % (project_ss_path + os.sep + ss_name)
+                continue
+            ss_name_to_sha[ss_name] = existing_sha
+
+    io_budget = IoBudget(ioBudget) if ioBudget is not None else None
+
+    def create_snapshot(snapshot_and_sha):
+        snapshot, ss_sha = snapshot_and_sha
+        cost = snapShotCost(srcPath, ss_sha, ssMode) if io_budget is not None else 0
+        if io_budget is not None:
+            io_budget.acquire(cost)
+        try:
+            start_time = time.time()
+            createSnapShot(srcPath, snapshot, ss_sha, ssMode, blob_store)
+            elapsed = time.time() - start_time
+        finally:
+            if io_budget is not None:
+                io_budget.release(cost)
+        print "%s (%s): %.1fs" % (snapshot, ss_sha, elapsed)
+        logging.info("Created snapshot %s (%s) in %.1fs", snapshot, ss_sha, elapsed)
+        return elapsed
+
+    start_time = time.time()
+    if numWorkers > 1 and len(to_create) > 1:
+        pool = Pool(numWorkers)
+        try:
+            pool.map(create_snapshot, to_create)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(create_snapshot, to_create)
+    print "Created %d snapshots in %.1fs" % (len(to_create), time.time() - start_time)
+
+    return ss_name_to_sha
 
 
 
@@ -144,6 +329,14 @@ if __name__ == "__main__":
     parser.add_argument('-d',dest="out_dir", default='out_dir', help="directories to dump the snapshots")
     parser.add_argument('-l',dest="lang", default='java', help="languages to be processed")
     parser.add_argument('-m',dest="ss_interval_len", default='6', help="duration of interval (in months) between two snapshots")
+    parser.add_argument('-s',dest="ss_mode", default='copy', choices=SS_MODES, \
+                            help="how to create each snapshot: copy = copy the whole repo, worktree = `git worktree add`, " \
+                            "shared = `git clone --shared`, stream = write only the source files, flattened, without checking anything out.")
+    parser.add_argument('-w',dest="num_workers", type=int, default=1, help="number of snapshots to create at a time")
+    parser.add_argument('--io-budget',dest="io_budget", type=int, default=None, \
+                            help="at most this many MB (estimated from the size of the snapshots) are written at a time; no limit by default")
+    parser.add_argument('--blob-store', dest="blob_store", action='store_true', \
+                            help="with -s stream, hard-link the files of the snapshots to a store of unique blobs in data/blobs/<project>/ instead of writing a copy per snapshot")
 
     #logging and config specific arguments
     parser.add_argument("-v", "--verbose", default = 'w', nargs="?", \
@@ -176,19 +369,13 @@ if __name__ == "__main__":
     commit_dates = fetchCommitDates(cfg, args.proj_dir, args.lang)
 
     #2. Snapshot
-    dumpSnapShots(args.proj_dir, args.out_dir, int(args.ss_interval_len), commit_dates[0], commit_dates[1])
+    ss_name_to_sha = dumpSnapShots(args.proj_dir, args.out_dir, int(args.ss_interval_len), commit_dates[0], commit_dates[1], args.ss_mode, args.blob_store, \
+                                   args.num_workers, args.io_budget * 1024 * 1024 if args.io_budget is not None else None)
 
+    # The SHAs the snapshots on disk were created at (see `dumpSnapShots()`); snapshots that are not git repos (see the
+    # 'stream' mode) only have this
     project_name = pathLeaf(args.proj_dir)
     ss_dir = os.path.abspath(args.out_dir)
-    ss_names = os.listdir(ss_dir + '/' + project_name)
-    ss_names.sort()
-    ss_paths = [ss_dir + '/' + project_name + '/' + ss_name + '/' for ss_name in ss_names]
-
-    ss_name_to_sha = {}
-    for ss_index, ss_path in enumerate(ss_paths):
-        repo = Repo(ss_path)
-        ss_sha = repo.git.log('--format=%H', '-n', '1')
-        ss_name_to_sha[ss_names[ss_index]] = ss_sha
 
     with open(ss_dir + '/' + project_name + '/ss_sha_info.txt', 'wb') as out_file:
         pickle.dump(ss_name_to_sha, out_file)
@@ -56,14 +56,14 @@ class DbProj:
             snapshot1 = "'" + snapshot1 + "'"
             snapshot2 = "'" + snapshot2 + "'"
 
-            sql_command = "SELECT distinct file_name, sha"
+            # The server counts the distinct (file_name, sha) pairs; only the count comes back
+            sql_command = "SELECT count(*) FROM (SELECT distinct file_name, sha"
             sql_command +=  " FROM " + table + " Where tag like \'" + self.language + "\'"
             sql_command +=  " and project = \'" + self.project + "\' and commit_date >= " \
-                               + snapshot1 + " and commit_date < " + snapshot2
+                               + snapshot1 + " and commit_date < " + snapshot2 + ") AS file_shas"
 
             #print sql_command
-            rows = self.dbCon.execute(sql_command)
-            return len(rows)
+            return self.dbCon.fetchOne(sql_command)[0]
 
 
 	def printCommitDates(self):
@@ -25,6 +25,8 @@ if __name__ == "__main__":
     parser.add_argument('-p',dest="proj_dir", help="the directories containing src code")
     parser.add_argument('-l',dest="lang", default='java', help="languages to be processed")
     parser.add_argument('-d',dest="out_dir", default='out_dir', help="directories to dump the processed files")
+    parser.add_argument('--blob-store', dest="blob_store", action='store_true', \
+                            help="hard-link the files dumped from git to a store of unique blobs in data/blobs/<project>/, and record them in a manifest per directory")
 
 
     #logging and config specific arguments
@@ -56,7 +58,7 @@ if __name__ == "__main__":
 
     cfg = Config(args.config_file)
 
-    corpus = Corpus(args.proj_dir, args.lang, args.out_dir, cfg)
+    corpus = Corpus(args.proj_dir, args.lang, args.out_dir, cfg, blobStore=args.blob_store)
     logging.debug(corpus)
     corpus.dump()
 
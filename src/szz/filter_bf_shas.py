@@ -1,6 +1,8 @@
 #--------------------------------------------------------------------------------------------------------------------------
 import os, sys, pandas
-from git import Repo
+
+sys.path.append("src/util")
+from CommitIndex import getCommitIndex
 
 #--------------------------------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -16,23 +18,16 @@ if __name__ == '__main__':
     lines_deleted_data_filename = data_dir + 'lines_deleted_in_bf_shas/' + project_name + '.buggylines'
     csvdata = pandas.read_csv(lines_deleted_data_filename, index_col=False)
 
-    bf_bi_shas = csvdata[['bf_sha', 'bi_sha']] # extract these 2 columns
-    bf_bi_shas_tuples = [(tuple[1], tuple[2]) for tuple in bf_bi_shas.itertuples()] # DataFame to list of couples
-    bf_bi_shas_tuples_unique = pandas.unique(bf_bi_shas_tuples)
-
-    bf_shas_relevant = []
-    project_repo = Repo(data_dir + 'projects/' + project_name)
-    for bf_sha, bi_sha in bf_bi_shas_tuples_unique:
-        bf_sha_date = str(project_repo.git.log('-n', '1', '--format="%ad"', '--date=short', bf_sha))
-        bf_sha_date = bf_sha_date.replace('"', '')
-
-        bi_sha_date = str(project_repo.git.log('-n', '1', '--format="%ad"', '--date=short', bi_sha))
-        bi_sha_date = bi_sha_date.replace('"', '')
+    # Unique (bf_sha, bi_sha) pairs, in the order they first appear
+    bf_bi_shas = csvdata[['bf_sha', 'bi_sha']].drop_duplicates()
 
-        if bi_sha_date < max_date and bf_sha_date > min_date:
-            bf_shas_relevant.append(bf_sha)
+    # Join the pairs against the author dates (YYYY-MM-DD) in the project's commit index, and filter them all at once
+    commit_index = getCommitIndex(data_dir + 'projects/' + project_name)
+    bf_sha_dates = commit_index.authorDates(bf_bi_shas.bf_sha.values)
+    bi_sha_dates = commit_index.authorDates(bf_bi_shas.bi_sha.values)
+    is_relevant = (bi_sha_dates < max_date) & (bf_sha_dates > min_date)
 
-    bf_shas_relevant = pandas.unique(bf_shas_relevant)
+    bf_shas_relevant = pandas.unique(bf_bi_shas.bf_sha.values[is_relevant])
     bf_shas_outfile_name = data_dir + 'bf_shas/' + project_name + '.' + min_date + '.' + max_date
     with open(bf_shas_outfile_name, 'wb') as outfile:
         outfile.write('\n'.join(bf_shas_relevant))
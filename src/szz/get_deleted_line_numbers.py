@@ -1,6 +1,8 @@
 #--------------------------------------------------------------------------------------------------------------------------
-import os, sys, shlex, subprocess, csv, ntpath
+import os, sys, shlex, subprocess, csv, ntpath, shutil
 from collections import defaultdict
+from subprocess import Popen, PIPE
+from multiprocessing import Pool
 
 try:
     from git import Repo
@@ -8,23 +10,121 @@ except ImportError as e:
     print('Required library `gitpython` not found in system. Please install using `sudo pip install gitpython`.')
     raise
 
+sys.path.append("src/util")
+from GitCatFile import getGitCatFile
+from DiffParser import COMMIT_FORMAT, DIFF_OPTIONS, iterFileDiffs, deletedLineNums
+
 #--------------------------------------------------------------------------------------------------------------------------
 def pathLeaf(path):
     """Returns the basename of the file/directory path in an _extremely_ robust way. For example, pathLeaf('/hame/saheel/git_repos/szz/abc.c/') will return 'abc.c'."""
     head, tail = ntpath.split(path)
     return tail or ntpath.basename(head)
 
+#--------------------------------------------------------------------------------------------------------------------------
+def get_deleted_lines(project_repo_path, bf_shas):
+    """
+    Yields (bf_sha, bf_file_name, deleted line numbers) for each file from which some lines were deleted in one of `bf_shas`.
+
+    All `bf_shas` are diffed against their first parent by a single `git log -p -U0 -w` process, whose output is parsed as it streams in (see `DiffParser.iterFileDiffs()`). `bf_file_name` is the name of the file in `bf_sha^`, and the line numbers (strings) are those of the deleted lines in `bf_sha^`; i.e., what `git diff -U0 -w bf_sha bf_sha^ | showlinenum.awk` used to report with a `+` sign.
+
+    Every SHA in `bf_shas` has to be a valid commit; git gives up on the whole list otherwise.
+    """
+    process = Popen(['git', 'log', '--no-walk=unsorted', '--stdin', '-p', '-U0', '-w', '-M', '-m', '--first-parent', \
+                     '--format=' + COMMIT_FORMAT] + DIFF_OPTIONS, \
+                    cwd=project_repo_path, stdin=PIPE, stdout=PIPE, close_fds=True)
+    # git reads all of stdin before it starts writing its output
+    process.stdin.write(''.join(bf_sha + '\n' for bf_sha in bf_shas))
+    process.stdin.close()
+
+    for bf_sha, bf_file_name, _, hunks in iterFileDiffs(process.stdout):
+        deleted_line_nums = deletedLineNums(hunks)
+        if bf_file_name is not None and deleted_line_nums:
+            yield (bf_sha, bf_file_name, [str(line_num) for line_num in deleted_line_nums])
+
+    process.stdout.close()
+    if process.wait() != 0:
+        raise ValueError("`git log` failed while diffing the bugfix commits in '" + project_repo_path + "'")
+
+#--------------------------------------------------------------------------------------------------------------------------
+def blame_deleted_lines(project_repo, project_name, bf_sha, bf_file_name, linums):
+    """Blames `linums` of `bf_file_name` in `bf_sha^` with a single `git blame`, and returns a list of (project, bf_sha, bf_file_name, bf_line_num, bi_sha, bi_file_name, bi_line_num) tuples, or None if blaming failed."""
+    blame_options = ['-L' + linum + ',+1' for linum in linums]
+    blame_options += [bf_sha + '^', '--', bf_file_name]
+
+    try:
+        blame_infos = project_repo.git.blame('-w', '-n', '-f', '-M', '-C', '--abbrev=40', \
+                                            stdout_as_string = False, *blame_options)
+    except Exception as e:
+        print(str(e))
+        print((bf_sha, bf_file_name))
+        return None
+
+    deleted_lines_info = []
+    for blame_info in blame_infos.splitlines():
+        try:
+            bf_line_num = blame_info.split(')')[0].split()[-1]
+            bi_line_num = blame_info.split('(')[0].split()[-1]
+            bi_sha = blame_info.split()[0][-40:]
+            bi_file_name = ' '.join(blame_info.split('(')[0].split()[1:-1])
+            deleted_lines_info.append((project_name, bf_sha, bf_file_name, bf_line_num, bi_sha, bi_file_name, bi_line_num))
+
+        except Exception as e:
+            print(str(e))
+            print((bf_sha, bf_file_name))
+            print('Skipping this `bf_file_name` in this `bf_sha`...')
+            break
+    return deleted_lines_info
+
+#--------------------------------------------------------------------------------------------------------------------------
+def process_shard(shard):
+    """
+    Finds and blames the lines deleted in one shard of the bugfix SHAs, and writes them to the shard's own CSV file (without a header).
+
+    `shard` is a (shard_index, project_repo_path, project_name, bf_shas, shard_filename) tuple. Runs in a worker process, which gets git readers of its own. Returns (shard_index, shard_filename, erroneous_bf_shas, failed_blames), where `erroneous_bf_shas` are the SHAs that are not valid commits, and `failed_blames` the (bf_sha, bf_file_name) pairs that could not be blamed.
+    """
+    shard_index, project_repo_path, project_name, bf_shas, shard_filename = shard
+    project_repo = Repo(project_repo_path)
+
+    # Problems occur when a given `bf_sha` is a "bad object" (which happens rarely); such SHAs are skipped up front,
+    # since a single bad SHA would make `git log` give up on all of them
+    reader = getGitCatFile(project_repo_path)
+    erroneous_bf_shas = []
+    valid_bf_shas = []
+    for bf_sha in bf_shas:
+        obj = reader.checkObject(bf_sha)
+        if obj is None or obj[1] != 'commit':
+            erroneous_bf_shas.append(bf_sha)
+        else:
+            valid_bf_shas.append(bf_sha)
+
+    failed_blames = []
+    with open(shard_filename, 'wb') as shard_file:
+        csv_writer = csv.writer(shard_file)
+        for bf_sha, bf_file_name, linums in get_deleted_lines(project_repo_path, valid_bf_shas):
+            deleted_lines_info = blame_deleted_lines(project_repo, project_name, bf_sha, bf_file_name, linums)
+            if deleted_lines_info is None:
+                failed_blames.append((bf_sha, bf_file_name))
+            else:
+                csv_writer.writerows(deleted_lines_info)
+
+    return (shard_index, shard_filename, erroneous_bf_shas, failed_blames)
+
 #--------------------------------------------------------------------------------------------------------------------------
 if __name__ == "__main__":
-    if len(sys.argv) != 5 or not os.path.isdir(sys.argv[1]) or not os.path.isfile(sys.argv[3]) or not os.path.isfile(sys.argv[4]):
-        print("\nUsage: python get_deleted_line_numbers.py <data_dir> <project_name> <path_to_showlinenum_script> <bf_shas_file>")
-        print("\nSample usage: python get_deleted_line_numbers.py data/ libuv bin/showlinenum.awk data/bf_shas/libuv.oneyear\n")
+    # The path to `showlinenum.awk` used to be the third argument; it is still accepted, but no longer needed
+    if len(sys.argv) > 3 and sys.argv[3].endswith('.awk'):
+        del sys.argv[3]
+
+    if len(sys.argv) not in [4, 5] or not os.path.isdir(sys.argv[1]) or not os.path.isfile(sys.argv[3]) \
+       or (len(sys.argv) == 5 and (not sys.argv[4].isdigit() or int(sys.argv[4]) < 1)):
+        print("\nUsage: python get_deleted_line_numbers.py <data_dir> <project_name> <bf_shas_file> [<num_of_cores>]")
+        print("\nSample usage: python get_deleted_line_numbers.py data/ libuv data/bf_shas/libuv.oneyear 8\n")
         raise ValueError('Please provide correct arguments, as described above.')
 
     data_dir = sys.argv[1] + "/"
     project_name = sys.argv[2]
-    path_to_showlinenum_script = os.path.abspath(sys.argv[3])
-    bf_sha_filepath = os.path.abspath(sys.argv[4])
+    bf_sha_filepath = os.path.abspath(sys.argv[3])
+    num_of_cores = int(sys.argv[4]) if len(sys.argv) == 5 else 1
 
     # Getting the list of bugfix-shas for this project
     bf_shas = []
@@ -42,95 +142,48 @@ if __name__ == "__main__":
     except Exception as e:
         raise ValueError("No Git repository found at '" + project_repo_path + "'!")
 
-    # `deleted_lines_info` will contain (bf_sha, bf_file_name, bf_line_num, bi_file_name, bi_line_num) tuples
-    # -- note that the `bf_file_name` and `bf_line_num` got Fixed in `bf_sha`
-    # -- and were Introduced in `bi_sha` at `bi_file_name` and `bi_line_num`
-    deleted_lines_info = []
-
-    erroneous_bf_shas = set()
-    for index, bf_sha in enumerate(bf_shas):
-        if (index % 100) == 0:
-            print('Currently on bf_sha #' + str(index + 1))
-
-        # Use the git-diff command to see what was deleted and added in bf_sha
-        diff_out = project_repo.git.diff("-U0", "-w", bf_sha, bf_sha + "^", stdout_as_string=False)
-
-        # Use the `showlinenum.awk` bash script to prepend line numbers to `diff_out`
-        p = subprocess.Popen(shlex.split(path_to_showlinenum_script + " show_header=0"), 
-                             stdout = subprocess.PIPE, 
-                             stdin = subprocess.PIPE, 
-                             stderr = subprocess.STDOUT)
-        p_stdout = p.communicate(input = diff_out)[0]
-
-        # Extract the info on deleted lines only 
-        # -- deleted lines appear with a `+` sign in `p_stdout` because of the way we ran `showlinenum` above
-        # -- see relevant section in `../../NOTES.txt` for details
-        p_stdout_lines = p_stdout.splitlines()
-
-        filename_to_lines_dict = defaultdict(list)
-        for line in p_stdout_lines:
-            # A typical diff `line` looks like this:
-            # src/unix/linux-core.c:472:+  if (model_idx == 0) {
-            line_splits = line.split(":")
-
-            # Get `bf_file_name` and `bf_line_num`
-            try:
-                if line_splits[2].startswith("+"):
-                    bf_file_name = line_splits[0]
-                    bf_line_num = line_splits[1]
-                    filename_to_lines_dict[bf_file_name].append(bf_line_num)
-
-            except Exception as e:
-                # Problems occus when given `bf_sha` is a "bad object" (which happens rarely)
-                # print('Error while processing ' + bf_sha)
-                # print(str(e))
-                erroneous_bf_shas.add(bf_sha)
-            
-        deleted_lines_info_curr_sha = []
-        for bf_file_name in filename_to_lines_dict:
-            linums = filename_to_lines_dict[bf_file_name]
-            blame_options = ['-L' + linum + ',+1' for linum in linums]
-            blame_options += [bf_sha + '^', '--', bf_file_name.replace(' ', '\ ')]
-
-            try:
-                blame_infos = project_repo.git.blame('-w', '-n', '-f', '-M', '-C', '--abbrev=40', \
-                                                    stdout_as_string = False, *blame_options)
-            except Exception as e:
-                print(str(e))
-                print((bf_sha, bf_file_name))
-                continue
-        
-            for blame_info in blame_infos.splitlines():
-                try:
-                    bf_line_num = blame_info.split(')')[0].split()[-1]
-                    bi_line_num = blame_info.split('(')[0].split()[-1]
-                    bi_sha = blame_info.split()[0][-40:]
-                    bi_file_name = ' '.join(blame_info.split('(')[0].split()[1:-1])
-                    curr_tuple = (project_name, bf_sha, bf_file_name, bf_line_num, bi_sha, bi_file_name, bi_line_num)
-                    deleted_lines_info_curr_sha.append(curr_tuple)
-
-                except Exception as e:
-                    print(str(e))
-                    print((bf_sha, bf_file_name))
-                    print('Skipping this `bf_file_name` in this `bf_sha`...')
-                    break
-
-        deleted_lines_info += deleted_lines_info_curr_sha
-        
     out_dir = data_dir + 'lines_deleted_in_bf_shas/'
     if not os.path.isdir(out_dir):
         os.mkdir(out_dir)
-
     out_file_name = out_dir + pathLeaf(bf_sha_filepath) + ".buggylines"
+
+    # Split the bugfix SHAs into contiguous shards, a few per core so that the cores stay busy till the end.
+    # Each shard streams its rows into a file of its own.
+    num_of_shards = min(len(bf_shas), num_of_cores * 4)
+    shard_size = (len(bf_shas) + num_of_shards - 1) // num_of_shards
+    shards = [(shard_index, project_repo_path, project_name, bf_shas[shard_index * shard_size:(shard_index + 1) * shard_size], \
+               out_file_name + '.shard' + str(shard_index)) for shard_index in range(num_of_shards)]
+    shards = [shard for shard in shards if shard[3]]
+
+    pool = Pool(num_of_cores)
+    shard_results = {}
+    for shard_index, shard_filename, erroneous_bf_shas, failed_blames in pool.imap_unordered(process_shard, shards, chunksize=1):
+        shard_results[shard_index] = (shard_filename, erroneous_bf_shas, failed_blames)
+        print('Done with shard ' + str(len(shard_results)) + ' of ' + str(len(shards)))
+    pool.close()
+    pool.join()
+
+    # Merge the shards in the order of the bugfix SHAs, so that the output does not depend on how they were scheduled
+    # Each row holds (project, bf_sha, bf_file_name, bf_line_num, bi_sha, bi_file_name, bi_line_num)
+    # -- note that the `bf_file_name` and `bf_line_num` got Fixed in `bf_sha`
+    # -- and were Introduced in `bi_sha` at `bi_file_name` and `bi_line_num`
     with open(out_file_name, 'wb') as out_file:
         csv_writer = csv.writer(out_file)
         csv_writer.writerow(('project', 'bf_sha', 'bf_file_name', 'bf_line_num', 'bi_sha', 'bi_file_name', 'bi_line_num'))
-        csv_writer.writerows(deleted_lines_info)
-        
-
-    if len(erroneous_bf_shas) > 0:
-        print("\nErrors encountered while processing the following " + str(len(erroneous_bf_shas)) + " bugfix commits. Skipped.")
-        print(erroneous_bf_shas)
+        for shard_index in sorted(shard_results.keys()):
+            shard_filename = shard_results[shard_index][0]
+            with open(shard_filename, 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, out_file)
+            os.remove(shard_filename)
+
+    for shard_index in sorted(shard_results.keys()):
+        shard_filename, erroneous_bf_shas, failed_blames = shard_results[shard_index]
+        if len(erroneous_bf_shas) > 0:
+            print("\nShard " + str(shard_index) + ": errors encountered while processing the following " + str(len(erroneous_bf_shas)) + " bugfix commits. Skipped.")
+            print(erroneous_bf_shas)
+        if len(failed_blames) > 0:
+            print("\nShard " + str(shard_index) + ": could not blame the following " + str(len(failed_blames)) + " (bf_sha, bf_file_name) pairs. Skipped.")
+            print(failed_blames)
 
     print("\nOutput written to '" + out_file_name + "'. Done.")
 #--------------------------------------------------------------------------------------------------------------------------
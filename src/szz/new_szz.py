@@ -1,60 +1,138 @@
 #--------------------------------------------------------------------------------------------------------------------------
 import os, sys, pandas, shlex, ntpath, pickle
 from git import Repo
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from multiprocessing import Pool
 from pprint import pprint
 
+sys.path.append("src/util")
+from CommitIndex import getCommitIndex
+from ReverseBlameCache import getReverseBlameCache
+from SzzCore import Blamer, AncestryPathTargets
+from TableWriter import openTableWriter, TABLE_FORMATS
+
+# Columns of the bugdata file, and those that are stored as integers in typed formats
+BUGDATA_COL_NAMES = ['project', 'ss_sha', 'ss_file_name', 'ss_line_num', 'bi_sha', 'bi_file_name', 'bi_line_num']
+BUGDATA_COL_TYPES = {'ss_line_num': 'int', 'bi_line_num': 'int'}
+
 #--------------------------------------------------------------------------------------------------------------------------
 def printUsage():
     """
     Usage : python src/szz/szz.py <path_to_data_dir>
                                  <project_name> 
                                  <path_to_bug_fixing_shas_file> 
+                                 [--output-format csv|parquet]
+                                 [--num-of-cores <num_of_cores>]
 
     Sample: python src/szz/new_szz.py data/ libuv data/bf_shas/libuv.2012-03-05.2015-12-12
+
+    The bugdata is written to data/corpus/<project_name>/ss_bugdata.csv, or to ss_bugdata.parquet (with dictionary-encoded SHAs and file names; needs pyarrow) if the output format is 'parquet'.
+    The (bi_sha, bi_file_name, sha) triples are reverse-blamed by `num_of_cores` processes (1 by default); with more than one, the rows of the triples come out in the order they are done.
     """
     print(printUsage.__doc__)
 
 #--------------------------------------------------------------------------------------------------------------------------
-def szz_reverse_blame(ss_path, sha_to_map_onto, buggy_linums, buggy_file_path, buggy_SHA):
-    """Reverse-blames `buggy_linums` (added in `buggy_file_path` in `buggy_SHA`)  onto `sha_to_map_onto`."""
-    ss_repo = Repo(ss_path)
-    # If `buggy_SHA` equals `sha_to_map_onto`, then git-blame-reverse fails.
-    if sha_to_map_onto != buggy_SHA:
-        blame_options = []
-        for linum in buggy_linums:
-            blame_options.append('-L' + str(linum) + ',+1')
-        blame_options += [buggy_SHA + '..' + sha_to_map_onto, '--', buggy_file_path]
-        
-        try:
-            blame_infos = ss_repo.git.blame('--reverse', '-w', '-n', '-f', '--abbrev=40', \
-                                            stdout_as_string = False, *blame_options)
-        except Exception as e:
-            print('Error while reverse-blaming! Skipping this (buggy_SHA, buggy_file_path) pair...') 
-            print(str(e))
-            return None
-
-        buggy_tuples = []
-        blame_infos = blame_infos.splitlines()
-        if len(blame_infos) != len(buggy_linums):
-            # print(buggy_linums)
-            # print(blame_infos)
-            print('Strange error... something weird happened while reverse-blaming. Please check!')
-            return None
-
-        for index, blame_info in enumerate(blame_infos):
-            mapped_buggy_line_num = blame_info.split('(')[0].split()[-1]
-            mapped_buggy_file_path = ' '.join(blame_info.split('(')[0].split()[1:-1])
-            buggy_tuples.append([sha_to_map_onto, mapped_buggy_file_path, mapped_buggy_line_num, \
-                                 buggy_SHA, buggy_file_path, buggy_linums[index]])
-            
-        return buggy_tuples
+def szz_group_buggylines(buggylines):
+    """
+    Groups the rows of `buggylines` by bug-fixing SHA in a single pass, instead of scanning the whole table once per bug-fixing SHA.
 
-    else:
-        return [[sha_to_map_onto, buggy_file_path, linum, buggy_SHA, buggy_file_path, linum] for linum in buggy_linums]
+    Returns a dictionary that maps each bf_sha to its list of (bi_sha, bi_file_name, linums), sorted by (bi_sha, bi_file_name), where `linums` are the distinct buggy line numbers of the pair.
+    """
+    bi_groups_per_bf_sha = defaultdict(list)
+    for (bf_sha, bi_sha, bi_file_name), bi_line_nums in buggylines.groupby(['bf_sha', 'bi_sha', 'bi_file_name'])['bi_line_num']:
+        bi_groups_per_bf_sha[bf_sha].append((bi_sha, bi_file_name, list(set(bi_line_nums))))
+    return bi_groups_per_bf_sha
+
+#--------------------------------------------------------------------------------------------------------------------------
+def szz_bf_sha_requests(targets, bf_sha, bi_groups):
+    """
+    Returns the reverse-blame requests, (bi_sha, bi_file_name, sha_to_map_onto, linums), for the buggy lines fixed in `bf_sha`.
+
+    Args
+    ----
+    targets: SzzCore.AncestryPathTargets
+        Chooses the snapshots _between_ each bi_sha and `bf_sha` (excluding `bf_sha`) on their ancestry path, which the buggy lines will later be mapped (reverse-blamed) onto
+    bf_sha: string
+        Bug-fixing SHA
+    bi_groups: list
+        (bi_sha, bi_file_name, linums) of `bf_sha`, as grouped by `szz_group_buggylines()`
+    """
+    shas_to_map_onto = {}
+    requests = []
+    for bi_sha, bi_file_name, linums in bi_groups:
+        if bi_sha not in shas_to_map_onto:
+            shas_to_map_onto[bi_sha] = [sha for _, sha in targets.targets(bi_sha, bf_sha)]
+        for sha_to_map_onto in shas_to_map_onto[bi_sha]:
+            requests.append((bi_sha, bi_file_name, sha_to_map_onto, linums))
+    return requests
+
+#--------------------------------------------------------------------------------------------------------------------------
+def szz_map_triple(blamer, triple, linums_per_request):
+    """
+    Reverse-blames the buggy lines of one (bi_sha, bi_file_name, sha_to_map_onto) triple onto sha_to_map_onto.
+
+    The union of the line numbers of all requests (`linums_per_request`) is reverse-blamed at once; if that fails, each request is reverse-blamed on its own, so that a bad request does not spoil the others.
+    Returns what `SzzCore.Blamer.reverseBlameLines()` does.
+    """
+    bi_sha, bi_file_name, sha_to_map_onto = triple
+    all_linums = sorted(set(linum for request_linums in linums_per_request for linum in request_linums))
+    # If `bi_sha` equals `sha_to_map_onto`, then git-blame-reverse fails; `reverseBlameLines()` maps every line onto itself
+    return blamer.reverseBlameLines(bi_sha, bi_file_name, sha_to_map_onto, all_linums, linums_per_request)
+
+#--------------------------------------------------------------------------------------------------------------------------
+def szz_triple_rows(project_name, triple, linums_per_request, mapped_lines):
+    """
+    Yields the bugdata rows of one (bi_sha, bi_file_name, sha_to_map_onto) triple: those of each of its requests, all of whose lines could be reverse-blamed.
+
+    Format of each row: ['project', 'ss_sha', 'ss_file_name', 'ss_line_num', 'bi_sha', 'bi_file_name', 'bi_line_num']
+    """
+    bi_sha, bi_file_name, sha_to_map_onto = triple
+    for linums in linums_per_request:
+        # Like before, a request is only used if all of its lines could be reverse-blamed
+        if all(str(linum) in mapped_lines for linum in linums):
+            for linum in linums:
+                mapped_file_name, mapped_linum = mapped_lines[str(linum)]
+                yield [project_name, sha_to_map_onto, mapped_file_name, mapped_linum, bi_sha, bi_file_name, linum]
+
+#--------------------------------------------------------------------------------------------------------------------------
+# (project name, reverse-blame engine) of the current process; set by `init_worker()`
+worker_state = None
+
+def init_worker(data_dir, project_name):
+    """
+    Sets up the state that `process_triple()` needs in the current (worker) process: a Blamer of the project clone of its own, whose reverse-blame results go through the process's own connection to the cache in `data/cache/`.
+    """
+    global worker_state
+    worker_state = (project_name, Blamer(data_dir + 'projects/' + project_name, getReverseBlameCache(data_dir, project_name)))
+
+def process_triple(triple_and_linums_per_request):
+    """Reverse-blames one (bi_sha, bi_file_name, sha_to_map_onto) triple, and returns its bugdata rows; see `szz_map_triple()` and `szz_triple_rows()`."""
+    project_name, blamer = worker_state
+    triple, linums_per_request = triple_and_linums_per_request
+    mapped_lines = szz_map_triple(blamer, triple, linums_per_request)
+    return list(szz_triple_rows(project_name, triple, linums_per_request, mapped_lines))
 
 #--------------------------------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
+    output_format = 'csv'
+    if '--output-format' in sys.argv:
+        option_index = sys.argv.index('--output-format')
+        output_format = sys.argv[option_index + 1] if option_index + 1 < len(sys.argv) else None
+        del sys.argv[option_index:option_index + 2]
+        if output_format not in TABLE_FORMATS:
+            printUsage()
+            raise ValueError('`--output-format` should be one of ' + str(TABLE_FORMATS) + '.')
+
+    num_of_cores = 1
+    if '--num-of-cores' in sys.argv:
+        option_index = sys.argv.index('--num-of-cores')
+        num_of_cores = sys.argv[option_index + 1] if option_index + 1 < len(sys.argv) else ''
+        del sys.argv[option_index:option_index + 2]
+        if not num_of_cores.isdigit() or int(num_of_cores) < 1:
+            printUsage()
+            raise ValueError('`--num-of-cores` should be a positive integer.')
+        num_of_cores = int(num_of_cores)
+
     if len(sys.argv) != 4 or not os.path.isfile(sys.argv[3]):
         printUsage()
         raise ValueError('Please provide valid arguments, as described above.')
@@ -86,44 +164,42 @@ if __name__ == '__main__':
         ss_sha_info = pickle.load(ss_sha_info_file)
         ss_shas = ss_sha_info.values()
 
-    # This will hold all the buggy tuples. It's a list of lists.
-    # Format of each buggy list: ['sha', 'file_name', 'line_num', 'bi_sha', 'bi_file_name', 'bi_line_num']
-    all_buggy_lists = []
+    # Every (bi_sha, bi_file_name, sha_to_map_onto) triple can be asked for by many bug-fixing SHAs...
+    # ...so we first collect the line numbers of all requests per triple, and then reverse-blame each triple once with the union of their line numbers
+    # Format of each request: (bi_sha, bi_file_name, sha_to_map_onto, linums)
+    num_of_requests = 0
+    linums_per_triple = OrderedDict()
     print(str(len(bf_shas)) + ' bug-fixing SHAs found for ' + project_name + '. Extracting bugdata...')
-    for bf_sha_index, bf_sha in enumerate(bf_shas):
-        # Get all bug-introducing SHAs related to this bug-fixing SHA.
-        buggylines_curr_bf_sha = buggylines[(buggylines.bf_sha == bf_sha)]
-        bi_shas = buggylines_curr_bf_sha.bi_sha.unique()
-
-        # For each bi_sha, get the list of commits between bi_sha and bf_sha, where it was eventually fixed.
-        # We will later map (reverse-blame) the buggy lines onto these shas
-        shas_to_map_onto = defaultdict(list)
-        for bi_sha in bi_shas:
-            # Get SHAs of all shas _between_ `bi_sha` and `bf_sha`
-            all_inbetween_shas = project_git_repo.git.log('--reverse', '--ancestry-path', '--format=%H', '--abbrev=40', \
-                                                             bi_sha + '..' + bf_sha) 
-            all_inbetween_shas = set(all_inbetween_shas.split()[:-1]) # <-- slicing removes `bf_sha` from the list 
-            relevant_shas = set.intersection(all_inbetween_shas, ss_shas)
-            shas_to_map_onto[bi_sha] += list(relevant_shas)
-
-        # Get all (bi_sha, bi_file_name) pairs fixed in bf_sha.
-        # For each pair, map the buggy lines onto the list of shas corresponding to each bi_sha.
-        bi_sha_file_groups = buggylines_curr_bf_sha.groupby(['bi_sha', 'bi_file_name'])
-        for key, df in bi_sha_file_groups:
-            curr_bi_sha = key[0]
-            curr_bi_file_name = key[1]
-            linums = list(set(df.bi_line_num))
-            # print((bf_sha, curr_bi_sha, curr_bi_file_name))
-            # print(linums)
-            for sha_to_map_onto in shas_to_map_onto[curr_bi_sha]:
-                curr_buggy_lists = szz_reverse_blame(project_git_repo_path, sha_to_map_onto, linums, curr_bi_file_name, curr_bi_sha)
-                if curr_buggy_lists is not None:
-                    all_buggy_lists += curr_buggy_lists
-
-    # Write back the bugdata in CSV format
-    output_filename = project_corpus_path + 'ss_bugdata.csv'
-    output_df = pandas.DataFrame(all_buggy_lists, columns = ['ss_sha', 'ss_file_name', 'ss_line_num', 'bi_sha', 'bi_file_name', 'bi_line_num'])
-    output_df.insert(0, 'project', project_name)
-    output_df.to_csv(output_filename, index=False)
+    bi_groups_per_bf_sha = szz_group_buggylines(buggylines)
+    del buggylines
+
+    targets = AncestryPathTargets(ss_shas, getCommitIndex(project_git_repo_path))
+    for bf_sha in bf_shas:
+        for request in szz_bf_sha_requests(targets, bf_sha, bi_groups_per_bf_sha.get(bf_sha, [])):
+            num_of_requests += 1
+            linums_per_triple.setdefault(request[:3], []).append(request[3])
+    del bi_groups_per_bf_sha
+
+    print(str(num_of_requests) + ' reverse-blame requests over ' + str(len(linums_per_triple)) + ' distinct (bi_sha, bi_file_name, sha) triples. Reverse-blaming...')
+
+    # The triples are handed out one at a time (and forgotten here), and reverse-blamed by `num_of_cores` processes
+    # Reverse-blame results are cached on disk in `data/cache/`, so reruns only blame what they have not seen before
+    triples = (linums_per_triple.popitem(last=False) for _ in range(len(linums_per_triple)))
+    if num_of_cores > 1:
+        pool = Pool(num_of_cores, init_worker, (data_dir, project_name))
+        rows_per_triple = pool.imap_unordered(process_triple, triples, chunksize=4)
+    else:
+        init_worker(data_dir, project_name)
+        rows_per_triple = (process_triple(triple) for triple in triples)
+
+    # Write back the bugdata as each triple is mapped, streaming the rows in chunks instead of holding them all in memory
+    # Format of each row: ['project', 'ss_sha', 'ss_file_name', 'ss_line_num', 'bi_sha', 'bi_file_name', 'bi_line_num']
+    output_filename = project_corpus_path + 'ss_bugdata.' + output_format
+    with openTableWriter(output_filename, BUGDATA_COL_NAMES, BUGDATA_COL_TYPES, output_format) as table_writer:
+        for rows in rows_per_triple:
+            table_writer.writeRows(rows)
+    if num_of_cores > 1:
+        pool.close()
+        pool.join()
 
 #--------------------------------------------------------------------------------------------------------------------------
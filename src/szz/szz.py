@@ -6,15 +6,27 @@ Read the documentation for the `szz()` and `printUsage()` functions for notes on
 References: Sliwerski, Jacek, Thomas Zimmermann, and Andreas Zeller. "When do changes induce fixes?." ACM sigsoft software engineering notes 30.4 (2005): 1-5.
 """
 #--------------------------------------------------------------------------------------------------------------------------
-import os, sys, ntpath, shlex, re, pickle, csv
+import os, sys, ntpath, shlex, re, pickle, csv, json
 from pprint import pprint
 from subprocess import Popen, PIPE, call
-from multiprocessing.dummy import Pool
+from multiprocessing import Pool
 
 try:
     from git import Repo
 except ImportError as e:
     raise
+
+from szz_process_ss import szz_ss_units, szz_process_unit, BLAME_MODES, MAP_MODES
+
+sys.path.append("src/util")
+from CommitIndex import getCommitIndex
+from SzzCore import pathLeaf, projectRepoPath
+from Journal import Journal
+from TableWriter import openTableWriter, readTable, TABLE_FORMATS
+
+# Columns of the bugdata file, and those that are stored as integers in typed formats
+BUGDATA_COL_NAMES = ['project', 'snapshot', 'ss_sha', 'ss_file_name', 'ss_line_num', 'bi_sha', 'bi_file_name', 'bi_line_num', 'is_new', 'is_bug', 'bf_ss', 'bf_sha', 'bf_file_name', 'bf_line_num']
+BUGDATA_COL_TYPES = dict((col_name, 'int') for col_name in ['ss_line_num', 'bi_line_num', 'is_new', 'is_bug', 'bf_line_num'])
     
 #--------------------------------------------------------------------------------------------------------------------------
 def printUsage():
@@ -24,59 +36,79 @@ def printUsage():
                          <path_to_bugfix_SHAs_file> 
                          <num_of_cores> 
                          [<path_to_bug_report_times_file>]
+                         [--blame-mode batched|per_line]
+                         [--map-mode blame|track|verify]
+                         [--resume]
+                         [--incremental]
+                         [--output-format csv|parquet]
 
     Sample usage: python szz.py data/corpus/libgit2/ data/snapshots/libgit2/ data/bf_shas/libgit2.bf 8
 
+    `--blame-mode` selects how the deleted lines of each file are blamed (see `szz_process_ss.szz_process_file()`); 'batched' is the default.
+    `--map-mode` selects how the 'batched' mode maps buggy lines onto the snapshots (see `szz_process_ss.szz_map_lines()`); 'blame' is the default.
+    `--resume` picks up an interrupted run where it stopped, instead of starting over; see `szz()`.
+    `--incremental` only processes the bugfix SHAs and snapshots that are new since the last run, and merges the results into the existing bugdata file; see `szz()`.
+    `--output-format` selects the format of the bugdata file: 'csv' (the default) writes ss_bugdata.csv; 'parquet' writes ss_bugdata.parquet, with dictionary-encoded SHAs and file names (needs pyarrow).
+
     Run 'pydoc /path/to/szz.py' to see detailed documentation on the `szz` module, especially the `szz.szz()` function.
     """
     print(printUsage.__doc__)
 #--------------------------------------------------------------------------------------------------------------------------
-def dismemberFilename(myname, mode):
-    """ 
-    Breaks down a complicated filename and returns a 2-element list consisting of the filename-component and the SHA-component
-    
-    If mode == 'learn', given a string of the form "s1__s2__s3.c", it returns ['s1/s2/s3.c', -1]
-    If mode == 'old', given a string of the form "s1__s2__s3__SHA.c", it returns ['s1/s2/s3.c', SHA]
-
-    NOTE: Since the s_i's represent the location of the file in the project directory structure, 'i' is not fixed. Thus, we may have just s1 and s2. Or we may have s1 through s4.
-    
-    Args
-    ----
-    myname: string
-        Full name of a file in the `learn` or `test/old` directories of some project corpus
-    mode: string
-        A string indicating whether `myname` comes from `learn` or `test/old` directories.
-    """
-    if mode == 'learn':
-        return [pathLeaf(myname).replace('__', '/'), -1]
-    elif mode == 'old':
-        filename_parts = myname.split('__')     # ['s1', 's2', 's3', 'SHA.c']
-        SHA_and_extension = filename_parts[-1].split('.')       # ['SHA', 'c']
-        return ['/'.join(filename_parts[:-1]) + '.' + SHA_and_extension[1], SHA_and_extension[0]]
+def pop_option(argv, option, choices, default):
+    """Removes `option` and its value (ex. '--blame-mode per_line') from `argv` and returns the value, or `default` if `option` is not given. Raises ValueError if the value is not one of `choices`."""
+    if option not in argv:
+        return default
+    option_index = argv.index(option)
+    value = argv[option_index + 1] if option_index + 1 < len(argv) else None
+    del argv[option_index:option_index + 2]
+    if value not in choices:
+        sys.stderr.write(printUsage.__doc__)
+        raise ValueError("Invalid input! `" + option + "` should be one of " + str(choices) + ".")
+    return value
 
 #--------------------------------------------------------------------------------------------------------------------------
-def pathLeaf(path):
-    """Returns the basename of the file/directory path in an _extremely_ robust way. For example, pathLeaf('/hame/saheel/git_repos/szz/abc.c/') will return 'abc.c'."""
-    head, tail = ntpath.split(path)
-    return tail or ntpath.basename(head)
+def pop_flag(argv, flag):
+    """Removes `flag` (ex. '--resume') from `argv`, and returns whether it was there."""
+    if flag not in argv:
+        return False
+    argv.remove(flag)
+    return True
 
 #--------------------------------------------------------------------------------------------------------------------------
-def Popen_and_print(cmd):
-    process = Popen(cmd, stdout=PIPE, stderr=PIPE, close_fds=True)
+def bugdata_rows(project_name, bf_ss, bugdata_in_unit):
+    """Yields the rows of the bugdata file (see `BUGDATA_COL_NAMES`) for the buggy tuples `bugdata_in_unit` found in the snapshot `bf_ss`."""
+    for buggy_dict in bugdata_in_unit:
+        bf_file_name, bf_sha, bf_line_num = buggy_dict.keys()[0]
+        ss_name, file_name, sha, line_num, buggy_SHA, buggy_file_name, buggy_line_num = buggy_dict.values()[0]
+        yield (project_name, ss_name, sha, file_name, line_num, buggy_SHA, buggy_file_name, buggy_line_num, -2, 1, bf_ss, bf_sha, bf_file_name, bf_line_num)
 
-    stdout, stderr = process.communicate()
-    if stdout:
-        sys.stdout.write(stdout)
-    if stderr:
-        sys.stderr.write(stderr)
+#--------------------------------------------------------------------------------------------------------------------------
+def load_manifest(manifest_filename, blame_mode, map_mode, output_format):
+    """
+    Returns the manifest of the last complete run (see `szz()`), or None if there is none or it was made with other blame/map modes or another output format.
+    """
+    if not os.path.isfile(manifest_filename):
+        print("No manifest found at " + manifest_filename + "; processing everything")
+        return None
+    with open(manifest_filename) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('blame_mode') != blame_mode or manifest.get('map_mode') != map_mode \
+       or manifest.get('output_format', 'csv') != output_format:
+        print("The last run used other blame/map modes or another output format; processing everything")
+        return None
+    return manifest
 
-    return process.returncode
+#--------------------------------------------------------------------------------------------------------------------------
+def process_indexed_unit(indexed_unit):
+    """Runs `szz_process_unit()` on an (index, unit) pair and returns (index, ss_name, buggy tuples), so that results arriving out of order can be put back in order. The buggy tuples are None if the unit failed."""
+    unit_index, unit = indexed_unit
+    return (unit_index,) + szz_process_unit(unit)
 
 #--------------------------------------------------------------------------------------------------------------------------
 def szz(project_corpus_path, project_snapshots_path, bugfix_SHAs_filename, \
-        num_of_cores = '4', ps_bug_report_times_filename = ''):
+        num_of_cores = '4', ps_bug_report_times_filename = '', blame_mode = 'batched', map_mode = 'blame', resume = False, incremental = False, output_format = 'csv'):
     """
-    Computes the SHAs where all the fix-inducing lines were introduced (along the lines of SZZ) and records the precise location of each such line in a CSV file in the `project_corpus_path` directory.
+    Computes the SHAs where all the fix-inducing lines were introduced (along the lines of SZZ) and records the precise location of each such line in a CSV (or Parquet) file in the `project_corpus_path` directory.
 
     TODO Document your algo!!
 
@@ -92,6 +124,16 @@ def szz(project_corpus_path, project_snapshots_path, bugfix_SHAs_filename, \
         Number of cores you want to utilize for parallel processing
     ps_bug_report_times_filename: string
         A file containing the list of dates (ex. '2009-04-13'), one on each line, when the post-release bugs were reported. The list should corresponding to the list of bugfix SHAs in the `bugfix_SHAs_filename` file. If you are working with development-time bugs, this parameter can be ignored, in which case it defaults to a null string.
+    blame_mode: string
+        'batched' (default) blames all the deleted lines of a file with one `git blame` invocation; 'per_line' blames them one at a time. Both pass the same options to `git blame`, and produce the same rows except where its move/copy detection (-M -C) attributes a line differently when the neighbouring lines are blamed along with it.
+    map_mode: string
+        'blame' (default) maps the buggy lines onto the snapshots with `git blame --reverse`; 'track' follows them through the diffs of their file in one pass, falling back to `git blame --reverse` where it can't; 'verify' does both and reports where they disagree.
+    resume: bool
+        Every finished (bugfix SHA, file) unit is recorded, along with its rows, in the journal `project_corpus_path`/ss_bugdata.journal as soon as it is done. If True, the units found in the journal of an earlier (crashed or preempted) run are not processed again, and their rows are merged into the output; if False, the journal is started afresh.
+    incremental: bool
+        After each complete run, the bugfix SHAs and snapshots it covered (leaving out the bugfix SHAs of units that failed) are listed in the manifest `project_corpus_path`/ss_bugdata.manifest.json. If True, only the (bugfix SHA, file) units that the last run did not cover are processed: those of new bugfix SHAs, and all those of snapshots from the first new snapshot on (their buggy lines may now map onto more snapshots). The rows of the other units are carried over from the existing bugdata file; rows of bugfix SHAs no longer in `bugfix_SHAs_filename` are dropped.
+    output_format: string
+        Format of the bugdata file, 'csv' (default) or 'parquet'. Rows are written in chunks as the units are done, in no particular order.
     
     Raises
     ------
@@ -138,56 +180,98 @@ def szz(project_corpus_path, project_snapshots_path, bugfix_SHAs_filename, \
     ss_paths = [project_snapshots_path + '/' + ss_name + '/' for ss_name in ss_names]
     ss_changes_paths = [project_corpus_path + '/' + ss_name + '/' for ss_name in ss_names]
 
-    # Wait for processes to complete
-    pool = Pool(int(num_of_cores))
-    processes = []
-    cmds = []
+    # Build (or refresh) the project's commit index once, before the snapshots are processed in parallel
+    getCommitIndex(projectRepoPath(ss_paths[0]))
+
+    # Split the work into (bugfix SHA, file) units across all snapshots, so that a snapshot with most of the fixes
+    # doesn't keep one core busy while the others sit idle. Biggest files first, so that no big unit starts last.
+    bugfix_SHAs = set(open(bugfix_SHAs_filename).read().splitlines())
+    units = []
     for ss_index, ss_changes_path in enumerate(ss_changes_paths):
-        process_ss_cmd = "python src/szz/szz_process_ss.py " + ss_names[ss_index] + " " + ss_paths[ss_index] + " " \
-                          + ss_changes_path + " " + bugfix_SHAs_filename
-        cmds.append(shlex.split(process_ss_cmd))
+        ss_units = szz_ss_units(ss_names[ss_index], ss_paths[ss_index], ss_changes_path, bugfix_SHAs, blame_mode, map_mode)
+        units += ss_units or []
 
-    # TODO check the return codes for errors
-    return_codes = pool.map(Popen_and_print, cmds)
+    # Units covered by the last complete run keep their rows from the existing bugdata file
+    bugdata_filename = project_corpus_path + '/ss_bugdata.' + output_format
+    manifest_filename = project_corpus_path + 'ss_bugdata.manifest.json'
+    carried_over_units = set()
+    manifest = load_manifest(manifest_filename, blame_mode, map_mode, output_format) if incremental else None
+    if manifest is not None and os.path.isfile(bugdata_filename):
+        done_bugfix_SHAs = set(manifest['bugfix_SHAs'])
+        done_ss_names = set(manifest['ss_names'])
+        new_ss_names = [ss_name for ss_name in ss_names if ss_name not in done_ss_names]
+        first_new_ss_name = min(new_ss_names) if new_ss_names else None
+        for unit in units:
+            ss_name, bugfix_SHA, bugfix_file_name = unit[:3]
+            if bugfix_SHA in done_bugfix_SHAs and ss_name in done_ss_names \
+               and (first_new_ss_name is None or ss_name < first_new_ss_name):
+                carried_over_units.add((ss_name, bugfix_SHA, bugfix_file_name))
+        units = [unit for unit in units if unit[:3] not in carried_over_units]
+        print("Incremental run: " + str(len(units)) + " new units, " + str(len(carried_over_units)) + " carried over")
+    indexed_units = sorted(enumerate(units), key=lambda indexed_unit: -os.path.getsize(indexed_unit[1][3] + indexed_unit[1][4]))
 
-    # Accumulate the bugdata for all snapshots into `bugdata_forall_ss_dict`
-    bugdata_forall_ss_dict = {}
-    for ss_index, ss_changes_path in enumerate(ss_changes_paths):
-        ss_bugdata_outfile_name = ss_changes_path + '/ss_mappedOntoSSOnly.bugdata'
-        try:
-            with open(ss_bugdata_outfile_name, 'rb') as ss_bugdata_outfile:
-                bugdata_in_ss = pickle.load(ss_bugdata_outfile)
-                bugdata_forall_ss_dict[ss_names[ss_index]] = bugdata_in_ss
-        except Exception as e:
-            sys.stderr.write("Error while fetching bugdata for snapshot " + ss_names[ss_index] + "\n" + str(e))
-
-    # Write `bugdata_forall_ss_dict`, that contains the bugdata for the whole project...
-    # ...to a CSV file in `data/corpus`
-    csv_rows = [('project', 'snapshot', 'ss_sha', 'ss_file_name', 'ss_line_num', 'bi_sha', 'bi_file_name', 'bi_line_num', 'is_new', 'is_bug', 'bf_ss', 'bf_sha', 'bf_file_name', 'bf_line_num')]
-    for ss_name in bugdata_forall_ss_dict.keys():
-        buggy_dicts =  bugdata_forall_ss_dict[ss_name]
-        for buggy_dict in buggy_dicts:
-            bf_ss = ss_name
-            bf_file_name, bf_sha, bf_line_num = buggy_dict.keys()[0]
-            ss_name, file_name, sha, line_num, buggy_SHA, buggy_file_name, buggy_line_num = buggy_dict.values()[0]
-            csv_rows.append(tuple([project_name, ss_name, sha, file_name, line_num, buggy_SHA, buggy_file_name, buggy_line_num, -2, 1, bf_ss, bf_sha, bf_file_name, bf_line_num]))
-        
-    bugdata_csv_filename = project_corpus_path + '/ss_bugdata.csv'
-    with open(bugdata_csv_filename, 'wb') as outfile:
-        csv_writer = csv.writer(outfile)
-        csv_writer.writerows(csv_rows)
+    # Rows are streamed to the bugdata file as they come, so memory use does not grow with the size of the history.
+    # Write to a temporary file first: the rows carried over are read from the existing bugdata file.
+    table_writer = openTableWriter(bugdata_filename + '.tmp', BUGDATA_COL_NAMES, BUGDATA_COL_TYPES, output_format)
+    if carried_over_units:
+        col_names, rows = readTable(bugdata_filename, output_format)
+        key_indices = [col_names.index(col_name) for col_name in ('bf_ss', 'bf_sha', 'bf_file_name')]
+        table_writer.writeRows(row for row in rows if tuple(row[key_index] for key_index in key_indices) in carried_over_units)
+
+    # Units finished by an earlier run are taken from the journal. A unit's key is the unit itself, so a unit is
+    # redone if anything about it (ex. the snapshot's SHA or the blame mode) has changed since.
+    journal = Journal(project_corpus_path + 'ss_bugdata.journal', resume)
+    pending_units = set(units)
+    for unit, (ss_name, bugdata_in_unit) in journal.items():
+        if unit in pending_units:
+            pending_units.remove(unit)
+            table_writer.writeRows(bugdata_rows(project_name, ss_name, bugdata_in_unit))
+    indexed_units = [indexed_unit for indexed_unit in indexed_units if indexed_unit[1] in pending_units]
+    if len(pending_units) < len(units):
+        print("Resuming: " + str(len(units) - len(pending_units)) + " of " + str(len(units)) + " units were done by an earlier run")
+
+    # Worker processes pull one unit at a time, and their results stream back here as soon as each unit is done
+    # Failed units are not journaled, so that `--resume` retries them
+    failed_units = []
+    pool = Pool(int(num_of_cores))
+    for unit_index, ss_name, bugdata_in_unit in pool.imap_unordered(process_indexed_unit, indexed_units, chunksize=1):
+        if bugdata_in_unit is None:
+            failed_units.append(units[unit_index])
+            continue
+        journal.record(units[unit_index], (ss_name, bugdata_in_unit))
+        table_writer.writeRows(bugdata_rows(project_name, ss_name, bugdata_in_unit))
+    pool.close()
+    pool.join()
+    journal.close()
+    if failed_units:
+        sys.stderr.write("\n" + str(len(failed_units)) + " of " + str(len(units)) + " units failed (see above); rerun with `--resume` to retry them\n")
+
+    table_writer.close()
+    os.rename(bugdata_filename + '.tmp', bugdata_filename)
+
+    # The bugfix SHAs of failed units are left out, so that `--incremental` processes them again next time
+    covered_bugfix_SHAs = set(bugfix_SHAs) - set(unit[1] for unit in failed_units)
+    with open(manifest_filename, 'w') as manifest_file:
+        json.dump({'bugfix_SHAs': sorted(covered_bugfix_SHAs), 'ss_names': ss_names, 'blame_mode': blame_mode, 'map_mode': map_mode,
+                   'output_format': output_format}, manifest_file)
 
 #-------------------------------------------------------------------------------------------------------------------------
 if __name__ == "__main__":
 
+    blame_mode = pop_option(sys.argv, '--blame-mode', BLAME_MODES, 'batched')
+    map_mode = pop_option(sys.argv, '--map-mode', MAP_MODES, 'blame')
+    resume = pop_flag(sys.argv, '--resume')
+    incremental = pop_flag(sys.argv, '--incremental')
+    output_format = pop_option(sys.argv, '--output-format', TABLE_FORMATS, 'csv')
+
     if len(sys.argv) not in [5, 6]:
         sys.stderr.write(printUsage.__doc__)
         raise ValueError("Invalid input!")
 
     if len(sys.argv) == 5:
         # Development-time bugs case
-        szz(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+        szz(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], blame_mode = blame_mode, map_mode = map_mode, resume = resume, incremental = incremental, output_format = output_format)
     elif len(sys.argv) == 6: 
         # Post-release bugs case
-        szz(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+        szz(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], blame_mode, map_mode, resume, incremental, output_format)
 #--------------------------------------------------------------------------------------------------------------------------
@@ -1,74 +1,126 @@
 #--------------------------------------------------------------------------------------------------------------------------
-import os, sys, ntpath, subprocess, shlex, re, pickle
+import os, sys, subprocess, shlex, re, pickle, traceback
 from pprint import pprint
 from subprocess import Popen, PIPE
 
-try:
-    from git import Repo
-except ImportError as e:
-    raise e
-    
+sys.path.append("src/util")
+from CommitIndex import getCommitIndex
+from ReverseBlameCache import getReverseBlameCache
+from LineTracker import LineTracker
+from SzzCore import Blamer, SnapshotTargets, dismemberFilename, pathLeaf, projectRepoPath
+
+# Ways of blaming the deleted lines of a file; see `szz_process_file()`
+BLAME_MODES = ('batched', 'per_line')
+
+# Ways of mapping buggy lines onto snapshots in the 'batched' blame mode; see `szz_map_lines()`
+MAP_MODES = ('blame', 'track', 'verify')
+
 #--------------------------------------------------------------------------------------------------------------------------
-def dismemberFilename(myname, mode):
-    """ 
-    Breaks down a complicated filename and returns a 2-element list consisting of the filename-component and the SHA-component
-    
-    If mode == 'learn', given a string of the form "s1__s2__s3.c", it returns ['s1/s2/s3.c', -1]
-    If mode == 'old', given a string of the form "s1__s2__s3__SHA.c", it returns ['s1/s2/s3.c', SHA]
+class SzzContext(object):
+    """
+    What all units of work of the project of the snapshot at `ss_path` share: the snapshot metadata in `ss_sha_info.txt`, and the commit index, the reverse-blame cache and the git handles of the project.
 
-    NOTE: Since the s_i's represent the location of the file in the project directory structure, 'i' is not fixed. Thus, we may have just s1 and s2. Or we may have s1 through s4.
-    
-    Args
-    ----
-    myname: string
-        Full name of a file in the `learn` or `test/old` directories of some project corpus
-    mode: string
-        A string indicating whether `myname` comes from `learn` or `test/old` directories.
+    All blames run against the project clone in `data/projects/<project>` with explicit revisions, so that every worker reads the same object store (and git's caches of it stay hot), and the snapshots are only needed for their metadata. If there is no such clone, the snapshots' own repos are blamed instead.
+
+    Loaded once per process (see `get_szz_context()`) instead of once per file, since a snapshot can have tens of thousands of changed files.
     """
-    if mode == 'learn':
-        return [pathLeaf(myname).replace('__', '/'), -1]
-    elif mode == 'old':
-        filename_parts = myname.split('__')     # ['s1', 's2', 's3', 'SHA.c']
-        SHA_and_extension = filename_parts[-1].split('.')       # ['SHA', 'c']
-        return ['/'.join(filename_parts[:-1]) + '.' + SHA_and_extension[1], SHA_and_extension[0]]
+    def __init__(self, ss_path):
+        project_snapshots_dir = os.path.dirname(os.path.dirname(ss_path))
+        self.project_snapshots_dir = project_snapshots_dir
+        with open(os.path.join(project_snapshots_dir, 'ss_sha_info.txt'), 'rb') as ss_sha_info_file:
+            self.ss_sha_info_dict = pickle.load(ss_sha_info_file)
 
-#--------------------------------------------------------------------------------------------------------------------------
-def pathLeaf(path):
-    """Returns the basename of the file/directory path in an _extremely_ robust way. For example, pathLeaf('/hame/saheel/git_repos/szz/abc.c/') will return 'abc.c'."""
-    head, tail = ntpath.split(path)
-    return tail or ntpath.basename(head)
+        self.project_repo_path = projectRepoPath(ss_path)
+        self.commit_index = getCommitIndex(self.project_repo_path)
+        self.reverse_blame_cache = getReverseBlameCache(os.path.dirname(os.path.dirname(project_snapshots_dir)), pathLeaf(project_snapshots_dir))
+        self.blamers = {}
+        self.targets_per_ss = {}
+        self.tracker = None
+
+    def ss_path(self, ss_name):
+        """Returns the path to the snapshot `ss_name`."""
+        return self.project_snapshots_dir + '/' + ss_name + '/'
+
+    def blamer(self, ss_path, cached = True):
+        """Returns a `SzzCore.Blamer` of the project (or, without a project clone, of the snapshot at `ss_path`), which reverse-blames through the project's reverse-blame cache if `cached` is True."""
+        repo_path = projectRepoPath(ss_path)
+        key = (repo_path, cached)
+        if key not in self.blamers:
+            self.blamers[key] = Blamer(repo_path, self.reverse_blame_cache if cached else None)
+        return self.blamers[key]
+
+    def targets(self, ss_name):
+        """Returns the `SzzCore.SnapshotTargets` of the buggy lines fixed in snapshot `ss_name`: this and the earlier snapshots."""
+        if ss_name not in self.targets_per_ss:
+            self.targets_per_ss[ss_name] = SnapshotTargets(self.ss_sha_info_dict, self.commit_index, ss_name, self.project_repo_path)
+        return self.targets_per_ss[ss_name]
+
+    def line_tracker(self):
+        """Returns the `LineTracker` of the project."""
+        if self.tracker is None:
+            self.tracker = LineTracker(self.project_repo_path, self.commit_index)
+        return self.tracker
+
+# One context per project per process; see `get_szz_context()`
+szz_contexts = {}
+
+def get_szz_context(ss_path):
+    """Returns the `SzzContext` of the project that the snapshot at `ss_path` (`data/snapshots/<project>/<ss>/`) belongs to."""
+    project_snapshots_dir = os.path.dirname(os.path.dirname(ss_path))
+    key = (os.getpid(), os.path.abspath(project_snapshots_dir))
+    if key not in szz_contexts:
+        szz_contexts[key] = SzzContext(ss_path)
+    return szz_contexts[key]
 
 #--------------------------------------------------------------------------------------------------------------------------
-def szz_reverse_blame(ss_path, sha_to_blame_on, buggy_line_num, buggy_file_path_in_ss, buggy_SHA):
-    """Reverse-blames `buggy_line_num` (added in `buggy_SHA`)  onto `sha_to_blame_on`."""
-    ss_repo = Repo(ss_path)
-    ss_name = pathLeaf(ss_path)
-    try:
-        # If buggy_SHA equals sha_to_blame_on, then git-blame-reverse fails.
-        # In our code buggy_SHA and sha_to_blame_on are never equal, but just to be safe...
-        if sha_to_blame_on != buggy_SHA:
-            curr_blame_info = ss_repo.git.blame('--reverse', '-w', '-n', '-f', '--abbrev=40', \
-                                                '-L' + buggy_line_num + ',+1', \
-                                                '--', buggy_file_path_in_ss, \
-                                                buggy_SHA + '..' + sha_to_blame_on,
-                                                stdout_as_string = False)
-            curr_buggy_line_num = curr_blame_info.split('(')[0].split()[-1]
-            curr_buggy_file_path_in_ss = ' '.join(curr_blame_info.split('(')[0].split()[1:-1])
-            return [ss_name, curr_buggy_file_path_in_ss, sha_to_blame_on, curr_buggy_line_num]
+def szz_map_lines(context, ss_names, buggy_line_nums, buggy_file_path_in_ss, buggy_SHA, map_mode = 'blame'):
+    """
+    Maps `buggy_line_nums` (added in `buggy_SHA`) onto each of the snapshots `ss_names`.
+
+    Returns a dictionary that maps each snapshot name to a dictionary that maps each of the `buggy_line_nums` that could be mapped to [ss_name, mapped_file_path, ss_sha, mapped_line_num].
+
+    `map_mode` is one of `MAP_MODES`. In the 'blame' mode, the lines are reverse-blamed (through the reverse-blame cache) onto each snapshot. In the 'track' mode, the `LineTracker` of the `context` (an `SzzContext`) follows the lines onto all snapshots in a single walk over the diffs of the file, and only the snapshots it cannot reach are reverse-blamed. The 'verify' mode does both, reports on stderr where they disagree, and keeps the reverse-blamed lines.
+    """
+    tracked_lines_per_SHA = {}
+    if map_mode != 'blame':
+        tracked_lines_per_SHA = context.line_tracker().mapLines(buggy_SHA, buggy_file_path_in_ss, buggy_line_nums,
+                                                                [context.ss_sha_info_dict[ss_name] for ss_name in ss_names])
 
+    mapped_lines_per_ss = {}
+    for ss_name in ss_names:
+        ss_sha = context.ss_sha_info_dict[ss_name]
+        tracked_lines = tracked_lines_per_SHA.get(ss_sha)
+        if tracked_lines is None or map_mode != 'track':
+            mapped_lines = context.blamer(context.ss_path(ss_name)).reverseBlameLines(buggy_SHA, buggy_file_path_in_ss, ss_sha, buggy_line_nums)
+            if tracked_lines is not None:
+                for line_num, mapped_line in sorted(mapped_lines.items()):
+                    if tracked_lines.get(line_num) != mapped_line:
+                        sys.stderr.write("\nLine tracking disagrees with reverse-blame for line " + line_num + " of " + buggy_file_path_in_ss \
+                                         + " (" + buggy_SHA + ") in snapshot " + ss_name + ": " + str(tracked_lines.get(line_num)) \
+                                         + " vs " + str(mapped_line))
         else:
-            return [ss_name, buggy_file_path_in_ss, sha_to_blame_on, buggy_line_num]
+            mapped_lines = tracked_lines
 
-    except Exception as e:
-        sys.stderr.write("\nError in reverse-blame! Continuing with next line_num...\n" + str(e))
-        return None
+        mapped_lines_per_ss[ss_name] = dict((line_num, [ss_name, mapped_file_path, ss_sha, mapped_line_num]) \
+                                            for line_num, (mapped_file_path, mapped_line_num) in mapped_lines.items())
+    return mapped_lines_per_ss
 
 #--------------------------------------------------------------------------------------------------------------------------
 def szz_process_file(old_file_SHA, old_file_path_in_ss, old_files_path, old_file_fullname, new_files_path,
-                     ss_path, ss_SHA):
-    """Returns buggy tuples corresponding to the lines deleted in `old_file_path_in_ss`"""
+                     ss_path, ss_SHA, blame_mode = 'batched', map_mode = 'blame'):
+    """
+    Returns buggy tuples corresponding to the lines deleted in `old_file_path_in_ss`
+
+    `blame_mode` is one of `BLAME_MODES`. In the 'per_line' mode, every deleted line gets its own `git blame` and `git blame --reverse` (per earlier snapshot) invocations. In the 'batched' mode, all deleted lines of the file are blamed at once, and the lines are reverse-blamed at once per (bug-introducing SHA, file, snapshot) triple, through the project's reverse-blame cache. Both modes return the same tuples in the same order, except where git's move/copy detection (-M -C) attributes a line differently when its neighbouring lines are blamed along with it.
 
-    ss_repo = Repo(ss_path)
+    `map_mode` (one of `MAP_MODES`) chooses how the 'batched' mode maps the lines onto the snapshots; see `szz_map_lines()`.
+    """
+    if blame_mode not in BLAME_MODES:
+        raise ValueError("`blame_mode` should be one of " + str(BLAME_MODES) + ". Given: " + str(blame_mode))
+    if map_mode not in MAP_MODES:
+        raise ValueError("`map_mode` should be one of " + str(MAP_MODES) + ". Given: " + str(map_mode))
+
+    context = get_szz_context(ss_path)
     all_buggy_tuples_in_ss_files = []
     bugfix_SHA = old_file_SHA
     this_ss_name = pathLeaf(ss_path)
@@ -81,100 +133,136 @@ def szz_process_file(old_file_SHA, old_file_path_in_ss, old_files_path, old_file
     process = Popen(shlex.split(diff_command), stdout=PIPE, close_fds=True)
     line_nums = process.communicate()[0].split()
 
-    project_snapshots_dir = os.path.dirname(os.path.dirname(ss_path))
-    ss_sha_info_filename = os.path.join(project_snapshots_dir, 'ss_sha_info.txt')
-    ss_sha_info_dict = pickle.load(open(ss_sha_info_filename, 'rb'))
-    all_ss_names = sorted(ss_sha_info_dict.keys())
-    this_and_prev_ss_names = all_ss_names[:all_ss_names.index(this_ss_name)] + [this_ss_name]
+    # The buggy lines are mapped onto this and the earlier snapshots that were taken after they were introduced
+    targets = context.targets(this_ss_name)
 
-    # Blame each buggy line to get the bug-introducing `buggy_sha`
-    # Then, reverse-blame each buggy line to find buggy lines present in various snapshots
-    for line_num in line_nums:
-        try:
-            blame_info = ss_repo.git.blame('-w', '-M', '-C', '-C', '-n', '-f', '--abbrev=40', \
-                                           '-L' + line_num + ',+1', \
-                                           bugfix_SHA + '^', \
-                                           '--', old_file_path_in_ss, \
-                                           stdout_as_string = False)
-        except Exception, e:
-            print("\nError! Continuing with next line_num...\n" + str(e))
-            continue
+    if blame_mode == 'batched':
+        if not line_nums:
+            return all_buggy_tuples_in_ss_files
 
-        buggy_line_num = blame_info.split('(')[0].split()[-1]
-        buggy_SHA = blame_info.split()[0][-40:]
-        buggy_file_path_in_ss = ' '.join(blame_info.split('(')[0].split()[1:-1])
+        # Blame all buggy lines at once to get the bug-introducing `buggy_sha` of each
+        blamed_lines = context.blamer(ss_path).blameLines(bugfix_SHA + '^', old_file_path_in_ss, line_nums)
+        ss_names_per_SHA = dict((buggy_SHA, [ss_name for ss_name, _ in targets.targets(buggy_SHA, bugfix_SHA)]) \
+                                for buggy_SHA in set(blame[0] for blame in blamed_lines.values()))
 
-        buggy_SHA_date = str(ss_repo.git.log('-n', '1', '--format="%ad"', '--date=short', buggy_SHA))
-        buggy_SHA_date = buggy_SHA_date.replace('"', '')
+        # Group the buggy lines by (buggy_SHA, buggy_file_path_in_ss)...
+        # ...and map each group at once onto all snapshots it can be mapped onto
+        buggy_line_nums_per_pair = {}
+        for buggy_SHA, buggy_file_path_in_ss, buggy_line_num in blamed_lines.values():
+            buggy_line_nums_per_pair.setdefault((buggy_SHA, buggy_file_path_in_ss), set()).add(buggy_line_num)
 
-        project_snapshots_dir = os.path.dirname(os.path.dirname(ss_path))
-        for ss_name in this_and_prev_ss_names:
-            if buggy_SHA_date < ss_name:
-                ss_sha = ss_sha_info_dict[ss_name]
-                ss_path = project_snapshots_dir + '/' + ss_name + '/'
+        mapped_lines_per_pair = {}
+        for (buggy_SHA, buggy_file_path_in_ss), buggy_line_nums in buggy_line_nums_per_pair.items():
+            buggy_line_nums = sorted(buggy_line_nums, key=int)
+            mapped_lines_per_ss = szz_map_lines(context, ss_names_per_SHA[buggy_SHA], buggy_line_nums, buggy_file_path_in_ss, buggy_SHA, map_mode)
+            for ss_name, mapped_lines in mapped_lines_per_ss.items():
+                mapped_lines_per_pair[(buggy_SHA, buggy_file_path_in_ss, ss_name)] = mapped_lines
 
-                # `buggy_tuple_ss` is the info of the buggy line mapped to this snapshot
-                buggy_tuple_ss = szz_reverse_blame(ss_path, ss_sha, buggy_line_num, buggy_file_path_in_ss, buggy_SHA)
+        # Emit the tuples in the same order as the 'per_line' mode does
+        for line_num in line_nums:
+            if line_num not in blamed_lines:
+                continue
+            buggy_SHA, buggy_file_path_in_ss, buggy_line_num = blamed_lines[line_num]
+            for ss_name in ss_names_per_SHA[buggy_SHA]:
+                buggy_tuple_ss = mapped_lines_per_pair[(buggy_SHA, buggy_file_path_in_ss, ss_name)].get(buggy_line_num)
                 if buggy_tuple_ss:
-                    # Add info on where the buggy line originated
-                    buggy_tuple_ss += [buggy_SHA, buggy_file_path_in_ss, buggy_line_num]
+                    buggy_tuple_ss = buggy_tuple_ss + [buggy_SHA, buggy_file_path_in_ss, buggy_line_num]
                     all_buggy_tuples_in_ss_files.append({(old_file_path_in_ss, old_file_SHA, line_num): buggy_tuple_ss})
 
+        return all_buggy_tuples_in_ss_files
+
+    # Blame each buggy line to get the bug-introducing `buggy_sha`
+    # Then, reverse-blame each buggy line to find buggy lines present in various snapshots
+    for line_num in line_nums:
+        blamed_lines = context.blamer(ss_path, cached = False).blameLines(bugfix_SHA + '^', old_file_path_in_ss, [line_num])
+        if line_num not in blamed_lines:
+            continue
+        buggy_SHA, buggy_file_path_in_ss, buggy_line_num = blamed_lines[line_num]
+
+        for ss_name, ss_sha in targets.targets(buggy_SHA, bugfix_SHA):
+            mapped_lines = context.blamer(context.ss_path(ss_name), cached = False).reverseBlameLines(buggy_SHA, buggy_file_path_in_ss, ss_sha, [buggy_line_num])
+
+            # `buggy_tuple_ss` is the info of the buggy line mapped to this snapshot...
+            # ...followed by the info of where the buggy line originated
+            if buggy_line_num in mapped_lines:
+                mapped_file_path, mapped_line_num = mapped_lines[buggy_line_num]
+                buggy_tuple_ss = [ss_name, mapped_file_path, ss_sha, mapped_line_num, buggy_SHA, buggy_file_path_in_ss, buggy_line_num]
+                all_buggy_tuples_in_ss_files.append({(old_file_path_in_ss, old_file_SHA, line_num): buggy_tuple_ss})
+
     return all_buggy_tuples_in_ss_files
 
 #--------------------------------------------------------------------------------------------------------------------------
-def szz_process_ss(ss_name, ss_path, ss_changes_path, bugfix_SHAs_filename):
-    bugfix_SHAs = [SHA for SHA in open(bugfix_SHAs_filename).read().splitlines()]
-    all_buggy_lines_fixed_in_ss = []
+def szz_ss_units(ss_name, ss_path, ss_changes_path, bugfix_SHAs, blame_mode = 'batched', map_mode = 'blame'):
+    """
+    Returns the units of work of one snapshot: one tuple of `szz_process_unit()` arguments per (bugfix SHA, file) pair whose old version is in `ss_changes_path`/test/old/, in the order `szz_process_ss()` processes them. `bugfix_SHAs` is a set.
 
-    # Git repo for current ss
+    Returns None (and says why on stderr) if the snapshot can't be processed.
+    """
+    # The SHA of the snapshot comes from its metadata; the snapshot does not have to be a git repo of its own
     try:
-        ss_repo = Repo(ss_path)
+        ss_SHA = get_szz_context(ss_path).ss_sha_info_dict[ss_name]
     except Exception as e:
-        sys.stderr.write("\nApparently, " + ss_path + " is not a valid git repo. Skipping this snapshot...")
+        sys.stderr.write("\nNo SHA found for the snapshot " + ss_name + " in `ss_sha_info.txt`. Skipping this snapshot...")
         sys.stderr.write(str(e))
-        return
-
-    ss_SHA = ss_repo.git.log('--format=%H', '-n', '1')
+        return None
 
-    # Get metadata on the files in ss/test/old and ss/test/new in order to process the buggy lines
-    old_file_paths_in_ss = []
-    old_file_SHAs = []
-    
     # Path to ss/test/old and ss/test/new; used to diff old and new files
     old_files_path = ss_changes_path + 'test/old/'
     new_files_path = ss_changes_path + 'test/new/'
     if not os.path.isdir(old_files_path) or not os.path.isdir(new_files_path):
         sys.stderr.write("`test/old/` or `test/new/` path invalid for the snapshot `" + ss_name + "`. Skipping this snapshot...")
-        return
+        return None
 
+    # Get metadata on the files in ss/test/old and ss/test/new in order to process the buggy lines
+    units = []
     old_file_fullnames = [filename for filename in os.listdir(old_files_path) if filename.endswith(('c', 'cpp', 'cc', 'java'))]
     old_file_fullnames.sort()
     for old_file_fullname in old_file_fullnames:
         # Example of old_file_fullname = src__oid__b7c891c629d298f2d82310d8ced2ee2e48084213.c
-        name_SHA_pair = dismemberFilename(old_file_fullname, 'old')
-        old_file_paths_in_ss.append(name_SHA_pair[0])
-        old_file_SHAs.append(name_SHA_pair[1])
+        old_file_path_in_ss, old_file_SHA = dismemberFilename(old_file_fullname, 'old')
+        if old_file_SHA in bugfix_SHAs:
+            units.append((ss_name, old_file_SHA, old_file_path_in_ss, old_files_path, old_file_fullname,
+                          new_files_path, ss_path, ss_SHA, blame_mode, map_mode))
+    return units
+
+#--------------------------------------------------------------------------------------------------------------------------
+def szz_process_unit(unit):
+    """
+    Processes one unit of work from `szz_ss_units()` with `szz_process_file()`.
+
+    Returns (ss_name, buggy tuples), or (ss_name, None) if the unit failed. Errors are reported on stderr instead of stopping the whole run; this is what lets a pool of worker processes map this function over the units of all snapshots. A failed unit must not be taken as done (ex. journaled), so that a later run retries it.
+    """
+    ss_name = unit[0]
+    try:
+        return (ss_name, szz_process_file(*unit[1:]))
+    except Exception as e:
+        sys.stderr.write("\nError while processing " + unit[2] + " (" + unit[1] + ") in snapshot " + ss_name + ". Continuing with next file...\n" \
+                         + traceback.format_exc())
+        return (ss_name, None)
+
+#--------------------------------------------------------------------------------------------------------------------------
+def szz_process_ss(ss_name, ss_path, ss_changes_path, bugfix_SHAs_filename, blame_mode = 'batched', map_mode = 'blame'):
+    bugfix_SHAs = set(open(bugfix_SHAs_filename).read().splitlines())
+    all_buggy_lines_fixed_in_ss = []
+
+    units = szz_ss_units(ss_name, ss_path, ss_changes_path, bugfix_SHAs, blame_mode, map_mode)
+    if units is None:
+        return
 
     # Start processing the ss/test/old files
-    for old_file_index, old_file_path_in_ss in enumerate(old_file_paths_in_ss):
-        old_file_SHA = old_file_SHAs[old_file_index]
-        if old_file_SHA in bugfix_SHAs:
-            temp = szz_process_file(old_file_SHA, old_file_path_in_ss,
-                                    old_files_path, old_file_fullnames[old_file_index],
-                                    new_files_path, ss_path, ss_SHA)
-            all_buggy_lines_fixed_in_ss += temp
+    for unit in units:
+        all_buggy_lines_fixed_in_ss += szz_process_unit(unit)[1] or []
 
     with open(ss_changes_path + '/ss_mappedOntoSSOnly.bugdata', 'wb') as ss_bugdata_outfile:
         pickle.dump(all_buggy_lines_fixed_in_ss, ss_bugdata_outfile)
 
 #--------------------------------------------------------------------------------------------------------------------------
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
+    if len(sys.argv) not in [5, 6, 7]:
         sys.stderr.write("Invalid input args to szz_process_ss.py. Aborting this snapshot.")
     
     print('\nProcessing snapshot ' + sys.argv[1])
-    szz_process_ss(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+    szz_process_ss(*sys.argv[1:7])
     print("Processing done for snapshot " + sys.argv[1])
 
 #--------------------------------------------------------------------------------------------------------------------------
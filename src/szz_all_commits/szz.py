@@ -15,6 +15,10 @@ try:
     from git import Repo
 except ImportError as e:
     raise
+
+sys.path.append("src/util")
+from CommitIndex import getCommitIndex
+from SzzCore import dismemberFilename, pathLeaf, projectRepoPath
     
 #--------------------------------------------------------------------------------------------------------------------------
 def printUsage():
@@ -31,36 +35,6 @@ def printUsage():
     """
     print(printUsage.__doc__)
 #--------------------------------------------------------------------------------------------------------------------------
-def dismemberFilename(myname, mode):
-    """ 
-    Breaks down a complicated filename and returns a 2-element list consisting of the filename-component and the SHA-component
-    
-    If mode == 'learn', given a string of the form "s1__s2__s3.c", it returns ['s1/s2/s3.c', -1]
-    If mode == 'old', given a string of the form "s1__s2__s3__SHA.c", it returns ['s1/s2/s3.c', SHA]
-
-    NOTE: Since the s_i's represent the location of the file in the project directory structure, 'i' is not fixed. Thus, we may have just s1 and s2. Or we may have s1 through s4.
-    
-    Args
-    ----
-    myname: string
-        Full name of a file in the `learn` or `test/old` directories of some project corpus
-    mode: string
-        A string indicating whether `myname` comes from `learn` or `test/old` directories.
-    """
-    if mode == 'learn':
-        return [pathLeaf(myname).replace('__', '/'), -1]
-    elif mode == 'old':
-        filename_parts = myname.split('__')     # ['s1', 's2', 's3', 'SHA.c']
-        SHA_and_extension = filename_parts[-1].split('.')       # ['SHA', 'c']
-        return ['/'.join(filename_parts[:-1]) + '.' + SHA_and_extension[1], SHA_and_extension[0]]
-
-#--------------------------------------------------------------------------------------------------------------------------
-def pathLeaf(path):
-    """Returns the basename of the file/directory path in an _extremely_ robust way. For example, pathLeaf('/hame/saheel/git_repos/szz/abc.c/') will return 'abc.c'."""
-    head, tail = ntpath.split(path)
-    return tail or ntpath.basename(head)
-
-#--------------------------------------------------------------------------------------------------------------------------
 def Popen_and_print(cmd):
     process = Popen(cmd, stdout=PIPE, stderr=PIPE, close_fds=True)
 
@@ -150,6 +124,9 @@ def szz(project_corpus_path, project_snapshots_path, bugfix_SHAs_filename, \
     with open(project_corpus_path + 'mapped_commits.txt', 'wb') as outfile:
         outfile.write('\n'.join(old_file_SHAs_forall_ss) + '\n')
 
+    # Build (or refresh) the project's commit index once, before the snapshots are processed in parallel
+    getCommitIndex(projectRepoPath(ss_paths[0]))
+
     # Wait for processes to complete
     pool = Pool(int(num_of_cores))
     processes = []
@@ -1,86 +1,19 @@
 #--------------------------------------------------------------------------------------------------------------------------
-import os, sys, ntpath, subprocess, shlex, re, pickle, csv
+import os, sys, subprocess, shlex, re, pickle, csv
 from subprocess import Popen, PIPE
 from collections import defaultdict
 from pprint import pprint
 
-try:
-    from git import Repo
-except ImportError as e:
-    raise e
+sys.path.append("src/util")
+from CommitIndex import getCommitIndex
+from ReverseBlameCache import getReverseBlameCache
+from SzzCore import Blamer, AncestryPathTargets, mapOntoTargets, dismemberFilename, pathLeaf, projectRepoPath
     
-#--------------------------------------------------------------------------------------------------------------------------
-def dismemberFilename(myname, mode):
-    """ 
-    Breaks down a complicated filename and returns a 2-element list consisting of the filename-component and the SHA-component
-    
-    If mode == 'learn', given a string of the form "s1__s2__s3.c", it returns ['s1/s2/s3.c', -1]
-    If mode == 'old', given a string of the form "s1__s2__s3__SHA.c", it returns ['s1/s2/s3.c', SHA]
-
-    NOTE: Since the s_i's represent the location of the file in the project directory structure, 'i' is not fixed. Thus, we may have just s1 and s2. Or we may have s1 through s4.
-    
-    Args
-    ----
-    myname: string
-        Full name of a file in the `learn` or `test/old` directories of some project corpus
-    mode: string
-        A string indicating whether `myname` comes from `learn` or `test/old` directories.
-    """
-    if mode == 'learn':
-        return [pathLeaf(myname).replace('__', '/'), -1]
-    elif mode == 'old':
-        filename_parts = myname.split('__')     # ['s1', 's2', 's3', 'SHA.c']
-        SHA_and_extension = filename_parts[-1].split('.')       # ['SHA', 'c']
-        return ['/'.join(filename_parts[:-1]) + '.' + SHA_and_extension[1], SHA_and_extension[0]]
-
-#--------------------------------------------------------------------------------------------------------------------------
-def pathLeaf(path):
-    """Returns the basename of the file/directory path in an _extremely_ robust way. For example, pathLeaf('/hame/saheel/git_repos/szz/abc.c/') will return 'abc.c'."""
-    head, tail = ntpath.split(path)
-    return tail or ntpath.basename(head)
-
-#--------------------------------------------------------------------------------------------------------------------------
-def szz_reverse_blame(ss_path, sha_to_map_onto, buggy_linums, buggy_file_path, buggy_SHA):
-    """Reverse-blames `buggy_linums` (added in `buggy_file_path` in `buggy_SHA`)  onto `sha_to_map_onto`."""
-    ss_repo = Repo(ss_path)
-    # If `buggy_SHA` equals `sha_to_map_onto`, then git-blame-reverse fails.
-    if sha_to_map_onto != buggy_SHA:
-        blame_options = []
-        for linum in buggy_linums:
-            blame_options.append('-L' + linum + ',+1')
-        blame_options += [buggy_SHA + '..' + sha_to_map_onto, '--', buggy_file_path]
-        
-        try:
-            blame_infos = ss_repo.git.blame('--reverse', '-w', '-n', '-f', '--abbrev=40', \
-                                            stdout_as_string = False, *blame_options)
-        except Exception as e:
-            print('Error while reverse-blaming! Skipping this (buggy_SHA, buggy_file_path) pair...') 
-            print(str(e))
-            return None
-
-        buggy_tuples = []
-        blame_infos = blame_infos.splitlines()
-        if len(blame_infos) != len(buggy_linums):
-            print('Minor error... something weird happened while reverse-blaming. Please check!')
-            return None
-
-        for index, blame_info in enumerate(blame_infos):
-            mapped_buggy_line_num = blame_info.split('(')[0].split()[-1]
-            mapped_buggy_file_path = ' '.join(blame_info.split('(')[0].split()[1:-1])
-            buggy_tuples.append([sha_to_map_onto, mapped_buggy_file_path, mapped_buggy_line_num, \
-                                 buggy_SHA, buggy_file_path, buggy_linums[index]])
-            
-        return buggy_tuples
-
-    else:
-        return [[sha_to_map_onto, buggy_file_path, linum, buggy_SHA, buggy_file_path, linum] for linum in buggy_linums]
-
 #--------------------------------------------------------------------------------------------------------------------------
 def szz_process_file(old_file_SHA, old_file_path_in_ss, old_files_path, old_file_fullname, new_files_path,
-                     ss_path, ss_SHA, mapped_commits):
-    """Returns buggy tuples corresponding to the lines deleted in `old_file_path_in_ss`"""
+                     ss_path, ss_SHA, blamer, targets):
+    """Returns buggy tuples corresponding to the lines deleted in `old_file_path_in_ss`, blamed by `blamer` (a `SzzCore.Blamer`) and mapped onto the commits that `targets` (a `SzzCore.AncestryPathTargets`) chooses"""
 
-    ss_repo = Repo(ss_path)
     mapped_buggy_tuples = []
     bugfix_SHA = old_file_SHA
     this_ss_name = pathLeaf(ss_path)
@@ -92,70 +25,47 @@ def szz_process_file(old_file_SHA, old_file_path_in_ss, old_files_path, old_file
                    + new_files_path + old_file_fullname
     process = Popen(shlex.split(diff_command), stdout=PIPE, close_fds=True)
     line_nums = process.communicate()[0].split()
-
-    # Blame the deleted lines so as to know which commit(s) added them
-    blame_options = []
-    for line_num in line_nums:
-        blame_options.append('-L' + line_num + ',+1')
-    blame_options += [bugfix_SHA + '^', '--', old_file_path_in_ss]
+    if not line_nums:
+        return mapped_buggy_tuples
 
     # Blame the buggy lines to get the bug-introducing `buggy_sha`
     # Then, reverse-blame them to find buggy lines...
     # ...present in various commits between the buggy and bugfixing commit
-    try:
-        blame_infos = ss_repo.git.blame('-w', '-n', '-f', '--abbrev=40', \
-                                        stdout_as_string = False, \
-                                        *blame_options)
-    except Exception, e:
-        print("\nError! Continuing with next line_num...\n" + str(e))
-        return None
+    blamed_lines = blamer.blameLines(bugfix_SHA + '^', old_file_path_in_ss, line_nums, blameOptions=('-w',))
 
     # This dictionary maps (buggy_SHA, buggy_file_path_in_ss) to the list of line numbers...
     # ...of the buggy lines added in `buggy_file_path_in_ss` in `buggy_SHA`
     linums_in_sha_file_pair = defaultdict(list)
-    buggy_SHAs = set()
-    for blame_info in blame_infos.splitlines():
-        buggy_SHA = blame_info.split()[0][-40:]
-        buggy_file_path_in_ss = ' '.join(blame_info.split('(')[0].split()[1:-1])
-        buggy_line_num = blame_info.split('(')[0].split()[-1]
-        linums_in_sha_file_pair[(buggy_SHA, buggy_file_path_in_ss)].append(buggy_line_num)
-        buggy_SHAs.add(buggy_SHA)
-
-    shas_to_map_onto = defaultdict(list)
-    for buggy_SHA in buggy_SHAs:
-        # Get SHAs of all commits _between_ `buggy_SHA` and `bugfix_SHA`
-        all_inbetween_commits = ss_repo.git.log('--reverse', '--ancestry-path', '--format=%H', '--abbrev=40', \
-                                                buggy_SHA + '..' + bugfix_SHA) 
-        all_inbetween_commits = set(all_inbetween_commits.split()[:-1]) # <-- slicing removes `bugfix_SHA` from the list 
-        relevant_commits = set.intersection(all_inbetween_commits, mapped_commits)
-        shas_to_map_onto[buggy_SHA] += list(relevant_commits)
-
-    for bsha, fpath in linums_in_sha_file_pair.keys():
-        for sha_to_map_onto in shas_to_map_onto[bsha]:
-            linums = linums_in_sha_file_pair[(bsha, fpath)]
-            buggy_tuples = szz_reverse_blame(ss_path, sha_to_map_onto, linums, \
-                                             fpath, bsha)
-            if buggy_tuples is not None:
-                mapped_buggy_tuples += [buggy_tuple + ['1', this_ss_name, old_file_SHA, old_file_path_in_ss, linums[index]] \
-                                        for index, buggy_tuple in enumerate(buggy_tuples)]
+    for line_num in line_nums:
+        if line_num in blamed_lines:
+            buggy_SHA, buggy_file_path_in_ss, buggy_line_num = blamed_lines[line_num]
+            linums_in_sha_file_pair[(buggy_SHA, buggy_file_path_in_ss)].append(buggy_line_num)
+
+    # Map onto all mapped commits _between_ `buggy_SHA` and `bugfix_SHA` (excluding `bugfix_SHA`) on their ancestry path
+    for (bsha, fpath), linums in linums_in_sha_file_pair.items():
+        for _, sha_to_map_onto, mapped_lines in mapOntoTargets(blamer, targets, bsha, fpath, bugfix_SHA, linums):
+            # Like before, the buggy lines are only used if all of them could be reverse-blamed
+            if all(linum in mapped_lines for linum in linums):
+                mapped_buggy_tuples += [[sha_to_map_onto, mapped_lines[linum][0], mapped_lines[linum][1], bsha, fpath, linum,
+                                         '1', this_ss_name, old_file_SHA, old_file_path_in_ss, linum] for linum in linums]
 
     return mapped_buggy_tuples
 
 #--------------------------------------------------------------------------------------------------------------------------
 def szz_process_ss(ss_name, ss_path, ss_corpus_path, bugfix_SHAs_filename):
-    bugfix_SHAs = [SHA for SHA in open(bugfix_SHAs_filename).read().splitlines()]
+    bugfix_SHAs = set(open(bugfix_SHAs_filename).read().splitlines())
     all_buggy_lines_fixed_in_ss = []
 
-    # Git repo for current ss
+    # The SHA of the snapshot comes from `ss_sha_info.txt`, written by dump.py; the snapshot itself is not opened
+    project_snapshots_dir = os.path.dirname(os.path.dirname(ss_path))
     try:
-        ss_repo = Repo(ss_path)
+        with open(os.path.join(project_snapshots_dir, 'ss_sha_info.txt'), 'rb') as ss_sha_info_file:
+            ss_SHA = pickle.load(ss_sha_info_file)[ss_name]
     except Exception as e:
-        sys.stderr.write("\nApparently, " + ss_path + " is not a valid git repo. Skipping this snapshot...")
+        sys.stderr.write("\nNo SHA found for the snapshot " + ss_name + " in `ss_sha_info.txt`. Skipping this snapshot...")
         sys.stderr.write(str(e))
         return
 
-    ss_SHA = ss_repo.git.log('--format=%H', '-n', '1')
-
     # Get metadata on the files in ss/test/old and ss/test/new in order to process the buggy lines
     old_file_paths_in_ss = []
     old_file_SHAs = []
@@ -182,6 +92,13 @@ def szz_process_ss(ss_name, ss_path, ss_corpus_path, bugfix_SHAs_filename):
     with open(project_corpus_path + 'mapped_commits.txt', 'rb') as infile:
         mapped_commits = [commit.strip() for commit in infile.readlines() if commit.strip()]
 
+    # The files of this snapshot share one git handle, and the project's reverse-blame cache in `data/cache/`
+    # Blames run against the project clone in `data/projects/`, whose object store all snapshots share
+    cache = getReverseBlameCache(os.path.dirname(os.path.dirname(project_snapshots_dir)), pathLeaf(project_snapshots_dir))
+    project_repo_path = projectRepoPath(ss_path)
+    blamer = Blamer(project_repo_path, cache)
+    targets = AncestryPathTargets(mapped_commits, getCommitIndex(project_repo_path))
+
     # Start processing the ss/test/old files
     for old_file_index, old_file_path_in_ss in enumerate(old_file_paths_in_ss):
         old_file_SHA = old_file_SHAs[old_file_index]
@@ -189,7 +106,7 @@ def szz_process_ss(ss_name, ss_path, ss_corpus_path, bugfix_SHAs_filename):
             print(old_file_path_in_ss)
             temp = szz_process_file(old_file_SHA, old_file_path_in_ss,
                                     old_files_path, old_file_fullnames[old_file_index],
-                                    new_files_path, ss_path, ss_SHA, mapped_commits)
+                                    new_files_path, ss_path, ss_SHA, blamer, targets)
             if temp is not None:
                 all_buggy_lines_fixed_in_ss += temp
 
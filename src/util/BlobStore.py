@@ -0,0 +1,110 @@
+import os
+import sys
+import errno
+import shutil
+import threading
+
+from GitCatFile import getGitCatFile
+import Util
+
+# Name of the file, in each directory populated from a store, that records which blob backs each file
+BLOB_MANIFEST = 'blob_manifest.tsv'
+
+
+class BlobStore:
+  """
+  Content-addressed store of the file contents (git blobs) of one project, under `data/blobs/<project>/`.
+
+  Each distinct blob is written once, at `<root>/<first 2 hex digits>/<other 38>`, and snapshot and corpus directories
+  are populated with hard links to it; consecutive snapshots share most of their files, so most links point to blobs
+  that are already there. Where a hard link cannot be made (ex. across file systems), the blob is copied instead.
+
+  Every directory that gets a file also gets a line "<blob SHA>\t<file name>" in its `BLOB_MANIFEST`, so that later
+  stages can process each distinct blob once. Files in the store must never be modified in place.
+  """
+
+  def __init__(self, root, repoPath):
+    self.root = root
+    self.repo_path = repoPath
+    self.manifests = {}
+    self.lock = threading.Lock()
+
+  def path(self, blobSha):
+    """Returns the path of blob `blobSha` in the store."""
+    return os.path.join(self.root, blobSha[:2], blobSha[2:])
+
+  def add(self, blobSha):
+    """Writes blob `blobSha` into the store, unless it is there already. Returns its path in the store, or None if the repo has no such blob."""
+    store_path = self.path(blobSha)
+    if os.path.exists(store_path):
+      return store_path
+
+    Util.create_dir(os.path.dirname(store_path))
+    # Write under a name of our own and rename, so that a concurrent writer never sees a partial blob
+    tmp_path = '%s.%d.%d.tmp' % (store_path, os.getpid(), threading.current_thread().ident)
+    if not getGitCatFile(self.repo_path).dumpBlob(blobSha, tmp_path):
+      os.remove(tmp_path)
+      return None
+    os.rename(tmp_path, store_path)
+    return store_path
+
+  def link(self, blobSha, destination):
+    """Makes `destination` a hard link to (or else a copy of) blob `blobSha`, and records it in the manifest of its directory. Returns False if the repo has no such blob."""
+    store_path = self.add(blobSha)
+    if store_path is None:
+      return False
+
+    if os.path.lexists(destination):
+      os.remove(destination)
+    try:
+      os.link(store_path, destination)
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+        raise
+      shutil.copyfile(store_path, destination)
+
+    with self.lock:
+      dir_path, file_name = os.path.split(os.path.abspath(destination))
+      self.manifests.setdefault(dir_path, []).append((blobSha, file_name))
+    return True
+
+  def writeManifests(self):
+    """Appends the files linked since the last call to the `BLOB_MANIFEST` of their directories."""
+    with self.lock:
+      manifests, self.manifests = self.manifests, {}
+    for dir_path, entries in manifests.items():
+      with open(os.path.join(dir_path, BLOB_MANIFEST), 'ab') as manifest_file:
+        manifest_file.write(''.join('%s\t%s\n' % entry for entry in entries))
+
+
+def readManifest(dirPath):
+  """Returns a dictionary that maps the file names in `dirPath` to the SHAs of the blobs backing them, as recorded in its `BLOB_MANIFEST`."""
+  manifest_path = os.path.join(dirPath, BLOB_MANIFEST)
+  if not os.path.isfile(manifest_path):
+    return {}
+  with open(manifest_path, 'rb') as manifest_file:
+    return dict((file_name, blob_sha) for blob_sha, file_name in
+                (line.rstrip('\n').split('\t', 1) for line in manifest_file if line.strip()))
+
+
+# One store per repository per process; see `getBlobStore()`
+_stores = {}
+
+def getBlobStore(repoPath):
+  """Returns the blob store of the project whose clone is at `repoPath` (`data/projects/<project>`): `data/blobs/<project>/`."""
+  repo_path = os.path.abspath(repoPath)
+  key = (os.getpid(), repo_path)
+  if key not in _stores:
+    data_dir = os.path.dirname(os.path.dirname(repo_path))
+    _stores[key] = BlobStore(os.path.join(data_dir, 'blobs', os.path.basename(repo_path)), repo_path)
+  return _stores[key]
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 2:
+    print("!! please give a directory populated from a blob store")
+    sys.exit()
+
+  manifest = readManifest(sys.argv[1])
+  print("%s: %d files backed by %d distinct blobs" % (sys.argv[1], len(manifest), len(set(manifest.values()))))
@@ -0,0 +1,406 @@
+import os
+import sys
+import shutil
+import logging
+import tempfile
+from subprocess import Popen, PIPE, check_call, check_output
+
+import numpy
+
+
+def _key(sha):
+  """Returns `sha` in the dtype of the `shas` array (bytes)."""
+  if isinstance(sha, bytes):
+    return sha
+  return sha.encode('ascii', 'replace')
+
+
+def _str(data):
+  if isinstance(data, str):
+    return data
+  return data.decode('utf-8', 'replace')
+
+
+class CommitIndex:
+  """
+  Compact, on-disk index of the commit metadata of one git repository.
+
+  It is built from a single `git log --all` pass and stored as a directory of .npy files that are memory-mapped
+  on load, so every process of a run shares one copy through the page cache. Commits are numbered by their
+  position in the sorted `shas` array. Per commit, it keeps:
+
+    shas            - 40-char SHA (sorted; a SHA is looked up with a binary search)
+    author_dates    - author date, YYYY-MM-DD, as `git log --date=short` prints it
+    author_times    - author timestamp
+    committer_times - committer timestamp
+    parent_offsets  - parents of commit i are parents[parent_offsets[i]:parent_offsets[i + 1]] (commit numbers)
+    child_offsets   - children of commit i are children[child_offsets[i]:child_offsets[i + 1]] (commit numbers)
+    topo_ranks      - position in a topological order (parents before children)
+    generations     - 1 for root commits, else 1 + the largest generation of the parents
+
+  Together, the parent and child arrays are the commit graph (DAG) in CSR form. Generation numbers let ancestry
+  queries skip everything that cannot possibly be on the path, so `isAncestor()` and `ancestryPath()` answer in
+  memory what `git merge-base --is-ancestor` and `git log --ancestry-path` would answer with a fork and a full walk.
+  """
+
+  # Bump this whenever the set of arrays (or their meaning) changes, so that old indexes get rebuilt
+  VERSION = 2
+  LOG_FORMAT = '%H|%P|%ad|%at|%ct'
+  ARRAYS = ['shas', 'author_dates', 'author_times', 'committer_times',
+            'parent_offsets', 'parents', 'child_offsets', 'children', 'topo_ranks', 'generations']
+
+  def __init__(self, indexPath):
+    self.index_path = indexPath
+    for name in self.ARRAYS:
+      setattr(self, name, numpy.load(os.path.join(indexPath, name + '.npy'), mmap_mode='r'))
+
+  def __len__(self):
+    return len(self.shas)
+
+  @staticmethod
+  def defaultIndexPath(repoPath):
+    return os.path.join(repoPath, '.git', 'szz_commit_index')
+
+  @staticmethod
+  def fingerprint(repoPath):
+    """Returns a string that changes whenever the set of commits reachable from the refs (or HEAD) of the repo changes."""
+    refs = check_output(['git', 'for-each-ref', '--format=%(objectname) %(refname)'], cwd=repoPath)
+    head = check_output(['git', 'rev-parse', 'HEAD'], cwd=repoPath)
+    return 'version %d\n' % CommitIndex.VERSION + _str(head) + _str(refs)
+
+  @classmethod
+  def forRepo(cls, repoPath, indexPath=None):
+    """Loads the index of the repo at `repoPath`, (re)building it first if it is missing or out of date."""
+    if indexPath is None:
+      indexPath = cls.defaultIndexPath(repoPath)
+
+    fingerprint = cls.fingerprint(repoPath)
+    fingerprint_path = os.path.join(indexPath, 'fingerprint.txt')
+    if not os.path.isfile(fingerprint_path) or open(fingerprint_path).read() != fingerprint:
+      cls.build(repoPath, indexPath, fingerprint)
+    return cls(indexPath)
+
+  @classmethod
+  def build(cls, repoPath, indexPath, fingerprint=None):
+    """Builds the index of the repo at `repoPath` with a single `git log` and writes it to the `indexPath` directory."""
+    logging.info("Building commit index of %s in %s" % (repoPath, indexPath))
+    if fingerprint is None:
+      fingerprint = cls.fingerprint(repoPath)
+
+    # `--topo-order` lists children before their parents
+    process = Popen(['git', 'log', '--all', '--topo-order', '--date=short', '--format=' + cls.LOG_FORMAT],
+                    cwd=repoPath, stdout=PIPE, close_fds=True)
+    log_shas = []
+    log_parents = []
+    log_author_dates = []
+    log_author_times = []
+    log_committer_times = []
+    for line in process.stdout:
+      sha, parents, author_date, author_time, committer_time = _str(line).rstrip('\n').split('|')
+      log_shas.append(sha)
+      log_parents.append(parents.split())
+      log_author_dates.append(author_date)
+      log_author_times.append(int(author_time))
+      log_committer_times.append(int(committer_time))
+    if process.wait() != 0:
+      raise ValueError("`git log` failed while building the commit index of " + repoPath)
+
+    num_of_commits = len(log_shas)
+    shas = numpy.array(log_shas, dtype='S40')
+    order = numpy.argsort(shas, kind='mergesort')   # commit number -> position in the log
+    ids = numpy.empty(num_of_commits, dtype=numpy.int64)
+    ids[order] = numpy.arange(num_of_commits)         # position in the log -> commit number
+    sha_to_id = dict(zip(log_shas, ids.tolist()))
+
+    parent_offsets = numpy.zeros(num_of_commits + 1, dtype=numpy.int64)
+    parents = []
+    for commit_id, log_position in enumerate(order.tolist()):
+      # Parents missing from the log (ex. cut off by a shallow clone) are dropped
+      parents += [sha_to_id[parent] for parent in log_parents[log_position] if parent in sha_to_id]
+      parent_offsets[commit_id + 1] = len(parents)
+    parents = numpy.array(parents, dtype=numpy.int32)
+
+    # Invert the parent edges: sort the (child, parent) pairs by parent
+    edge_children = numpy.repeat(numpy.arange(num_of_commits, dtype=numpy.int32), numpy.diff(parent_offsets))
+    children = edge_children[numpy.argsort(parents, kind='mergesort')]
+    child_offsets = numpy.zeros(num_of_commits + 1, dtype=numpy.int64)
+    child_offsets[1:] = numpy.cumsum(numpy.bincount(parents, minlength=num_of_commits))
+
+    # Walking the log backwards visits parents before children
+    topo_ranks = numpy.empty(num_of_commits, dtype=numpy.int32)
+    generations = numpy.zeros(num_of_commits, dtype=numpy.int32)
+    for rank, log_position in enumerate(range(num_of_commits - 1, -1, -1)):
+      commit_id = ids[log_position]
+      topo_ranks[commit_id] = rank
+      commit_parents = parents[parent_offsets[commit_id]:parent_offsets[commit_id + 1]]
+      generations[commit_id] = 1 + (generations[commit_parents].max() if len(commit_parents) else 0)
+
+    arrays = {'shas': shas[order],
+              'author_dates': numpy.array(log_author_dates, dtype='S10')[order],
+              'author_times': numpy.array(log_author_times, dtype=numpy.int64)[order],
+              'committer_times': numpy.array(log_committer_times, dtype=numpy.int64)[order],
+              'parent_offsets': parent_offsets,
+              'parents': parents,
+              'child_offsets': child_offsets,
+              'children': children,
+              'topo_ranks': topo_ranks,
+              'generations': generations}
+
+    # Write to a temporary directory first, so that concurrent readers never see a half-written index
+    tmp_path = indexPath.rstrip(os.sep) + '.tmp.' + str(os.getpid())
+    if os.path.isdir(tmp_path):
+      shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in cls.ARRAYS:
+      numpy.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+    with open(os.path.join(tmp_path, 'fingerprint.txt'), 'w') as fingerprint_file:
+      fingerprint_file.write(fingerprint)
+
+    if os.path.isdir(indexPath):
+      shutil.rmtree(indexPath, ignore_errors=True)
+    try:
+      os.rename(tmp_path, indexPath)
+    except OSError:
+      # Somebody else built it at the same time
+      shutil.rmtree(tmp_path, ignore_errors=True)
+
+  def idOf(self, sha):
+    """Returns the commit number of `sha`, or -1 if it is not in the index."""
+    key = _key(sha)
+    if len(key) != 40:
+      return -1
+    commit_id = int(numpy.searchsorted(self.shas, key))
+    if commit_id < len(self.shas) and self.shas[commit_id] == key:
+      return commit_id
+    return -1
+
+  def shaOf(self, commitId):
+    return _str(self.shas[commitId])
+
+  def __contains__(self, sha):
+    return self.idOf(sha) >= 0
+
+  def authorDate(self, sha):
+    """Returns the author date (YYYY-MM-DD) of `sha`, or '' if it is not in the index (like `git log -n 1 --format=%ad --date=short` would)."""
+    commit_id = self.idOf(sha)
+    if commit_id < 0:
+      return ''
+    return _str(self.author_dates[commit_id])
+
+  def idsOf(self, shas):
+    """Vectorized `idOf()`: returns an array with the commit number of each of `shas` (-1 where it is not in the index)."""
+    # One extra character, so that longer strings do not match after being cut to 40 characters
+    keys = numpy.asarray(shas).astype('S41')
+    if len(self.shas) == 0:
+      return numpy.full(len(keys), -1, dtype=numpy.int64)
+    ids = numpy.minimum(numpy.searchsorted(self.shas, keys.astype('S40')), len(self.shas) - 1)
+    return numpy.where(self.shas[ids] == keys, ids, -1)
+
+  def authorDates(self, shas):
+    """Vectorized `authorDate()`: returns an array with the author date (YYYY-MM-DD) of each of `shas` ('' where it is not in the index)."""
+    ids = self.idsOf(shas)
+    dates = self.author_dates[numpy.maximum(ids, 0)].astype(str) if len(self.author_dates) else numpy.full(len(ids), '', dtype=str)
+    dates[ids < 0] = ''
+    return dates
+
+  def parentIds(self, commitId):
+    return self.parents[self.parent_offsets[commitId]:self.parent_offsets[commitId + 1]]
+
+  def parentsOf(self, sha):
+    """Returns the list of the parents of `sha` (an empty list if it is not in the index)."""
+    commit_id = self.idOf(sha)
+    if commit_id < 0:
+      return []
+    return [self.shaOf(parent_id) for parent_id in self.parentIds(commit_id)]
+
+  def childIds(self, commitId):
+    return self.children[self.child_offsets[commitId]:self.child_offsets[commitId + 1]]
+
+  def isAncestor(self, ancestorSha, sha):
+    """Returns True if `ancestorSha` is `sha` or one of its ancestors (like `git merge-base --is-ancestor`)."""
+    ancestor_id = self.idOf(ancestorSha)
+    commit_id = self.idOf(sha)
+    if ancestor_id < 0 or commit_id < 0:
+      return False
+
+    # Generation numbers strictly decrease along parent edges, so nothing below the ancestor's generation can lead to it
+    min_generation = self.generations[ancestor_id]
+    stack = [commit_id]
+    visited = set(stack)
+    while stack:
+      curr_id = stack.pop()
+      if curr_id == ancestor_id:
+        return True
+      for parent_id in self.parentIds(curr_id).tolist():
+        if parent_id not in visited and self.generations[parent_id] >= min_generation:
+          visited.add(parent_id)
+          stack.append(parent_id)
+    return False
+
+
+  def ancestryPathIds(self, ancestorId, commitId):
+    """
+    Returns the set of commit numbers on the ancestry path from `ancestorId` (excluded) to `commitId` (included).
+
+    These are the commits that are both descendants of `ancestorId` and ancestors of (or equal to) `commitId`.
+    """
+    # 1. Ancestors of `commitId` down to (but not below) the generation of `ancestorId`
+    min_generation = self.generations[ancestorId] + 1
+    ancestors = set([commitId]) if self.generations[commitId] >= min_generation else set()
+    stack = list(ancestors)
+    while stack:
+      curr_id = stack.pop()
+      for parent_id in self.parentIds(curr_id).tolist():
+        if parent_id not in ancestors and self.generations[parent_id] >= min_generation:
+          ancestors.add(parent_id)
+          stack.append(parent_id)
+
+    # 2. Descendants of `ancestorId`, but only among those ancestors
+    on_path = set()
+    stack = [ancestorId]
+    while stack:
+      curr_id = stack.pop()
+      for child_id in self.childIds(curr_id).tolist():
+        if child_id in ancestors and child_id not in on_path:
+          on_path.add(child_id)
+          stack.append(child_id)
+    return on_path
+
+  def ancestryPath(self, ancestorSha, sha):
+    """
+    Returns the SHAs of the commits on the ancestry path between `ancestorSha` and `sha`, oldest first.
+
+    This is what `git log --reverse --ancestry-path ancestorSha..sha` lists (in a topological order), so `sha` itself is
+    the last element. The list is empty if `ancestorSha` is not an ancestor of `sha`, or either of them is unknown.
+    """
+    ancestor_id = self.idOf(ancestorSha)
+    commit_id = self.idOf(sha)
+    if ancestor_id < 0 or commit_id < 0:
+      return []
+    on_path = sorted(self.ancestryPathIds(ancestor_id, commit_id), key=lambda curr_id: self.topo_ranks[curr_id])
+    return [self.shaOf(curr_id) for curr_id in on_path]
+
+  def firstParentChain(self, ancestorSha, sha):
+    """
+    Returns the SHAs of the commits from `ancestorSha` (excluded) to `sha` (included) following first parents, oldest first.
+
+    This is what `git log --reverse --first-parent ancestorSha..sha` lists when `ancestorSha` is on the first-parent
+    chain of `sha`. If it is not (or either of them is unknown), returns None.
+    """
+    ancestor_id = self.idOf(ancestorSha)
+    commit_id = self.idOf(sha)
+    if ancestor_id < 0 or commit_id < 0:
+      return None
+
+    min_generation = self.generations[ancestor_id]
+    chain = []
+    curr_id = commit_id
+    while curr_id != ancestor_id:
+      parent_ids = self.parentIds(curr_id)
+      if len(parent_ids) == 0 or self.generations[curr_id] <= min_generation:
+        return None
+      chain.append(curr_id)
+      curr_id = int(parent_ids[0])
+    chain.reverse()
+    return [self.shaOf(curr_id) for curr_id in chain]
+
+  def shasOnAncestryPath(self, ancestorSha, sha, candidateShas):
+    """Returns the set of `candidateShas` (ex. snapshot SHAs) that lie strictly between `ancestorSha` and `sha` on their ancestry path."""
+    ancestor_id = self.idOf(ancestorSha)
+    commit_id = self.idOf(sha)
+    if ancestor_id < 0 or commit_id < 0:
+      return set()
+
+    # Only candidates whose generation lies between the two ends can possibly be on the path
+    min_generation = self.generations[ancestor_id]
+    max_generation = self.generations[commit_id]
+    candidate_ids = set()
+    for candidate_sha in candidateShas:
+      candidate_id = self.idOf(candidate_sha)
+      if candidate_id >= 0 and candidate_id != commit_id and min_generation < self.generations[candidate_id] < max_generation:
+        candidate_ids.add(candidate_id)
+    if not candidate_ids:
+      return set()
+
+    on_path = self.ancestryPathIds(ancestor_id, commit_id)
+    return set(self.shaOf(candidate_id) for candidate_id in candidate_ids if candidate_id in on_path)
+
+
+# One index per repository per process; see `getCommitIndex()`
+_indexes = {}
+
+def getCommitIndex(repoPath, indexPath=None):
+  """Returns the CommitIndex shared by everyone in this process for the repository at `repoPath`."""
+  key = os.path.abspath(repoPath)
+  if key not in _indexes:
+    _indexes[key] = CommitIndex.forRepo(repoPath, indexPath)
+  return _indexes[key]
+
+
+def test():
+  repo_path = tempfile.mkdtemp()
+  try:
+    def commit(day, message, args=()):
+      date = '2015-03-%02dT12:00:00 +0000' % day
+      env = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@a', GIT_AUTHOR_DATE=date,
+                 GIT_COMMITTER_NAME='c', GIT_COMMITTER_EMAIL='c@c', GIT_COMMITTER_DATE=date)
+      check_call(['git'] + list(args or ['commit', '-q', '--allow-empty', '-m', message]), cwd=repo_path, env=env)
+      return _str(check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_path)).strip()
+
+    # c1 <- c2 <- merge, and c1 <- side <- merge
+    check_call(['git', 'init', '-q'], cwd=repo_path)
+    c1 = commit(1, 'c1')
+    check_call(['git', 'branch', 'side'], cwd=repo_path)
+    c2 = commit(2, 'c2')
+    check_call(['git', 'checkout', '-q', 'side'], cwd=repo_path)
+    side = commit(3, 'side')
+    check_call(['git', 'checkout', '-q', '-'], cwd=repo_path)
+    merge = commit(4, 'merge', ['merge', '-q', '--no-ff', '-m', 'merge', 'side'])
+    unknown = '0' * 40
+
+    index = CommitIndex.forRepo(repo_path)
+    assert len(index) == 4
+    assert index.authorDate(c1) == '2015-03-01' and index.authorDate(merge) == '2015-03-04'
+    assert unknown not in index and index.authorDate(unknown) == '' and index.authorDate(c1[:7]) == ''
+    assert list(index.authorDates([c2, unknown, c1[:7]])) == ['2015-03-02', '', '']
+    assert list(index.idsOf([unknown, side])) == [-1, index.idOf(side)]
+
+    assert index.parentsOf(merge) == [c2, side] and index.parentsOf(c1) == [] and index.parentsOf(unknown) == []
+    assert index.isAncestor(c1, merge) and index.isAncestor(merge, merge)
+    assert not index.isAncestor(side, c2) and not index.isAncestor(merge, c1) and not index.isAncestor(unknown, merge)
+
+    ancestry_path = index.ancestryPath(c1, merge)
+    assert sorted(ancestry_path[:-1]) == sorted([c2, side]) and ancestry_path[-1] == merge
+    assert index.ancestryPath(side, c2) == [] and index.ancestryPath(unknown, merge) == []
+    assert index.firstParentChain(c1, merge) == [c2, merge]
+    assert index.firstParentChain(side, merge) is None and index.firstParentChain(c1, unknown) is None
+    assert index.shasOnAncestryPath(c1, merge, [c1, c2, side, merge, unknown]) == set([c2, side])
+    assert index.shasOnAncestryPath(c2, merge, [side]) == set()
+
+    # A new commit changes the fingerprint, so the index is rebuilt
+    c5 = commit(5, 'c5')
+    index = CommitIndex.forRepo(repo_path)
+    assert len(index) == 5 and index.parentsOf(c5) == [merge]
+  finally:
+    shutil.rmtree(repo_path)
+  print("CommitIndex: all checks passed")
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 2:
+    print("!! please give the path to a git repository, or --test")
+    sys.exit()
+
+  if sys.argv[1] == '--test':
+    test()
+    sys.exit()
+
+  index = getCommitIndex(sys.argv[1])
+  print("%d commits" % len(index))
+  head = _str(check_output(['git', 'rev-parse', 'HEAD'], cwd=sys.argv[1])).strip()
+  print(head, index.authorDate(head), index.parentsOf(head))
+  for parent in index.parentsOf(head):
+    print(parent, index.isAncestor(parent, head), index.isAncestor(head, parent))
+  if len(sys.argv) > 3:
+    print(index.ancestryPath(sys.argv[2], sys.argv[3]))
@@ -4,7 +4,13 @@ import sys
 
 from Config import Config
 
+# Rows fetched per round trip by `DatabaseCon.stream()`
+DEFAULT_FETCH_SIZE = 10000
+
 class DatabaseCon:
+  # Used to give each server-side cursor a name of its own
+  num_of_streams = 0
+
   def __init__(self, db, dbUser, dbHost, dbPort):
     #print "Going to connect to database %s in server %s, for user %s" % (db, dbHost, dbUser)
     #passwrd = raw_input("Please enter password..\n")
@@ -39,6 +45,46 @@ class DatabaseCon:
       raise
       return None
 
+  def fetchOne(self, sql_command):
+    """Like `execute()`, but returns only the first row (ex. of a `SELECT COUNT(*)`), or None if there is none."""
+    logging.debug("Executing SQL command = %s\n", sql_command)
+    cur = self.conn.cursor()
+    try:
+      cur.execute(sql_command)
+      return cur.fetchone()
+    except:
+      print("!! Error executing command %s" % (sql_command))
+      raise
+    finally:
+      cur.close()
+
+  def stream(self, sql_command, fetchSize=DEFAULT_FETCH_SIZE):
+    """
+    Like `execute()`, but yields the rows one at a time instead of returning them all.
+
+    The rows come from a named (server-side) cursor, `fetchSize` at a time, so only that many are held in memory
+    however many the query returns. The cursor lives in the current transaction, and is closed once the rows are
+    exhausted or the generator is closed.
+    """
+    logging.debug("Streaming SQL command = %s\n", sql_command)
+    DatabaseCon.num_of_streams += 1
+    cur = self.conn.cursor(name="stream_%d" % DatabaseCon.num_of_streams)
+    cur.itersize = fetchSize
+    try:
+      try:
+        cur.execute(sql_command)
+      except:
+        print("!! Error executing command %s" % (sql_command))
+        raise
+      while True:
+        rows = cur.fetchmany(fetchSize)
+        if not rows:
+          break
+        for row in rows:
+          yield row
+    finally:
+      cur.close()
+
 
   def test(config_file):
     cfg = Config(config_file)
@@ -0,0 +1,237 @@
+import re
+import sys
+import bisect
+
+# "@@ -<old_start>[,<old_count>] +<new_start>[,<new_count>] @@"; a missing count means 1
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+# Marks the start of a commit in `git log -p --format=` + COMMIT_FORMAT output; a NUL can't start a diff line
+COMMIT_FORMAT = '%x00%H'
+
+# Options that make `git log -p`/`git diff` output parseable by `iterFileDiffs()` regardless of the user's git config
+DIFF_OPTIONS = ['--src-prefix=a/', '--dst-prefix=b/', '--no-color', '--no-ext-diff']
+
+_ESCAPES = {'a': '\a', 'b': '\b', 't': '\t', 'n': '\n', 'v': '\v', 'f': '\f', 'r': '\r', '"': '"', '\\': '\\'}
+
+
+def _str(data):
+  if isinstance(data, str):
+    return data
+  return data.decode('utf-8', 'surrogateescape')
+
+
+def parseHunkHeader(line):
+  """Returns (old_start, old_count, new_start, new_count) for a hunk header line, or None if `line` is not one."""
+  match = HUNK_HEADER.match(line)
+  if match is None:
+    return None
+  old_start, old_count, new_start, new_count = match.groups()
+  return (int(old_start), 1 if old_count is None else int(old_count),
+          int(new_start), 1 if new_count is None else int(new_count))
+
+
+def unquotePath(path):
+  """Undoes git's C-style quoting of unusual file names (ex. "a/tab\\there.c" -> a/tab<TAB>here.c)."""
+  if not (path.startswith('"') and path.endswith('"')):
+    return path
+
+  chars = []
+  pos = 1
+  while pos < len(path) - 1:
+    char = path[pos]
+    if char != '\\':
+      chars.append(char)
+      pos += 1
+    elif path[pos + 1] in _ESCAPES:
+      chars.append(_ESCAPES[path[pos + 1]])
+      pos += 2
+    else:
+      # Octal escape of a byte, ex. \303
+      chars.append(chr(int(path[pos + 1:pos + 4], 8)))
+      pos += 4
+  return ''.join(chars)
+
+
+def _stripPrefix(path):
+  """Turns the path on a ---/+++ line into a file name; returns None for /dev/null."""
+  path = unquotePath(path.rstrip('\n').split('\t')[0])
+  if path == '/dev/null':
+    return None
+  return path[2:]
+
+
+def _headerPaths(header):
+  """
+  Returns the (old_path, new_path) of a "diff --git a/<path> b/<path>" header, or (None, None) if the paths differ.
+
+  The header is only needed for diffs without ---/+++ lines (mode changes, binary files); since a file name may
+  contain " b/", it is trusted only when both halves name the same file.
+  """
+  half = (len(header) - 1) // 2
+  old_path, new_path = unquotePath(header[:half]), unquotePath(header[half + 1:])
+  if header[half] != ' ' or old_path[2:] != new_path[2:]:
+    return (None, None)
+  return (old_path[2:], new_path[2:])
+
+
+def iterFileDiffs(lines):
+  """
+  Parses a stream of unified diff `lines` (ex. the stdout of `git log -p -U0 --format=%x00%H`) one file at a time.
+
+  Yields (sha, old_path, new_path, hunks) for each file, where `sha` is the commit the diff belongs to (None for plain
+  `git diff` output), a path is None if the file did not exist on that side, and `hunks` is the list of
+  (old_start, old_count, new_start, new_count) tuples of the file. The deleted lines of a hunk are old_start ... old_start + old_count - 1.
+  """
+  sha = None
+  file_diff = None
+  lines = iter(lines)
+  for line in lines:
+    line = _str(line)
+
+    if line.startswith('\0'):
+      if file_diff is not None:
+        yield tuple(file_diff)
+        file_diff = None
+      sha = line[1:].strip()
+
+    elif line.startswith('diff '):
+      if file_diff is not None:
+        yield tuple(file_diff)
+      file_diff = [sha] + list(_headerPaths(line.rstrip('\n').split(' ', 2)[2])) + [[]]
+
+    elif file_diff is None:
+      continue
+
+    elif line.startswith('new file mode'):
+      file_diff[1] = None
+
+    elif line.startswith('deleted file mode'):
+      file_diff[2] = None
+
+    # A rename (or copy) without content changes has no ---/+++ lines, and its "diff --git" header names two files
+    elif line.startswith(('rename from ', 'copy from ')):
+      file_diff[1] = unquotePath(line.rstrip('\n').split(' ', 2)[2])
+
+    elif line.startswith(('rename to ', 'copy to ')):
+      file_diff[2] = unquotePath(line.rstrip('\n').split(' ', 2)[2])
+
+    elif line.startswith('--- '):
+      file_diff[1] = _stripPrefix(line[4:])
+
+    elif line.startswith('+++ '):
+      file_diff[2] = _stripPrefix(line[4:])
+
+    elif line.startswith('@@'):
+      hunk = parseHunkHeader(line)
+      file_diff[3].append(hunk)
+
+      # Skip the body of the hunk by counting its lines, so that no content line is ever taken for a header
+      num_of_lines = hunk[1] + hunk[3]
+      while num_of_lines > 0:
+        if not _str(next(lines)).startswith('\\'):    # "\ No newline at end of file"
+          num_of_lines -= 1
+
+  if file_diff is not None:
+    yield tuple(file_diff)
+
+
+def deletedLineNums(hunks):
+  """Returns the (old) line numbers of all lines deleted by `hunks`."""
+  line_nums = []
+  for old_start, old_count, _, _ in hunks:
+    line_nums += range(old_start, old_start + old_count)
+  return line_nums
+
+
+class LineMap:
+  """
+  Maps line numbers of the old side of a diff onto the new side, given the diff's -U0 hunks.
+
+  Interval arithmetic: a line either falls inside the deleted range of a hunk, or is shifted by the net number of
+  lines added by all hunks that end before it.
+  """
+
+  def __init__(self, hunks):
+    hunks = sorted(hunks)
+    self.old_starts = [old_start for old_start, old_count, _, _ in hunks]
+    # A hunk that deletes nothing inserts its lines after line `old_start`
+    self.old_ends = [old_start + old_count - 1 if old_count else old_start for old_start, old_count, _, _ in hunks]
+    self.old_counts = [old_count for _, old_count, _, _ in hunks]
+    self.shifts = []
+    shift = 0
+    for _, old_count, _, new_count in hunks:
+      shift += new_count - old_count
+      self.shifts.append(shift)
+
+  def __getitem__(self, lineNum):
+    """Returns the new line number of old line `lineNum`, or None if the diff deletes it."""
+    # Hunks that end before `lineNum`
+    index = bisect.bisect_left(self.old_ends, lineNum)
+    if index < len(self.old_ends) and self.old_counts[index] and self.old_starts[index] <= lineNum:
+      return None
+    if index == 0:
+      return lineNum
+    return lineNum + self.shifts[index - 1]
+
+
+def test():
+  diff = ['\0' + 'a' * 40 + '\n',
+          'diff --git a/old name.c b/new name.c\n',
+          'similarity index 80%\n',
+          'rename from old name.c\n',
+          'rename to new name.c\n',
+          '--- a/old name.c\n',
+          '+++ b/new name.c\n',
+          '@@ -2 +2 @@\n',
+          '-int x;\n',
+          '\\ No newline at end of file\n',
+          '+int y;\n',
+          '\\ No newline at end of file\n',
+          'diff --git a/moved.c b/dir/moved.c\n',
+          'similarity index 100%\n',
+          'rename from moved.c\n',
+          'rename to dir/moved.c\n',
+          '\0' + 'b' * 40 + '\n',
+          'diff --git a/empty.c b/empty.c\n',
+          'new file mode 100644\n',
+          'index 0000000..e69de29\n',
+          'diff --git a/b.c b/b.c\n',
+          '--- a/b.c\n',
+          '+++ b/b.c\n',
+          '@@ -3,0 +4,2 @@\n',
+          '+--- not a header\n',
+          '+@@ -1 +1 @@ not a hunk\n',
+          '@@ -10,2 +11,0 @@\n',
+          '-a\n',
+          '-b\n',
+          'diff --git "a/tab\\there.c" "b/tab\\there.c"\n',
+          'deleted file mode 100644\n',
+          '--- "a/tab\\there.c"\n',
+          '+++ /dev/null\n',
+          '@@ -1 +0,0 @@\n',
+          '-z\n']
+  file_diffs = list(iterFileDiffs(diff))
+  assert file_diffs == [('a' * 40, 'old name.c', 'new name.c', [(2, 1, 2, 1)]),
+                        ('a' * 40, 'moved.c', 'dir/moved.c', []),
+                        ('b' * 40, None, 'empty.c', []),
+                        ('b' * 40, 'b.c', 'b.c', [(3, 0, 4, 2), (10, 2, 11, 0)]),
+                        ('b' * 40, 'tab\there.c', None, [(1, 1, 0, 0)])], file_diffs
+  assert deletedLineNums(file_diffs[3][3]) == [10, 11]
+  assert deletedLineNums([]) == []
+
+  line_map = LineMap(file_diffs[3][3])
+  assert [line_map[line_num] for line_num in range(1, 14)] == [1, 2, 3, 6, 7, 8, 9, 10, 11, None, None, 12, 13]
+  assert LineMap([])[7] == 7
+  assert [LineMap([(1, 1, 0, 0)])[line_num] for line_num in (1, 2)] == [None, 1]
+  print("DiffParser: all checks passed")
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) > 1 and sys.argv[1] == '--test':
+    test()
+    sys.exit()
+
+  # ex. git log -p -U0 --format=%x00%H -n 5 | python DiffParser.py
+  for sha, old_path, new_path, hunks in iterFileDiffs(sys.stdin):
+    print(sha, old_path, new_path, deletedLineNums(hunks))
@@ -0,0 +1,323 @@
+import os
+import sys
+import atexit
+import shutil
+import logging
+import binascii
+import datetime
+import tempfile
+import threading
+from subprocess import Popen, PIPE, check_call, check_output
+
+
+def _str(data):
+  """Returns `data` (as read from a git pipe) as a native string."""
+  if isinstance(data, str):
+    return data
+  return data.decode('utf-8', 'surrogateescape')
+
+
+def _bytes(data):
+  """Returns `data` as bytes, ready to be written to a git pipe."""
+  if isinstance(data, bytes):
+    return data
+  return data.encode('utf-8', 'surrogateescape')
+
+
+def shortDate(timestamp, tz):
+  """
+  Converts a git timestamp and timezone (ex. 1425600000, '+0530') to a 'YYYY-MM-DD' date in that timezone.
+
+  This is the date that `git log --date=short` prints.
+  """
+  offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+  if tz.startswith('-'):
+    offset = -offset
+  return str((datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=timestamp + offset)).date())
+
+
+class GitCatFile:
+  """
+  Long-lived object reader for one git repository.
+
+  Runs `git cat-file --batch` (and `git cat-file --batch-check`, when only the type and size of an object are needed) once, and
+  keeps talking to it over a pipe, so that looking up a blob, a commit or a tree does not fork a new git process.
+  Object names can be anything `git cat-file` understands, ex. 'SHA', 'SHA:path/to/file.c' or 'SHA^{tree}'.
+  Lookups are serialized with a lock, so one reader can be shared by several threads.
+  """
+
+  def __init__(self, repoPath):
+    self.repo_path = os.path.abspath(repoPath)
+    self.lock = threading.Lock()
+    self.batch = None
+    self.batch_check = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, etype, value, traceback):
+    self.close()
+
+  def _start(self, option):
+    return Popen(['git', 'cat-file', option], cwd=self.repo_path,
+                 stdin=PIPE, stdout=PIPE, close_fds=True)
+
+  def _header(self, process, name):
+    process.stdin.write(_bytes(name) + b'\n')
+    process.stdin.flush()
+    return self._readHeader(process, name)
+
+  def _readHeader(self, process, name):
+    # A header looks like "<sha> <type> <size>\n", or "<name> missing\n" if git can't find the object; the name
+    # may contain spaces (ex. 'SHA:my file.c'), so the status is taken from the end of the line
+    header = _str(process.stdout.readline()).rstrip('\n')
+    if header.endswith((' missing', ' ambiguous')) or len(header.split()) != 3:
+      logging.debug("git cat-file: object %s not found in %s" % (name, self.repo_path))
+      return None
+    sha, obj_type, size = header.rsplit(' ', 2)
+    return (sha, obj_type, int(size))
+
+  def close(self):
+    for process in (self.batch, self.batch_check):
+      if process is not None and process.poll() is None:
+        process.stdin.close()
+        process.wait()
+    self.batch = None
+    self.batch_check = None
+
+  def _discard(self, option):
+    # Called (with the lock held) when a lookup fails halfway: the pipe may still hold answers that nobody read, which
+    # the next caller would take for its own, so the process is killed and restarted on next use instead
+    process = self.batch if option == '--batch' else self.batch_check
+    if process is not None and process.poll() is None:
+      process.kill()
+      process.wait()
+    if option == '--batch':
+      self.batch = None
+    else:
+      self.batch_check = None
+
+  def checkObject(self, name):
+    """Returns (sha, type, size) of the object called `name`, or None if it does not exist."""
+    with self.lock:
+      if self.batch_check is None:
+        self.batch_check = self._start('--batch-check')
+      try:
+        return self._header(self.batch_check, name)
+      except BaseException:
+        self._discard('--batch-check')
+        raise
+
+  def checkObjects(self, names, chunkSize=256):
+    """
+    Returns (sha, type, size), or None, for each of `names`, like `checkObject()` does.
+
+    The names are written `chunkSize` at a time before their headers are read back, so that resolving many objects
+    costs one round trip per chunk instead of one per object; a chunk is small enough that neither pipe fills up.
+    """
+    # A newline would split a name in two, and git would answer twice
+    bad_names = [name for name in names if '\n' in name]
+    if bad_names:
+      raise ValueError("Object names can't contain newlines: %r" % (bad_names[0],))
+
+    headers = []
+    with self.lock:
+      if self.batch_check is None:
+        self.batch_check = self._start('--batch-check')
+      try:
+        for start in range(0, len(names), chunkSize):
+          chunk = names[start:start + chunkSize]
+          self.batch_check.stdin.write(b''.join(_bytes(name) + b'\n' for name in chunk))
+          self.batch_check.stdin.flush()
+          headers += [self._readHeader(self.batch_check, name) for name in chunk]
+      except BaseException:
+        self._discard('--batch-check')
+        raise
+    return headers
+
+  def readObject(self, name):
+    """Returns (sha, type, content) of the object called `name`, or None if it does not exist."""
+    with self.lock:
+      if self.batch is None:
+        self.batch = self._start('--batch')
+      try:
+        header = self._header(self.batch, name)
+        if header is None:
+          return None
+        sha, obj_type, size = header
+        content = self.batch.stdout.read(size)
+        self.batch.stdout.read(1)   # the newline that follows the content
+      except BaseException:
+        self._discard('--batch')
+        raise
+      return (sha, obj_type, content)
+
+  def blob(self, name):
+    """Returns the contents of the blob called `name` (ex. 'SHA:path/to/file.c') as bytes, or None if it does not exist."""
+    obj = self.readObject(name)
+    if obj is None or obj[1] != 'blob':
+      return None
+    return obj[2]
+
+  def dumpBlob(self, name, destination):
+    """Writes the contents of the blob called `name` to the file `destination`. Returns False if the blob does not exist."""
+    content = self.blob(name)
+    with open(destination, 'wb') as out_file:
+      if content is not None:
+        out_file.write(content)
+    return content is not None
+
+  def commitInfo(self, sha):
+    """
+    Returns a dictionary with the metadata of commit `sha`, or None if it does not exist.
+
+    The keys are 'sha', 'tree', 'parents' (a list of SHAs), 'author_time', 'committer_time' (UNIX timestamps),
+    and 'author_date', 'committer_date' (YYYY-MM-DD in the timezone of the author/committer, as `git log --date=short` shows them).
+    """
+    obj = self.readObject(sha)
+    if obj is None or obj[1] != 'commit':
+      return None
+
+    info = {'sha': obj[0], 'parents': []}
+    for line in _str(obj[2]).split('\n'):
+      if line == '':
+        break   # end of headers; the commit message follows
+      key, _, value = line.partition(' ')
+      if key == 'tree':
+        info['tree'] = value
+      elif key == 'parent':
+        info['parents'].append(value)
+      elif key in ('author', 'committer'):
+        timestamp, tz = value.rsplit(' ', 2)[1:]
+        info[key + '_time'] = int(timestamp)
+        info[key + '_date'] = shortDate(int(timestamp), tz)
+    return info
+
+  def lsTree(self, treeish, recursive=False):
+    """
+    Returns the entries of the tree `treeish` (ex. 'SHA^{tree}' or 'SHA:src') as a list of (mode, type, sha, path) tuples.
+
+    Like `git ls-tree -r`, a `recursive` listing descends into subtrees and only lists their blobs (and submodules).
+    """
+    obj = self.readObject(treeish)
+    if obj is None or obj[1] != 'tree':
+      return []
+
+    entries = []
+    content = obj[2]
+    pos = 0
+    # Each entry is "<mode> <name>\0<20-byte binary sha>"
+    while pos < len(content):
+      space = content.index(b' ', pos)
+      nul = content.index(b'\0', space)
+      mode = _str(content[pos:space])
+      name = _str(content[space + 1:nul])
+      sha = _str(binascii.hexlify(content[nul + 1:nul + 21]))
+      pos = nul + 21
+
+      if mode == '40000':
+        if recursive:
+          entries += [(sub_mode, sub_type, sub_sha, name + '/' + sub_path)
+                      for sub_mode, sub_type, sub_sha, sub_path in self.lsTree(sha, True)]
+        else:
+          entries.append(('040000', 'tree', sha, name))
+      elif mode == '160000':
+        entries.append((mode, 'commit', sha, name))
+      else:
+        entries.append((mode.zfill(6), 'blob', sha, name))
+    return entries
+
+
+# One reader per repository per process; see `getGitCatFile()`
+_readers = {}
+
+def getGitCatFile(repoPath):
+  """
+  Returns the GitCatFile shared by everyone in this process for the repository at `repoPath`.
+
+  A forked child never reuses its parent's pipes; it gets a reader of its own on first use.
+  """
+  key = (os.getpid(), os.path.abspath(repoPath))
+  if key not in _readers:
+    _readers[key] = GitCatFile(repoPath)
+  return _readers[key]
+
+@atexit.register
+def closeGitCatFiles():
+  for (pid, _), reader in _readers.items():
+    if pid == os.getpid():
+      reader.close()
+
+
+def test():
+  repo_path = tempfile.mkdtemp()
+  try:
+    # Authored at 00:00 on 2015-03-06 in +0530, which is still 2015-03-05 in the committer's -0800
+    env = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@a', GIT_AUTHOR_DATE='1425580200 +0530',
+               GIT_COMMITTER_NAME='c', GIT_COMMITTER_EMAIL='c@c', GIT_COMMITTER_DATE='1425580200 -0800')
+    check_call(['git', 'init', '-q'], cwd=repo_path)
+    os.mkdir(os.path.join(repo_path, 'src'))
+    for file_name, content in (('src/a.c', b'int a;\n'), ('my file.c', b'x\n')):
+      with open(os.path.join(repo_path, file_name), 'wb') as out_file:
+        out_file.write(content)
+    check_call(['git', 'add', '.'], cwd=repo_path)
+    check_call(['git', 'commit', '-q', '-m', 'first'], cwd=repo_path, env=env)
+    with open(os.path.join(repo_path, 'src/a.c'), 'ab') as out_file:
+      out_file.write(b'int b;\n')
+    check_call(['git', 'commit', '-q', '-a', '-m', 'second'], cwd=repo_path, env=env)
+    first, second = _str(check_output(['git', 'rev-list', '--reverse', 'HEAD'], cwd=repo_path)).split()
+
+    with GitCatFile(repo_path) as reader:
+      assert reader.checkObject('HEAD:my file.c')[1:] == ('blob', 2)
+      assert reader.checkObject('0' * 40) is None
+      assert reader.checkObject('HEAD:no such file.c') is None
+      assert [header and header[1] for header in reader.checkObjects(['HEAD', 'HEAD:nope.c', 'HEAD:src'], chunkSize=2)] \
+             == ['commit', None, 'tree']
+      try:
+        reader.checkObjects(['HEAD\nHEAD'])
+        assert False, "a name with a newline was accepted"
+      except ValueError:
+        pass
+
+      # A missing object must not leave anything in the pipe for the next lookup
+      assert reader.readObject('HEAD:no such file.c') is None
+      assert reader.blob(first + ':src/a.c') == b'int a;\n'
+      assert reader.blob('HEAD:src/a.c') == b'int a;\nint b;\n'
+      assert reader.blob('HEAD') is None
+
+      blob_path = os.path.join(repo_path, 'blob')
+      assert reader.dumpBlob('HEAD:my file.c', blob_path) and open(blob_path, 'rb').read() == b'x\n'
+      assert not reader.dumpBlob('HEAD:nope.c', blob_path)
+
+      info = reader.commitInfo(second)
+      assert info['sha'] == second and info['parents'] == [first] and reader.commitInfo(first)['parents'] == []
+      assert (info['author_date'], info['committer_date'], info['author_time']) == ('2015-03-06', '2015-03-05', 1425580200)
+      assert reader.commitInfo('0' * 40) is None and reader.commitInfo('HEAD:src') is None
+
+      assert [entry[1:] for entry in reader.lsTree('HEAD^{tree}')] == \
+             [('blob', reader.checkObject('HEAD:my file.c')[0], 'my file.c'), ('tree', reader.checkObject('HEAD:src')[0], 'src')]
+      assert [(mode, path) for mode, _, _, path in reader.lsTree('HEAD^{tree}', recursive=True)] == \
+             [('100644', 'my file.c'), ('100644', 'src/a.c')]
+      assert reader.lsTree('0' * 40) == []
+
+    assert shortDate(0, '-0100') == '1969-12-31' and shortDate(0, '+0000') == '1970-01-01'
+  finally:
+    shutil.rmtree(repo_path)
+  print("GitCatFile: all checks passed")
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 2:
+    print("!! please give the path to a git repository, or --test")
+    sys.exit()
+
+  if sys.argv[1] == '--test':
+    test()
+    sys.exit()
+
+  reader = getGitCatFile(sys.argv[1])
+  head = reader.commitInfo('HEAD')
+  print(head)
+  for entry in reader.lsTree(head['tree'], recursive=True)[:10]:
+    print(entry)
@@ -0,0 +1,122 @@
+import os
+import sys
+import pickle
+import logging
+import tempfile
+
+
+class Journal:
+  """
+  Append-only record of the finished units of work of a long run, so that a rerun can pick up where it stopped.
+
+  Each entry is a (key, value) pair, ex. a unit of work and the rows it produced, pickled onto the end of the file
+  and flushed to disk before `record()` returns. A crash (or a preempted job) loses at most the entry that was being
+  written; such a torn entry at the end of the file is dropped when the journal is loaded again.
+
+  Only the keys are kept in memory; the values are read back from the file by `items()`, one entry at a time.
+  """
+
+  def __init__(self, path, resume=True):
+    """Opens the journal at `path`. Unless `resume` is True, entries of an earlier run are discarded."""
+    self.path = path
+    self.keys = set()
+    if resume and os.path.isfile(path):
+      self._load()
+    else:
+      open(path, 'wb').close()
+    self.out_file = open(path, 'ab')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, etype, value, traceback):
+    self.close()
+
+  def __len__(self):
+    return len(self.keys)
+
+  def __contains__(self, key):
+    return key in self.keys
+
+  def _entries(self):
+    """Yields (key, value, end offset) for each complete entry in the file."""
+    with open(self.path, 'rb') as in_file:
+      while True:
+        try:
+          key, value = pickle.load(in_file)
+        except EOFError:
+          return
+        except Exception as e:
+          logging.warning("Dropping the torn tail of journal %s: %s" % (self.path, e))
+          return
+        yield (key, value, in_file.tell())
+
+  def items(self):
+    """Yields the (key, value) entries of the journal in the order they were recorded."""
+    self.out_file.flush()
+    for key, value, _ in self._entries():
+      yield (key, value)
+
+  def _load(self):
+    valid_size = 0
+    for key, _, end_offset in self._entries():
+      self.keys.add(key)
+      valid_size = end_offset
+
+    # Cut off a torn last entry, so that new entries are appended right after the last good one
+    if os.path.getsize(self.path) != valid_size:
+      with open(self.path, 'r+b') as journal_file:
+        journal_file.truncate(valid_size)
+
+  def record(self, key, value):
+    """Appends the entry (`key`, `value`) and makes sure it is on disk."""
+    pickle.dump((key, value), self.out_file, 2)
+    self.out_file.flush()
+    os.fsync(self.out_file.fileno())
+    self.keys.add(key)
+
+  def close(self):
+    self.out_file.close()
+
+
+def test():
+  journal_fd, journal_path = tempfile.mkstemp(suffix='.journal')
+  os.close(journal_fd)
+  try:
+    with Journal(journal_path) as journal:
+      journal.record(('ss1', 'a.c'), [1, 2])
+      journal.record(('ss1', 'b.c'), [])
+    good_size = os.path.getsize(journal_path)
+
+    # A run killed halfway through `record()` leaves a torn entry at the end of the file
+    torn_entry = pickle.dumps((('ss2', 'c.c'), list(range(100))), 2)
+    with open(journal_path, 'ab') as journal_file:
+      journal_file.write(torn_entry[:len(torn_entry) // 2])
+
+    with Journal(journal_path) as journal:
+      assert len(journal) == 2 and ('ss1', 'a.c') in journal and ('ss2', 'c.c') not in journal
+      assert os.path.getsize(journal_path) == good_size
+      journal.record(('ss2', 'c.c'), [3])
+      assert list(journal.items()) == [(('ss1', 'a.c'), [1, 2]), (('ss1', 'b.c'), []), (('ss2', 'c.c'), [3])]
+
+    with Journal(journal_path, resume=False) as journal:
+      assert len(journal) == 0 and list(journal.items()) == []
+  finally:
+    if os.path.exists(journal_path):
+      os.remove(journal_path)
+  print("Journal: all checks passed")
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 2:
+    print("!! please give the path to a journal, or --test")
+    sys.exit()
+
+  if sys.argv[1] == '--test':
+    test()
+    sys.exit()
+
+  journal = Journal(sys.argv[1])
+  print("%s: %d entries" % (journal.path, len(journal)))
+  journal.close()
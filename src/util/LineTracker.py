@@ -0,0 +1,150 @@
+import os
+import sys
+import logging
+from subprocess import Popen, PIPE
+
+from CommitIndex import getCommitIndex
+from GitCatFile import getGitCatFile
+from DiffParser import COMMIT_FORMAT, DIFF_OPTIONS, iterFileDiffs, LineMap
+
+
+class LineTracker:
+  """
+  Maps lines of a file forward through history, like `git blame --reverse -w` does, without blaming.
+
+  Starting from the lines of `filePath` in `startSha`, it walks the first-parent commits that touch the file up to the
+  furthest target commit with a single `git log -p -U0 -w`, and carries every line's number through each diff with
+  interval arithmetic (see `DiffParser.LineMap`). The position of the lines is recorded as the walk passes each
+  target, so all lines are mapped onto all targets on that chain in one go.
+
+  Merges are where following first parents and blaming part ways: `git blame --reverse` also follows a line into
+  the other parents. So the walk stops at the first merge whose parents disagree on the contents of the file.
+
+  A line that is deleted along the way keeps the number it had in the last revision that still contained it, which
+  is what `git blame --reverse` reports for it too. What the tracker cannot follow -- targets that are not on the
+  first-parent chain of the walk, targets past such a merge, and files that get renamed or deleted before a
+  target -- is left out of its results, for the caller to reverse-blame instead.
+  """
+
+  def __init__(self, repoPath, commitIndex=None):
+    self.repo_path = os.path.abspath(repoPath)
+    self.commit_index = commitIndex if commitIndex is not None else getCommitIndex(repoPath)
+    self.cat_file = getGitCatFile(repoPath)
+    self.divergent_merges = {}    # (merge SHA, file) -> whether the parents of the merge have different versions of the file
+
+  def mapLines(self, startSha, filePath, lineNums, targetShas):
+    """
+    Maps `lineNums` of `filePath` in `startSha` onto each of `targetShas`.
+
+    Returns a dictionary {target_sha: {line_num: (mapped_file, mapped_line_num)}} with line numbers as strings. Targets
+    the tracker could not follow are missing from it.
+    """
+    mapped_lines_per_target = {}
+    if not lineNums or self.cat_file.checkObject(startSha + ':' + filePath) is None:
+      return mapped_lines_per_target
+
+    line_nums = sorted(set(int(line_num) for line_num in lineNums))
+    remaining_shas = set(targetShas)
+    if startSha in remaining_shas:
+      remaining_shas.discard(startSha)
+      mapped_lines_per_target[startSha] = dict((str(line_num), (filePath, str(line_num))) for line_num in line_nums)
+
+    # Walk towards the furthest target; the targets on its first-parent chain come along for free
+    generation = lambda sha: self.commit_index.generations[self.commit_index.idOf(sha)]
+    remaining_shas = [sha for sha in remaining_shas if sha in self.commit_index]
+    while remaining_shas:
+      furthest_sha = max(remaining_shas, key=generation)
+      chain = self.commit_index.firstParentChain(startSha, furthest_sha)
+      if chain is None:
+        remaining_shas.remove(furthest_sha)
+        continue
+
+      on_chain = set(chain)
+      walkable = set(chain[:self._walkableLength(chain, filePath)])
+      chain_targets = [sha for sha in remaining_shas if sha in walkable]
+      if chain_targets:
+        mapped_lines_per_target.update(self._walk(startSha, filePath, line_nums, chain[:len(walkable)], chain_targets))
+      remaining_shas = [sha for sha in remaining_shas if sha not in on_chain]
+
+    return mapped_lines_per_target
+
+  def _walkableLength(self, chain, filePath):
+    """Returns the number of commits of `chain` before its first merge whose parents have different versions of `filePath`."""
+    for position, sha in enumerate(chain):
+      parent_ids = self.commit_index.parentIds(self.commit_index.idOf(sha))
+      if len(parent_ids) < 2:
+        continue
+      key = (sha, filePath)
+      if key not in self.divergent_merges:
+        blobs = set()
+        for parent_id in parent_ids.tolist():
+          blob = self.cat_file.checkObject(self.commit_index.shaOf(parent_id) + ':' + filePath)
+          blobs.add(blob[0] if blob is not None else None)
+        self.divergent_merges[key] = len(blobs) > 1
+      if self.divergent_merges[key]:
+        return position
+    return len(chain)
+
+  def _walk(self, startSha, filePath, lineNums, chain, targetShas):
+    """Carries `lineNums` along `chain` (first-parent commits after `startSha`, oldest first) and records them at each of `targetShas`."""
+    positions = dict((sha, position) for position, sha in enumerate(chain))
+    targets = sorted(targetShas, key=lambda sha: positions[sha])
+
+    mapped = dict((line_num, line_num) for line_num in lineNums)    # line in `startSha` -> current/last line number
+    alive = set(lineNums)
+    mapped_lines_per_target = {}
+
+    def record(target_sha):
+      mapped_lines_per_target[target_sha] = dict((str(line_num), (filePath, str(mapped[line_num])))
+                                                 for line_num in lineNums)
+
+    # `--literal-pathspecs` so that file names with glob characters are taken as they are
+    process = Popen(['git', '--literal-pathspecs', 'log', '--reverse', '--first-parent', '-m', '-p', '-U0', '-w',
+                     '--no-renames', '--format=' + COMMIT_FORMAT] + DIFF_OPTIONS +
+                    [startSha + '..' + chain[-1], '--', filePath],
+                    cwd=self.repo_path, stdout=PIPE, close_fds=True)
+    next_target = 0
+    completed = True
+    for sha, old_path, new_path, hunks in iterFileDiffs(process.stdout):
+      position = positions.get(sha)
+      if position is None:
+        logging.warning("LineTracker: %s is not on the first-parent chain %s..%s" % (sha, startSha, chain[-1]))
+        completed = False
+        break
+      while next_target < len(targets) and positions[targets[next_target]] < position:
+        record(targets[next_target])
+        next_target += 1
+
+      if old_path != filePath or new_path != filePath:
+        # Renamed or deleted; `git blame --reverse` knows better from here on
+        completed = False
+        break
+
+      line_map = LineMap(hunks)
+      for line_num in list(alive):
+        new_line_num = line_map[mapped[line_num]]
+        if new_line_num is None:
+          alive.discard(line_num)
+        else:
+          mapped[line_num] = new_line_num
+
+    process.stdout.close()
+    if process.wait() != 0 and completed:
+      logging.warning("LineTracker: `git log` failed for %s..%s -- %s" % (startSha, chain[-1], filePath))
+      return {}
+
+    if completed:
+      for target_sha in targets[next_target:]:
+        record(target_sha)
+    return mapped_lines_per_target
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 6:
+    print("!! please give the path to a git repository, a start SHA, a file, a comma-separated list of lines and target SHAs")
+    sys.exit()
+
+  tracker = LineTracker(sys.argv[1])
+  for target_sha, mapped_lines in sorted(tracker.mapLines(sys.argv[2], sys.argv[3], sys.argv[4].split(','), sys.argv[5:]).items()):
+    print(target_sha, sorted(mapped_lines.items(), key=lambda item: int(item[0])))
@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import sqlite3
+import logging
+
+import Util
+
+
+class ReverseBlameCache:
+  """
+  Persistent cache of `git blame --reverse` line mappings, keyed by (bi_sha, bi_file, target_sha).
+
+  For each line `bi_line_num` of `bi_file` in `bi_sha`, it remembers where reverse-blaming that line onto `target_sha`
+  put it: (mapped_file, mapped_line_num). Since commits never change, neither do these mappings, so they stay valid
+  across runs (as long as the blame options stay `--reverse -w -n -f`, which all our SZZ variants use).
+
+  The cache is an SQLite database, which several processes can share. It holds at most `maxEntries` line mappings;
+  beyond that, the least recently used ones are evicted.
+  """
+
+  EVICT_EVERY = 10000     # inserts between two checks of the size of the cache
+
+  def __init__(self, dbPath, maxEntries=5000000):
+    self.db_path = dbPath
+    self.max_entries = maxEntries
+    self.inserts_since_eviction = 0
+
+    self.conn = sqlite3.connect(dbPath, timeout=600)
+    self.conn.text_factory = str
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS reverse_blame ("
+                      " bi_sha TEXT, bi_file TEXT, target_sha TEXT, bi_line_num TEXT,"
+                      " mapped_file TEXT, mapped_line_num TEXT, last_used REAL,"
+                      " PRIMARY KEY (bi_sha, bi_file, target_sha, bi_line_num))")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS reverse_blame_lru ON reverse_blame (last_used)")
+    self.conn.commit()
+
+  def close(self):
+    self.conn.close()
+
+  def lookup(self, biSha, biFile, targetSha, lineNums):
+    """Returns a dictionary that maps those of `lineNums` that are in the cache to their (mapped_file, mapped_line_num)."""
+    rows = self.conn.execute("SELECT bi_line_num, mapped_file, mapped_line_num FROM reverse_blame"
+                             " WHERE bi_sha = ? AND bi_file = ? AND target_sha = ?",
+                             (biSha, biFile, targetSha)).fetchall()
+    if not rows:
+      return {}
+
+    self.conn.execute("UPDATE reverse_blame SET last_used = ? WHERE bi_sha = ? AND bi_file = ? AND target_sha = ?",
+                      (time.time(), biSha, biFile, targetSha))
+    self.conn.commit()
+
+    wanted = set(str(line_num) for line_num in lineNums)
+    return dict((line_num, (mapped_file, mapped_line_num))
+                for line_num, mapped_file, mapped_line_num in rows if line_num in wanted)
+
+  def store(self, biSha, biFile, targetSha, mappedLines):
+    """Adds `mappedLines`, a dictionary that maps line numbers to (mapped_file, mapped_line_num), to the cache."""
+    if not mappedLines:
+      return
+
+    now = time.time()
+    self.conn.executemany("INSERT OR REPLACE INTO reverse_blame VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          [(biSha, biFile, targetSha, str(line_num), mapped_file, str(mapped_line_num), now)
+                           for line_num, (mapped_file, mapped_line_num) in mappedLines.items()])
+    self.conn.commit()
+
+    self.inserts_since_eviction += len(mappedLines)
+    if self.inserts_since_eviction >= self.EVICT_EVERY:
+      self.evict()
+
+  def evict(self):
+    """Drops the least recently used line mappings until at most `max_entries` are left."""
+    self.inserts_since_eviction = 0
+    num_of_entries = self.conn.execute("SELECT COUNT(*) FROM reverse_blame").fetchone()[0]
+    if num_of_entries <= self.max_entries:
+      return
+
+    logging.info("Evicting %d entries from %s" % (num_of_entries - self.max_entries, self.db_path))
+    self.conn.execute("DELETE FROM reverse_blame WHERE rowid IN"
+                      " (SELECT rowid FROM reverse_blame ORDER BY last_used LIMIT ?)",
+                      (num_of_entries - self.max_entries,))
+    self.conn.commit()
+
+  def reverseBlame(self, biSha, biFile, targetSha, lineNums, reverseBlameLines):
+    """
+    Returns a dictionary that maps each of `lineNums` to its (mapped_file, mapped_line_num) on `targetSha`.
+
+    Lines missing from the cache are reverse-blamed all at once by calling `reverseBlameLines(missing_line_nums)`,
+    which should return such a dictionary for the lines it could map. Lines it could not map are left out of the
+    result (and out of the cache, so that they are retried next time).
+    """
+    mapped_lines = self.lookup(biSha, biFile, targetSha, lineNums)
+    missing_line_nums = [line_num for line_num in lineNums if str(line_num) not in mapped_lines]
+    if missing_line_nums:
+      newly_mapped_lines = reverseBlameLines(missing_line_nums)
+      self.store(biSha, biFile, targetSha, newly_mapped_lines)
+      for line_num, mapping in newly_mapped_lines.items():
+        mapped_lines[str(line_num)] = mapping
+    return mapped_lines
+
+
+# One cache per database per process; SQLite connections must not be shared with forked children
+_caches = {}
+
+def getReverseBlameCache(dataDir, projectName):
+  """Returns the reverse-blame cache of `projectName`, stored in `<dataDir>/cache/<projectName>.reverse_blame.sqlite`."""
+  cache_dir = os.path.join(dataDir, 'cache')
+  Util.create_dir(cache_dir)
+  db_path = os.path.join(cache_dir, projectName + '.reverse_blame.sqlite')
+
+  key = (os.getpid(), os.path.abspath(db_path))
+  if key not in _caches:
+    _caches[key] = ReverseBlameCache(db_path)
+  return _caches[key]
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 3:
+    print("!! please give the data directory and the project name")
+    sys.exit()
+
+  cache = getReverseBlameCache(sys.argv[1], sys.argv[2])
+  print("%s: %d cached line mappings" % (cache.db_path, cache.conn.execute("SELECT COUNT(*) FROM reverse_blame").fetchone()[0]))
@@ -0,0 +1,59 @@
+import os
+import sys
+
+from GitCatFile import getGitCatFile
+import Util
+
+# Extensions of the source files that the later stages (learn/change/test dirs, srcML) read
+SOURCE_EXTENSIONS = ('.c', '.cpp', '.cc', '.java')
+
+
+def isSourceFile(path, extensions=SOURCE_EXTENSIONS):
+  """Returns True if the extension of `path` (in any case) is one of `extensions`."""
+  return os.path.splitext(path)[1].lower() in extensions
+
+
+def flatPath(path):
+  """Returns the name of `path` in the flattened layout of the corpus: 's1/s2/file.c' becomes 's1__s2__file.c'."""
+  return path.replace('/', Util.SEP)
+
+
+def listSourceFiles(repoPath, sha, extensions=SOURCE_EXTENSIONS):
+  """
+  Returns (path, blob SHA) of each source file (see `isSourceFile()`) in the tree of commit `sha`, like a filtered
+  `git ls-tree -r` would, without checking anything out. Symbolic links and submodules are left out.
+  """
+  reader = getGitCatFile(repoPath)
+  return [(path, blob_sha) for mode, obj_type, blob_sha, path in reader.lsTree(sha + '^{tree}', recursive=True)
+          if obj_type == 'blob' and mode != '120000' and isSourceFile(path, extensions)]
+
+
+def dumpSourceFiles(repoPath, sha, outDir, extensions=SOURCE_EXTENSIONS, blobStore=None):
+  """
+  Writes the source files of commit `sha` straight from the object store of the repo at `repoPath` into `outDir`,
+  in the flattened layout (see `flatPath()`). With a `blobStore` (a `BlobStore.BlobStore`), the files are hard links
+  to its blobs instead, and `outDir` gets a manifest of them.
+
+  Returns the list of (path, blob SHA) that were written.
+  """
+  Util.create_dir(outDir)
+  reader = getGitCatFile(repoPath)
+  source_files = listSourceFiles(repoPath, sha, extensions)
+  for path, blob_sha in source_files:
+    if blobStore is not None:
+      blobStore.link(blob_sha, os.path.join(outDir, flatPath(path)))
+    else:
+      reader.dumpBlob(blob_sha, os.path.join(outDir, flatPath(path)))
+  if blobStore is not None:
+    blobStore.writeManifests()
+  return source_files
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 3:
+    print("!! please give a repository and a commit")
+    sys.exit()
+
+  for path, blob_sha in listSourceFiles(sys.argv[1], sys.argv[2]):
+    print("%s %s" % (blob_sha, flatPath(path)))
@@ -0,0 +1,237 @@
+import os
+import sys
+import ntpath
+
+from git import Repo
+
+from GitCatFile import getGitCatFile
+
+
+# Options of the forward `git blame` that finds bug-introducing lines: ignore whitespace, and follow lines that were
+# moved or copied across files
+BLAME_OPTIONS = ('-w', '-M', '-C', '-C')
+
+# Options of the `git blame --reverse` that maps buggy lines onto later commits; `ReverseBlameCache` assumes these
+REVERSE_BLAME_OPTIONS = ('--reverse', '-w')
+
+
+def pathLeaf(path):
+  """Returns the basename of the file/directory path in an _extremely_ robust way. For example, pathLeaf('/hame/saheel/git_repos/szz/abc.c/') will return 'abc.c'."""
+  head, tail = ntpath.split(path)
+  return tail or ntpath.basename(head)
+
+
+def dismemberFilename(myname, mode):
+  """
+  Breaks down a complicated filename and returns a 2-element list consisting of the filename-component and the SHA-component
+
+  If mode == 'learn', given a string of the form "s1__s2__s3.c", it returns ['s1/s2/s3.c', -1]
+  If mode == 'old', given a string of the form "s1__s2__s3__SHA.c", it returns ['s1/s2/s3.c', SHA]
+
+  NOTE: Since the s_i's represent the location of the file in the project directory structure, 'i' is not fixed. Thus, we may have just s1 and s2. Or we may have s1 through s4.
+  """
+  if mode == 'learn':
+    return [pathLeaf(myname).replace('__', '/'), -1]
+  elif mode == 'old':
+    filename_parts = myname.split('__')     # ['s1', 's2', 's3', 'SHA.c']
+    SHA_and_extension = filename_parts[-1].split('.')       # ['SHA', 'c']
+    return ['/'.join(filename_parts[:-1]) + '.' + SHA_and_extension[1], SHA_and_extension[0]]
+
+
+def parseBlameLine(blameInfo):
+  """
+  Splits one line of `git blame -n -f --abbrev=40` output into its components.
+
+  Returns a 4-element list: [SHA, file path in SHA, line number in SHA, line number in the blamed revision]. For a
+  reverse blame, the last element is the line number in the starting revision of the range.
+  """
+  header = blameInfo.split('(')[0].split()
+  sha = blameInfo.split()[0][-40:]
+  file_path = ' '.join(header[1:-1])
+  line_num = header[-1]
+  final_line_num = blameInfo.split(')')[0].split()[-1]
+  return [sha, file_path, line_num, final_line_num]
+
+
+def projectRepoPath(ssPath):
+  """
+  Returns the path to the project clone (`data/projects/<project>`) from which the snapshot at `ssPath`
+  (`data/snapshots/<project>/<ss>/`) was dumped.
+
+  Falls back to `ssPath` itself if there is no such clone.
+  """
+  project_snapshots_dir = os.path.dirname(os.path.dirname(ssPath))
+  data_dir = os.path.dirname(os.path.dirname(project_snapshots_dir))
+  project_repo_path = os.path.join(data_dir, 'projects', pathLeaf(project_snapshots_dir))
+  if os.path.isdir(project_repo_path):
+    return project_repo_path
+  return ssPath
+
+
+class Blamer:
+  """
+  The blame/reverse-blame engine shared by all SZZ variants.
+
+  Every call blames all the given lines of a file with a single `git blame` (one `-L` option per line), and only
+  falls back to smaller invocations if that fails, so that one bad line does not spoil the others. Reverse-blames go
+  through `reverseBlameCache` (a `ReverseBlameCache`) if one is given.
+  """
+
+  def __init__(self, repoPath, reverseBlameCache=None):
+    self.repo_path = repoPath
+    self.repo = Repo(repoPath)
+    self.cache = reverseBlameCache
+
+  def _blame(self, options, lineNums, rev, filePath):
+    """Returns the lines of `git blame <options> -L... <rev> -- <filePath>` output, or None (with the error on stderr) if git fails."""
+    blame_options = list(options) + ['-n', '-f', '--abbrev=40']
+    blame_options += ['-L' + str(line_num) + ',+1' for line_num in lineNums]
+    blame_options += [rev, '--', filePath]
+    try:
+      return self.repo.git.blame(stdout_as_string=False, *blame_options).splitlines()
+    except Exception as e:
+      sys.stderr.write("\nError while blaming " + filePath + " in " + rev + "!\n" + str(e))
+      return None
+
+  def blameLines(self, rev, filePath, lineNums, blameOptions=BLAME_OPTIONS):
+    """
+    Blames `lineNums` of `filePath` in `rev` (ex. 'SHA^').
+
+    Returns a dictionary that maps each line number (as a string) to [buggy_SHA, buggy_file_path, buggy_line_num].
+    Lines that could not be blamed are missing from the dictionary.
+    """
+    blame_infos = self._blame(blameOptions, lineNums, rev, filePath)
+    if blame_infos is None:
+      if len(lineNums) == 1:
+        return {}
+      blamed_lines = {}
+      for line_num in lineNums:
+        blamed_lines.update(self.blameLines(rev, filePath, [line_num], blameOptions))
+      return blamed_lines
+
+    blamed_lines = {}
+    for blame_info in blame_infos:
+      buggy_sha, buggy_file_path, buggy_line_num, line_num = parseBlameLine(blame_info)
+      blamed_lines[line_num] = [buggy_sha, buggy_file_path, buggy_line_num]
+    return blamed_lines
+
+  def _reverseBlameLines(self, biSha, biFile, targetSha, lineNums):
+    """Reverse-blames `lineNums` with a single `git blame --reverse`; returns None if that fails."""
+    blame_infos = self._blame(REVERSE_BLAME_OPTIONS, lineNums, biSha + '..' + targetSha, biFile)
+    if blame_infos is None:
+      return None
+    if len(blame_infos) != len(lineNums):
+      sys.stderr.write("\nStrange error... reverse-blaming " + biFile + " (" + biSha + ") onto " + targetSha
+                       + " gave " + str(len(blame_infos)) + " lines for " + str(len(lineNums)) + ". Please check!")
+      return None
+
+    # The number in parentheses is the line number in `biSha`, i.e. one of `lineNums`
+    mapped_lines = {}
+    for blame_info in blame_infos:
+      _, mapped_file, mapped_line_num, line_num = parseBlameLine(blame_info)
+      mapped_lines[line_num] = (mapped_file, mapped_line_num)
+    return mapped_lines
+
+  def reverseBlameLines(self, biSha, biFile, targetSha, lineNums, lineNumGroups=None):
+    """
+    Maps `lineNums` of `biFile` in `biSha` onto `targetSha`, like `git blame --reverse -w biSha..targetSha` does.
+
+    Returns a dictionary that maps line numbers (as strings) to their (mapped_file, mapped_line_num); lines that could
+    not be mapped are left out. If reverse-blaming all missing lines at once fails, they are retried one group of
+    `lineNumGroups` (ex. the lines asked for by one bug-fixing SHA) at a time, or else one line at a time.
+    """
+    # git-blame-reverse fails on an empty range; every line maps onto itself anyway
+    if targetSha == biSha:
+      return dict((str(line_num), (biFile, str(line_num))) for line_num in lineNums)
+
+    def reverse_blame_lines(line_nums):
+      mapped_lines = self._reverseBlameLines(biSha, biFile, targetSha, line_nums)
+      if mapped_lines is not None:
+        return mapped_lines
+
+      missing_line_nums = set(str(line_num) for line_num in line_nums)
+      groups = lineNumGroups if lineNumGroups is not None and len(lineNumGroups) > 1 else [[line_num] for line_num in line_nums]
+      mapped_lines = {}
+      if len(groups) > 1:
+        for group in groups:
+          group = [line_num for line_num in group if str(line_num) in missing_line_nums]
+          if group:
+            mapped_lines.update(self._reverseBlameLines(biSha, biFile, targetSha, group) or {})
+      return mapped_lines
+
+    if self.cache is None:
+      return reverse_blame_lines(lineNums)
+    return self.cache.reverseBlame(biSha, biFile, targetSha, lineNums, reverse_blame_lines)
+
+
+class SnapshotTargets:
+  """
+  Targets of the snapshot-based SZZ (src/szz/): the snapshots up to `lastSsName` that were taken after the
+  bug-introducing commit was authored. Snapshots are named after their dates, so comparing the author date of the
+  bug-introducing commit (YYYY-MM-DD) with the names of the snapshots is enough.
+  """
+
+  def __init__(self, ssShaInfo, commitIndex, lastSsName=None, repoPath=None):
+    self.ss_sha_info = ssShaInfo
+    self.commit_index = commitIndex
+    self.repo_path = repoPath
+    self.ss_names = sorted(name for name in ssShaInfo.keys() if lastSsName is None or name <= lastSsName)
+
+  def authorDate(self, sha):
+    """Returns the author date (YYYY-MM-DD) of `sha`, from the commit index or else from the repo at `repoPath`; '' if neither has it."""
+    author_date = self.commit_index.authorDate(sha)
+    if author_date == '' and self.repo_path is not None:
+      # Ex. a commit that is not reachable from the refs the index was built from
+      commit_info = getGitCatFile(self.repo_path).commitInfo(sha)
+      if commit_info is not None:
+        author_date = commit_info['author_date']
+    return author_date
+
+  def targets(self, biSha, bfSha):
+    """Returns the (name, SHA) of each snapshot onto which the lines of `biSha`, fixed in `bfSha`, are mapped, oldest first."""
+    bi_date = self.authorDate(biSha)
+    if bi_date == '':
+      # '' sorts before every snapshot name, so it would map the lines onto all of them
+      sys.stderr.write("\nUnknown bug-introducing commit " + biSha + " (fixed in " + bfSha + "); skipping it\n")
+      return []
+    return [(ss_name, self.ss_sha_info[ss_name]) for ss_name in self.ss_names if bi_date < ss_name]
+
+
+class AncestryPathTargets:
+  """
+  Targets of the commit-based SZZ variants (src/szz_all_commits/ and src/szz/new_szz.py): those of `shas` (ex. all
+  changed commits, or the snapshot SHAs) that lie strictly between the bug-introducing and the bug-fixing commit on
+  their ancestry path.
+  """
+
+  def __init__(self, shas, commitIndex):
+    self.shas = shas
+    self.commit_index = commitIndex
+
+  def targets(self, biSha, bfSha):
+    """Returns the (SHA, SHA) of each commit onto which the lines of `biSha`, fixed in `bfSha`, are mapped."""
+    return [(sha, sha) for sha in self.commit_index.shasOnAncestryPath(biSha, bfSha, self.shas)]
+
+
+def mapOntoTargets(blamer, targets, biSha, biFile, bfSha, lineNums):
+  """
+  Maps `lineNums` of `biFile` in `biSha`, fixed in `bfSha`, onto each of the targets that the `targets` strategy
+  (ex. `SnapshotTargets` or `AncestryPathTargets`) chooses for them.
+
+  Returns a list of (target name, target SHA, mapped lines), where the mapped lines are what
+  `Blamer.reverseBlameLines()` returns.
+  """
+  return [(target_name, target_sha, blamer.reverseBlameLines(biSha, biFile, target_sha, lineNums))
+          for target_name, target_sha in targets.targets(biSha, bfSha)]
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) < 5:
+    print("!! please give a repository, a bug-fixing SHA, a file and some line numbers")
+    sys.exit()
+
+  blamer = Blamer(sys.argv[1])
+  bf_sha, file_path, line_nums = sys.argv[2], sys.argv[3], sys.argv[4:]
+  for line_num, (bi_sha, bi_file, bi_line_num) in sorted(blamer.blameLines(bf_sha + '^', file_path, line_nums).items()):
+    print("%s -> %s %s %s" % (line_num, bi_sha, bi_file, bi_line_num))
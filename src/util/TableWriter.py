@@ -0,0 +1,200 @@
+import os
+import csv
+import sys
+import shutil
+import tempfile
+
+# Formats `openTableWriter()` can write and `readTable()` can read
+TABLE_FORMATS = ('csv', 'parquet')
+
+
+class CsvTableWriter:
+  """
+  Writes rows to a CSV file as they come, `chunkRows` rows at a time, so that a table never has to be built in memory.
+  """
+
+  def __init__(self, path, colNames, colTypes=None, chunkRows=10000):
+    self.path = path
+    self.chunk_rows = chunkRows
+    self.chunk = []
+    self.out_file = open(path, 'wb')
+    self.csv_writer = csv.writer(self.out_file)
+    self.csv_writer.writerow(colNames)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, etype, value, traceback):
+    self.close()
+
+  def write(self, row):
+    self.chunk.append(row)
+    if len(self.chunk) >= self.chunk_rows:
+      self.flush()
+
+  def writeRows(self, rows):
+    for row in rows:
+      self.write(row)
+
+  def flush(self):
+    self.csv_writer.writerows(self.chunk)
+    self.chunk = []
+
+  def close(self):
+    self.flush()
+    self.out_file.close()
+
+
+class ParquetTableWriter:
+  """
+  Writes rows to a Parquet file as they come, one row group of `chunkRows` rows at a time.
+
+  `colTypes` maps column names to 'int' or 'str' (the default). String columns, such as SHAs and file names, are
+  dictionary-encoded, so that each distinct value is stored once per row group. Needs pyarrow.
+  """
+
+  def __init__(self, path, colNames, colTypes=None, chunkRows=100000):
+    try:
+      import pyarrow
+      import pyarrow.parquet
+    except ImportError:
+      raise ImportError("Writing Parquet files needs pyarrow (`pip install pyarrow`); or use the 'csv' format")
+    self.pa = pyarrow
+    self.pq = pyarrow.parquet
+
+    self.path = path
+    self.col_names = list(colNames)
+    self.col_types = [(colTypes or {}).get(col_name, 'str') for col_name in self.col_names]
+    self.chunk_rows = chunkRows
+    self.chunk = []
+    self.parquet_writer = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, etype, value, traceback):
+    self.close()
+
+  def write(self, row):
+    self.chunk.append(row)
+    if len(self.chunk) >= self.chunk_rows:
+      self.flush()
+
+  def writeRows(self, rows):
+    for row in rows:
+      self.write(row)
+
+  def flush(self):
+    if not self.chunk and self.parquet_writer is not None:
+      return
+
+    arrays = []
+    for col_index, col_type in enumerate(self.col_types):
+      values = [row[col_index] for row in self.chunk]
+      if col_type == 'int':
+        arrays.append(self.pa.array([int(value) for value in values], type=self.pa.int64()))
+      else:
+        arrays.append(self.pa.array([str(value) for value in values], type=self.pa.string()).dictionary_encode())
+    table = self.pa.Table.from_arrays(arrays, names=self.col_names)
+    self.chunk = []
+
+    if self.parquet_writer is None:
+      self.parquet_writer = self.pq.ParquetWriter(self.path, table.schema)
+    self.parquet_writer.write_table(table)
+
+  def close(self):
+    self.flush()
+    self.parquet_writer.close()
+
+
+def openTableWriter(path, colNames, colTypes=None, tableFormat='csv'):
+  """Returns a writer of `tableFormat` (one of `TABLE_FORMATS`) that streams rows with the columns `colNames` to `path`."""
+  if tableFormat == 'csv':
+    return CsvTableWriter(path, colNames, colTypes)
+  elif tableFormat == 'parquet':
+    return ParquetTableWriter(path, colNames, colTypes)
+  raise ValueError("`tableFormat` should be one of " + str(TABLE_FORMATS) + ". Given: " + str(tableFormat))
+
+
+def readTable(path, tableFormat='csv'):
+  """
+  Reads back a table written by `openTableWriter()`, one chunk at a time.
+
+  Returns (column names, an iterator over the rows). Values of CSV tables are strings.
+  """
+  if tableFormat == 'csv':
+    in_file = open(path, 'rb')
+    csv_reader = csv.reader(in_file)
+    return (next(csv_reader), csv_reader)
+
+  elif tableFormat == 'parquet':
+    import pyarrow.parquet
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    col_names = parquet_file.schema.names
+
+    def rows():
+      for row_group_index in range(parquet_file.num_row_groups):
+        columns = parquet_file.read_row_group(row_group_index).to_pydict()
+        for row in zip(*[columns[col_name] for col_name in col_names]):
+          yield row
+    return (col_names, rows())
+
+  raise ValueError("`tableFormat` should be one of " + str(TABLE_FORMATS) + ". Given: " + str(tableFormat))
+
+
+def test():
+  col_names = ['sha', 'file', 'line']
+  rows = [('a' * 40, 'src/a.c', 1), ('b' * 40, 'with, comma "and quotes".c', 20), ('a' * 40, 'src/a.c', 300)]
+  table_formats = ['csv']
+  try:
+    import pyarrow
+    table_formats.append('parquet')
+  except ImportError:
+    print("TableWriter: pyarrow is not installed; skipping the Parquet checks")
+
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    for table_format in table_formats:
+      path = os.path.join(tmp_dir, 'table.' + table_format)
+      # Chunks of 2 rows, so that the rows span a full and a partial chunk
+      writer = CsvTableWriter if table_format == 'csv' else ParquetTableWriter
+      with writer(path, col_names, {'line': 'int'}, chunkRows=2) as table_writer:
+        table_writer.write(rows[0])
+        table_writer.writeRows(rows[1:])
+      read_col_names, read_rows = readTable(path, table_format)
+      assert list(read_col_names) == col_names
+      expected_rows = [(sha, file_name, str(line) if table_format == 'csv' else line) for sha, file_name, line in rows]
+      assert [tuple(row) for row in read_rows] == expected_rows, table_format
+
+      # A table without rows still has its header
+      with openTableWriter(path, col_names, {'line': 'int'}, table_format):
+        pass
+      read_col_names, read_rows = readTable(path, table_format)
+      assert list(read_col_names) == col_names and list(read_rows) == []
+
+    try:
+      openTableWriter(os.path.join(tmp_dir, 'table.json'), col_names, tableFormat='json')
+      assert False, "an unknown format was accepted"
+    except ValueError:
+      pass
+  finally:
+    shutil.rmtree(tmp_dir)
+  print("TableWriter: all checks passed")
+
+
+if __name__ == '__main__':
+
+  if len(sys.argv) > 1 and sys.argv[1] == '--test':
+    test()
+    sys.exit()
+
+  if len(sys.argv) < 3:
+    print("!! please give the path to a table and its format, or --test")
+    sys.exit()
+
+  col_names, rows = readTable(sys.argv[1], sys.argv[2])
+  print(col_names)
+  for row_index, row in enumerate(rows):
+    if row_index == 10:
+      break
+    print(row)